@@ -0,0 +1,101 @@
+"""
+Minimal stand-ins for the WebUI modules GelbooruPromptRandomizer imports, so the benchmarks can
+load the script outside the WebUI. Only used by the bench harness.
+
+install() registers fake `modules` (and `gradio`, if it is not installed) packages and returns
+the options object, pre-filled with the defaults the script registers in on_ui_settings.
+"""
+import sys
+import types
+
+
+class _Options:
+    def __init__(self):
+        self.__dict__['data'] = {}
+
+    def __getattr__(self, key):
+        try:
+            return self.__dict__['data'][key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self.__dict__['data'][key] = value
+
+    def add_option(self, key, info):
+        self.data.setdefault(key, info.default)
+
+
+class _OptionInfo:
+    def __init__(self, default=None, label='', component=None, component_args=None, **kwargs):
+        self.default = default
+
+    def info(self, *args, **kwargs):
+        return self
+
+    def needs_reload_ui(self):
+        return self
+
+
+class StableDiffusionProcessing:
+    def __init__(self, **kwargs):
+        self.prompt = ''
+        self.negative_prompt = ''
+        self.width = 512
+        self.height = 512
+        self.batch_size = 1
+        self.n_iter = 1
+        self.extra_generation_params = {}
+        self.__dict__.update(kwargs)
+
+
+class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
+    pass
+
+
+class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
+    pass
+
+
+def install() -> _Options:
+    callbacks = {}
+
+    def register(name):
+        return lambda fn: callbacks.setdefault(name, []).append(fn)
+
+    modules = types.ModuleType('modules')
+    modules.__path__ = []
+    scripts = types.ModuleType('modules.scripts')
+    scripts.AlwaysVisible = object()
+    scripts.Script = type('Script', (), {'__init__': lambda self: None})
+    shared = types.ModuleType('modules.shared')
+    shared.opts = _Options()
+    shared.OptionInfo = _OptionInfo
+    script_callbacks = types.ModuleType('modules.script_callbacks')
+    script_callbacks.callbacks = callbacks
+    for name in ('on_ui_settings', 'on_app_started'):
+        setattr(script_callbacks, name, register(name))
+    processing = types.ModuleType('modules.processing')
+    for cls in (StableDiffusionProcessing, StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img):
+        setattr(processing, cls.__name__, cls)
+
+    for module in (scripts, shared, script_callbacks, processing):
+        setattr(modules, module.__name__.split('.')[1], module)
+        sys.modules[module.__name__] = module
+    sys.modules['modules'] = modules
+
+    try:
+        import gradio  # noqa: F401
+    except ImportError:
+        gradio = types.ModuleType('gradio')
+        gradio.__getattr__ = lambda name: type(name, (), {})
+        sys.modules['gradio'] = gradio
+    return shared.opts
+
+
+def load_defaults():
+    """
+    Run the ui_settings callbacks so every gpr_ option has its default value
+    """
+    for fn in sys.modules['modules.script_callbacks'].callbacks.get('on_ui_settings', []):
+        fn()
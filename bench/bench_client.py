@@ -0,0 +1,243 @@
+"""
+End-to-end client benchmark against the local stand-in server (bench/stand_in_server.py).
+
+Usage:
+    python bench/bench_client.py [--ops 200] [--concurrency 8] [--latency-ms 30] [--jitter-ms 10]
+                                 [--tail-rate 0 --tail-ms 1000] [--error-rate 0] [--throttle-rate 0]
+                                 [--mirrors 0] [--fixtures dump.xml ...]
+                                 [--scenarios random_post,search_posts,get_random_tags,before_process]
+                                 [--parser expat] [--tags tag_0] [--tracemalloc]
+
+The server runs in a subprocess so its CPU time is not counted. Scenarios:
+
+    random_post       Gelbooru.random_post on the shared runtime, count cache warm after the first call
+    search_posts      Gelbooru.search_posts(limit=100) at random pages
+    get_random_tags   the Randomize button path (planner, reservoir, tag transform, HEAD check)
+    before_process    the img2img auto-mode path including image download, decode and sizing
+
+For each scenario it reports operations/s, API requests/s seen by the server, latency
+percentiles per operation, CPU time per post and the peak memory (RSS high-water mark, or
+Python allocations with --tracemalloc, which slows everything down).
+
+--mirrors N starts N more servers with the same posts and independent latency draws and spreads
+API requests over all of them with hedging (EndpointPool); hedges sent and won are reported too.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import _webui_shim  # noqa: E402
+
+SCENARIOS = ('random_post', 'search_posts', 'get_random_tags', 'before_process')
+
+
+def _percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))] if samples else float('nan')
+
+
+def _peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+class _Server:
+    def __init__(self, args, rng_seed: int = 0):
+        cmd = [sys.executable, os.path.join(BENCH_DIR, 'stand_in_server.py'), '--port', '0',
+               '--latency-ms', str(args.latency_ms), '--jitter-ms', str(args.jitter_ms),
+               '--tail-rate', str(args.tail_rate), '--tail-ms', str(args.tail_ms),
+               '--error-rate', str(args.error_rate), '--throttle-rate', str(args.throttle_rate),
+               '--posts', str(args.posts), '--rng-seed', str(rng_seed)]
+        if args.fixtures:
+            cmd += ['--fixtures', *args.fixtures]
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+        line = self.process.stdout.readline().strip()
+        if not line.startswith('ready '):
+            self.process.kill()
+            raise RuntimeError(f'stand-in server failed to start: {line!r}')
+        self.api = line.split(' ', 1)[1]
+        self.root = self.api.rsplit('/', 1)[0]
+
+    def _call(self, path, method='GET'):
+        request = urllib.request.Request(self.root + path, method=method, data=b'' if method == 'POST' else None)
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+    def reset(self):
+        self._call('/_reset', 'POST')
+
+    def stats(self) -> dict:
+        return self._call('/_stats')
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait(5)
+
+
+async def _drive(op, ops: int, concurrency: int):
+    """
+    Run `op()` `ops` times with up to `concurrency` in flight.
+    Returns (latencies, posts handled, errors)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, totals = [], {'posts': 0, 'errors': 0}
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                totals['posts'] += await op()
+            except Exception:
+                totals['errors'] += 1
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one() for _ in range(ops)))
+    return latencies, totals['posts'], totals['errors']
+
+
+def _scenarios(args, server, pool, opts):
+    from scripts.Gel import CountCache, Gelbooru, get_runtime
+    import scripts.GelbooruPromptRandomizer as gpr
+    from modules.processing import StableDiffusionProcessingImg2Img
+
+    runtime = get_runtime(pool_size=max(8, args.concurrency))
+    gel = Gelbooru(api=server.api, runtime=runtime, count_cache=CountCache(), parser=args.parser,
+                   max_concurrency=args.concurrency, endpoints=pool)
+    gel._limiter.configure(1000)
+    tags = args.tags.split(',') if args.tags else []
+    gpr._gel_client(None, None)._limiter.configure(1000)  # image/HEAD client, not covered by gpr_rate_limit
+
+    async def random_post():
+        return 1 if await gel.random_post(tags=tags) else 0
+
+    async def search_posts():
+        return len(await gel.search_posts(tags=tags, limit=100, page=random.randrange(50)))
+
+    async def get_random_tags():
+        _, _, url = await gpr.get_random_tags(args.tags, '')
+        return 1 if url else 0
+
+    script = gpr.GPRScript()
+
+    def process():
+        p = StableDiffusionProcessingImg2Img(prompt='masterpiece')
+        script.before_process(p, True, args.tags, '')
+        return 1 if getattr(p, 'init_images', None) else 0
+
+    async def before_process():
+        return await asyncio.get_running_loop().run_in_executor(None, process)
+
+    return {'random_post': random_post, 'search_posts': search_posts,
+            'get_random_tags': get_random_tags, 'before_process': before_process}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--ops', type=int, default=200, help='operations per scenario')
+    ap.add_argument('--concurrency', type=int, default=8)
+    ap.add_argument('--posts', type=int, default=5000, help='synthetic posts on the server')
+    ap.add_argument('--fixtures', nargs='*', default=[], help='recorded dapi XML/JSON pages to serve instead')
+    ap.add_argument('--latency-ms', type=float, default=30.0)
+    ap.add_argument('--jitter-ms', type=float, default=10.0)
+    ap.add_argument('--tail-rate', type=float, default=0.0, help='share of responses delayed by --tail-ms more')
+    ap.add_argument('--tail-ms', type=float, default=1000.0)
+    ap.add_argument('--mirrors', type=int, default=0, help='extra servers to hedge requests over')
+    ap.add_argument('--error-rate', type=float, default=0.0)
+    ap.add_argument('--throttle-rate', type=float, default=0.0)
+    ap.add_argument('--scenarios', default=','.join(SCENARIOS))
+    ap.add_argument('--parser', default='expat', choices=('expat', 'json', 'xmltodict'))
+    ap.add_argument('--tags', default='tag_0', help='include tags, comma separated')
+    ap.add_argument('--tracemalloc', action='store_true', help='report peak Python allocations instead of RSS')
+    args = ap.parse_args()
+
+    opts = _webui_shim.install()
+    import scripts.Gel as gel_module
+    import scripts.GelbooruPromptRandomizer as gpr
+    from scripts.Gel import CountCache, EndpointPool
+    from scripts.GelImageCache import ImageCache
+
+    _webui_shim.load_defaults()
+    server = _Server(args)
+    mirrors = [_Server(args, rng_seed=i + 1) for i in range(args.mirrors)]
+    servers = [server] + mirrors
+    pool = EndpointPool([s.api for s in servers]) if mirrors else None
+    workdir = tempfile.mkdtemp(prefix='gpr-bench-')
+
+    # Point the script at the stand-in and keep its caches away from the real ones in cache/
+    gel_module.API_GELBOORU = server.api
+    gpr._COUNT_CACHE = CountCache()
+    gpr._IMAGE_CACHE = ImageCache(os.path.join(workdir, 'images'), max_bytes=0)
+    opts.gpr_api_key, opts.gpr_user_id = 'bench', 'bench'
+    opts.gpr_response_parser = args.parser
+    opts.gpr_max_concurrency = args.concurrency
+    opts.gpr_rate_limit = 1000
+    opts.gpr_metrics_file = os.path.join(workdir, 'metrics.prom')
+    opts.gpr_image_cache_mb = 0
+    opts.gpr_response_cache_mb = 0
+    opts.gpr_endpoints = '\n'.join(s.api for s in mirrors)
+
+    print(f"server {server.api} (+{len(mirrors)} mirrors)  latency {args.latency_ms:g}+-{args.jitter_ms:g}ms  "
+          f"tail {args.tail_rate:g}x{args.tail_ms:g}ms  errors {args.error_rate:g}  429 {args.throttle_rate:g}  "
+          f"parser {args.parser}  concurrency {args.concurrency}")
+    print(f"{'scenario':<16} {'ops/s':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'cpu ms/post':>12} {'peak MB':>8} {'errors':>7}")
+
+    scenarios = _scenarios(args, server, pool, opts)
+    loop = asyncio.new_event_loop()
+    try:
+        for name in args.scenarios.split(','):
+            op = scenarios[name]
+            with contextlib.redirect_stdout(io.StringIO()):
+                loop.run_until_complete(op())  # warm up connections, counts and the server's query cache
+            for s in servers:
+                s.reset()
+            hedges = [gpr._endpoint_pool(server.api), pool]
+            hedged = [dict(p.stats) for p in hedges if p is not None]
+            if args.tracemalloc:
+                tracemalloc.start()
+            cpu, wall = time.process_time(), time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):  # the script's [GPR] log lines
+                latencies, posts, errors = loop.run_until_complete(_drive(op, args.ops, args.concurrency))
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            if args.tracemalloc:
+                peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+                tracemalloc.stop()
+            else:
+                peak = _peak_rss_mb()
+            requests = sum(s.stats().get('requests', 0) for s in servers)
+            print(f"{name:<16} {args.ops / wall:>8.1f} {requests / wall:>8.1f} "
+                  f"{_percentile(latencies, 0.5) * 1e3:>8.1f} {_percentile(latencies, 0.95) * 1e3:>8.1f} "
+                  f"{_percentile(latencies, 0.99) * 1e3:>8.1f} {cpu / max(1, posts) * 1e3:>12.3f} "
+                  f"{peak:>8.1f} {errors:>7}")
+            if mirrors:
+                after = [p.stats for p in hedges if p is not None]
+                sent = sum(a['hedges'] - b['hedges'] for a, b in zip(after, hedged))
+                won = sum(a['hedge_wins'] - b['hedge_wins'] for a, b in zip(after, hedged))
+                print(f"{'':<16} hedges sent {sent}, won {won}")
+    finally:
+        gel_module.get_runtime().close()
+        loop.close()
+        for s in servers:
+            s.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Throughput benchmark for the dapi response parsers.
+
+Usage:
+    python bench/bench_parser.py [--posts 100] [--pages 200] [--parsers expat,json,xmltodict]
+
+Builds synthetic limit=100 pages in the XML and json=1 layouts and reports pages/s and posts/s
+for parsing alone and for parsing plus GelbooruImage construction.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripts.Gel import Gelbooru, GelbooruImage, parse_response  # noqa: E402
+
+
+def _post(i: int) -> dict:
+    return {
+        'id': 9000000 + i,
+        'created_at': 'Sat Jan 01 00:00:00 -0500 2022',
+        'score': i % 50,
+        'width': 1536 + i % 7,
+        'height': 2048 - i % 5,
+        'md5': f'{i:032x}',
+        'directory': f'{i % 256:02x}/{(i * 7) % 256:02x}',
+        'image': f'{i:032x}.jpg',
+        'rating': 'general',
+        'source': 'https://example.com/source',
+        'change': 1640000000 + i,
+        'owner': 'uploader',
+        'creator_id': 1000 + i,
+        'parent_id': 0,
+        'sample': 1,
+        'preview_height': 250,
+        'preview_width': 187,
+        'tags': ' '.join(f'tag_{(i * 31 + k) % 5000}' for k in range(35)),
+        'title': '',
+        'has_notes': 'false',
+        'has_comments': 'false',
+        'file_url': f'https://img.example.com/images/{i:032x}.jpg',
+        'preview_url': f'https://img.example.com/thumbnails/{i:032x}.jpg',
+        'sample_url': f'https://img.example.com/samples/{i:032x}.jpg',
+        'sample_height': 1133,
+        'sample_width': 850,
+        'status': 'active',
+        'post_locked': 0,
+        'has_children': 'false',
+    }
+
+
+def _xml_page(posts: list, count: int) -> bytes:
+    from xml.sax.saxutils import escape
+    items = ''.join('<post>' + ''.join(f'<{k}>{escape(str(v))}</{k}>' for k, v in p.items()) + '</post>'
+                    for p in posts)
+    return (f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<posts limit="{len(posts)}" offset="0" count="{count}">{items}</posts>').encode()
+
+
+def _json_page(posts: list, count: int) -> bytes:
+    return json.dumps({'@attributes': {'limit': len(posts), 'offset': 0, 'count': count}, 'post': posts}).encode()
+
+
+def _run(parser: str, body: bytes, pages: int, build: bool) -> float:
+    gel = Gelbooru(parser=parser)
+    start = time.perf_counter()
+    for _ in range(pages):
+        stream = parse_response(body, parser)
+        if build:
+            [GelbooruImage(p, gel) for p in stream]
+        else:
+            for _p in stream:
+                pass
+    return time.perf_counter() - start
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--posts', type=int, default=100, help='posts per page')
+    ap.add_argument('--pages', type=int, default=200, help='pages parsed per parser')
+    ap.add_argument('--parsers', default='expat,json,xmltodict')
+    args = ap.parse_args()
+
+    posts = [_post(i) for i in range(args.posts)]
+    bodies = {'xml': _xml_page(posts, 100000), 'json': _json_page(posts, 100000)}
+
+    print(f"{'parser':<10} {'stage':<14} {'pages/s':>10} {'posts/s':>12} {'us/post':>9}")
+    for parser in args.parsers.split(','):
+        body = bodies['json' if parser == 'json' else 'xml']
+        for build in (False, True):
+            elapsed = _run(parser, body, args.pages, build)
+            total = args.pages * args.posts
+            print(f"{parser:<10} {'parse+image' if build else 'parse':<14} "
+                  f"{args.pages / elapsed:>10.1f} {total / elapsed:>12.0f} {elapsed / total * 1e6:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
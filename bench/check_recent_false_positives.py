@@ -0,0 +1,63 @@
+"""
+Check that the recent-post filter keeps forgetting when it is saved and shared between processes.
+
+Usage:
+    python bench/check_recent_false_positives.py [--capacity 1000] [--cycles 20] [--processes 2]
+                                                 [--save-every 50] [--max-rate 0.05]
+
+Several RecentPosts instances share one file, as WebUI instances and the sidecar do. They take turns
+adding fresh post ids and saving every --save-every additions, for --cycles times the capacity in
+total, so every instance rotates many times. After each capacity worth of additions the false
+positive rate is measured on ids that were never added, and the ids added more than three
+capacities ago must have been forgotten. Exits non-zero if the worst rate exceeds --max-rate or
+old ids are still reported as seen.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripts.GelRecent import RecentPosts  # noqa: E402
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--capacity', type=int, default=1000)
+    ap.add_argument('--cycles', type=int, default=20)
+    ap.add_argument('--processes', type=int, default=2)
+    ap.add_argument('--save-every', type=int, default=50)
+    ap.add_argument('--max-rate', type=float, default=0.05)
+    args = ap.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'recent_posts.bloom')
+    filters = [RecentPosts(path, capacity=args.capacity, save_interval=float('inf'))
+               for _ in range(args.processes)]
+    probes = range(10 ** 9, 10 ** 9 + 10000)
+    worst_rate, worst_old = 0.0, 0.0
+    next_id = 0
+    for cycle in range(args.cycles):
+        for _ in range(args.capacity // args.save_every):
+            for f in filters:
+                for _ in range(args.save_every // args.processes or 1):
+                    f.add('q', next_id)
+                    next_id += 1
+                f.save()
+        for f in filters:
+            rate = sum(f.seen('q', i) for i in probes) / len(probes)
+            worst_rate = max(worst_rate, rate)
+            if cycle >= 3:
+                old = range(0, next_id - 3 * args.capacity)[-args.capacity:]
+                worst_old = max(worst_old, sum(f.seen('q', i) for i in old) / len(old))
+        print(f'cycle {cycle + 1:3d}: false positive rate {rate:.4f}')
+
+    print(f'worst false positive rate {worst_rate:.4f} (max {args.max_rate}), '
+          f'old ids still seen {worst_old:.4f}')
+    ok = worst_rate <= args.max_rate and worst_old <= args.max_rate
+    print('PASS' if ok else 'FAIL')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
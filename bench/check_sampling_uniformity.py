@@ -0,0 +1,127 @@
+"""
+Statistical check that Gelbooru.random_post samples uniformly over the whole result set.
+
+Usage:
+    python bench/check_sampling_uniformity.py [--posts 5000] [--max-offset 300] [--samples 20000] [--buckets 50]
+                                              [--alpha 0.001] [--max-requests 1.5]
+
+Runs random_post against an in-process stand-in for the dapi with sparse, unevenly spaced post ids
+and a shrunken MAX_OFFSET, so the deep (id:<N) path is exercised without touching the network.
+Draws are bucketed by ascending rank and compared to the uniform expectation with a chi-square test;
+the old capped-offset sampler is run alongside for contrast. The client has a count cache, as in the
+extension. Exits non-zero if the deep sampler's p-value is below --alpha or it spends more than
+--max-requests requests per sample on average.
+"""
+import argparse
+import asyncio
+import math
+import os
+import random
+import sys
+from bisect import bisect_left
+from urllib.parse import parse_qsl, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripts.Gel import CountCache, Gelbooru  # noqa: E402
+
+
+class _FakeGelbooru(Gelbooru):
+    """
+    Answers post queries from an in-memory id list, honoring limit, pid and an optional id:<N tag
+    """
+
+    def __init__(self, ids, max_offset):
+        super().__init__(api_key='bench', user_id='bench', count_cache=CountCache())
+        self.MAX_OFFSET = max_offset
+        self.ids = ids  # ascending
+        self.requests = 0
+
+    async def _request(self, url: str, cached: bool = True, **kwargs) -> bytes:
+        self.requests += 1
+        args = dict(parse_qsl(urlparse(url).query))
+        limit, pid = int(args.get('limit', 100)), int(args.get('pid', 0))
+        end = len(self.ids)
+        for tag in args.get('tags', '').split():
+            if tag.startswith('id:<'):
+                end = bisect_left(self.ids, int(tag[4:]))
+
+        # Newest first, like the real API; offsets past MAX_OFFSET come back empty
+        start = pid * limit if limit > 1 else pid
+        if start > self.MAX_OFFSET:
+            page = []
+        else:
+            page = self.ids[:end][::-1][start:start + limit]
+        posts = ''.join(f'<post><id>{i}</id><tags>a</tags></post>' for i in page)
+        return f'<?xml version="1.0" encoding="UTF-8"?><posts count="{end}" offset="{start}">{posts}</posts>'.encode()
+
+
+def _capped_random_post(client, count):
+    offset = random.randint(0, min(count - 1, client.MAX_OFFSET))
+    return client.search_posts(tags=['a'], limit=1, page=offset)
+
+
+def _chi_square(counts):
+    """
+    Chi-square statistic against a uniform expectation and its upper tail p-value
+    (Wilson-Hilferty normal approximation, fine for the bucket counts used here)
+    """
+    k = len(counts) - 1
+    expected = sum(counts) / len(counts)
+    stat = sum((c - expected) ** 2 / expected for c in counts)
+    z = ((stat / k) ** (1 / 3) - (1 - 2 / (9 * k))) / math.sqrt(2 / (9 * k))
+    return stat, 0.5 * math.erfc(z / math.sqrt(2))
+
+
+async def _run(client, draw, samples, buckets):
+    rank = {post_id: i for i, post_id in enumerate(client.ids)}
+    counts = [0] * buckets
+    client.requests = 0
+    for _ in range(samples):
+        post = await draw()
+        counts[rank[post.id] * buckets // len(client.ids)] += 1
+    return counts, client.requests / samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=5000)
+    parser.add_argument('--max-offset', type=int, default=300)
+    parser.add_argument('--samples', type=int, default=20000)
+    parser.add_argument('--buckets', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--alpha', type=float, default=0.001, help='fail below this chi-square p-value')
+    parser.add_argument('--max-requests', type=float, default=1.5, help='fail above this many requests per sample')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    # Sparse ids with bursts and gaps, so interpolation on id alone would be biased
+    ids, current = [], 1000
+    for _ in range(args.posts):
+        current += random.choice((1, 1, 2, 3, 50, 400))
+        ids.append(current)
+
+    client = _FakeGelbooru(ids, args.max_offset)
+    loop = asyncio.new_event_loop()
+
+    runs = [
+        ('deep', lambda: client.random_post(tags=['a'])),
+        ('capped', lambda: _capped_random_post(client, len(ids))),
+    ]
+    failed = False
+    for name, draw in runs:
+        counts, per_sample = loop.run_until_complete(_run(client, draw, args.samples, args.buckets))
+        stat, p = _chi_square(counts)
+        covered = sum(1 for c in counts if c)
+        print(f'{name:>7}: chi2={stat:10.1f}  p={p:.4f}  buckets hit={covered}/{args.buckets}  '
+              f'requests/sample={per_sample:.2f}')
+        if name == 'deep' and (p < args.alpha or per_sample > args.max_requests):
+            failed = True
+
+    loop.close()
+    print('FAIL' if failed else 'PASS')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""
+Local stand-in for the Gelbooru dapi and image CDN, for benchmarks.
+
+Usage:
+    python bench/stand_in_server.py [--port 8765] [--posts 5000] [--fixtures dump.xml ...]
+                                    [--latency-ms 30] [--jitter-ms 10] [--tail-rate 0.05 --tail-ms 1000]
+                                    [--error-rate 0.01] [--throttle-rate 0.01]
+
+Serves index.php?page=dapi&s=post&q=index in the XML and json=1 layouts, with tags, -tags, id:N,
+id:<N, {a ~ b} OR groups, limit, pid and count honored like the real API (offsets past 20000 come
+back empty), s=tag&names=... with a category derived from each tag name, and JPEG images for every
+post's file/sample/preview URL. Posts are synthetic unless recorded dapi pages (XML or JSON, as
+saved from the API) are given with --fixtures; their URLs are rewritten to point here.
+
+Every response waits latency +- jitter first, a share of them (tail rate) tail-ms more on top.
+A share of API requests fails with 503 (error rate) or 429 with Retry-After: 1 (throttle rate).
+GET /_stats returns request counters as JSON and POST /_reset clears them. Prints "ready <url>"
+on stdout once listening.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import sys
+import zlib
+from collections import Counter, OrderedDict
+from typing import *
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripts.Gel import parse_response  # noqa: E402
+
+MAX_OFFSET = 20000
+# Tag types handed out by s=tag, mostly general like on the real site
+_TAG_TYPES = (0, 0, 0, 0, 0, 1, 3, 4, 4, 5)
+
+
+def synthetic_posts(n: int, vocab: int = 5000, tags_per_post: int = 35, seed: int = 0) -> List[dict]:
+    """
+    `n` posts with sparse ids and Zipf-ish tag frequencies (tag_0 is on most posts)
+    """
+    rng = random.Random(seed)
+    posts, post_id = [], 1000
+    for i in range(n):
+        post_id += rng.choice((1, 1, 2, 3, 17, 250))
+        tags = {f'tag_{(int(rng.paretovariate(0.8)) - 1) % vocab}' for _ in range(tags_per_post)}
+        md5 = f'{rng.getrandbits(128):032x}'
+        posts.append({
+            'id': post_id,
+            'created_at': 'Sat Jan 01 00:00:00 -0500 2022',
+            'score': rng.randrange(100),
+            'width': 1536,
+            'height': 2048,
+            'md5': md5,
+            'directory': f'{md5[:2]}/{md5[2:4]}',
+            'image': f'{md5}.jpg',
+            'rating': rng.choice(('general', 'sensitive', 'questionable')),
+            'source': '',
+            'change': 1640000000 + i,
+            'owner': 'uploader',
+            'creator_id': 1000 + i % 97,
+            'parent_id': 0,
+            'sample': 1,
+            'preview_height': 250,
+            'preview_width': 187,
+            'tags': ' '.join(sorted(tags)),
+            'title': '',
+            'has_notes': 'false',
+            'has_comments': 'false',
+            'file_url': f'/images/{md5}.jpg',
+            'preview_url': f'/thumbnails/{md5}.jpg',
+            'sample_url': f'/samples/{md5}.jpg',
+            'sample_height': 1133,
+            'sample_width': 850,
+            'status': 'active',
+            'post_locked': 0,
+            'has_children': 'false',
+        })
+    return posts
+
+
+def load_fixtures(paths: List[str]) -> List[dict]:
+    """
+    Posts of recorded dapi pages, with file/sample/preview URLs made relative to this server
+    """
+    posts = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        parser = 'json' if data.lstrip()[:1] in (b'{', b'[') else 'expat'
+        for post in parse_response(data, parser):
+            md5 = post.get('md5') or f"{int(post['id']):032x}"
+            post = dict(post)
+            for field, folder in (('file_url', 'images'), ('sample_url', 'samples'), ('preview_url', 'thumbnails')):
+                if post.get(field):
+                    post[field] = f'/{folder}/{md5}.jpg'
+            posts[int(post['id'])] = post
+    return [posts[key] for key in sorted(posts)]
+
+
+def _jpeg(width: int, height: int) -> bytes:
+    from PIL import Image
+    noise = Image.effect_noise((width // 8, height // 8), 64).convert('RGB')
+    image = noise.resize((width, height), Image.BILINEAR)
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+class StandInGelbooru:
+    def __init__(self, posts: List[dict], latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, seed: int = 0,
+                 tail_rate: float = 0.0, tail: float = 0.0):
+        self.posts = sorted(posts, key=lambda p: int(p['id']), reverse=True)  # newest first, like the API
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.tail_rate = tail_rate
+        self.tail = tail
+        self.stats = Counter()
+        self.base_url = ''
+        self._rng = random.Random(seed)
+        self._tags = [frozenset(str(p.get('tags', '')).split()) for p in self.posts]
+        self._queries = OrderedDict()  # type: OrderedDict[str, List[int]]
+        self._images = {}  # type: Dict[str, bytes]
+        self._tag_counts = Counter(tag for tags in self._tags for tag in tags)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/index.php', self.dapi)
+        app.router.add_get('/{folder:images|samples|thumbnails}/{name}', self.image)
+        app.router.add_get('/_stats', self.get_stats)
+        app.router.add_post('/_reset', self.reset)
+        return app
+
+    async def _delay(self):
+        delay = self.latency + self._rng.uniform(-self.jitter, self.jitter)
+        if self._rng.random() < self.tail_rate:
+            self.stats['slow'] += 1
+            delay += self.tail
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _match(self, query: str) -> List[int]:
+        """
+        Indices into self.posts matching a tag query, cached per query string
+        """
+        result = self._queries.get(query)
+        if result is not None:
+            self._queries.move_to_end(query)
+            return result
+
+        include, exclude, groups, below = set(), set(), [], None
+        group = None
+        for tag in query.split():
+            if tag.startswith('{'):
+                group, tag = [], tag[1:]
+            if group is not None:
+                closed = tag.endswith('}')
+                tag = tag.rstrip('}')
+                if tag and tag != '~':
+                    group.append(tag)
+                if closed:
+                    groups.append(group)
+                    group = None
+            elif tag.startswith('id:<'):
+                below = int(tag[4:])
+            elif tag.startswith('-'):
+                exclude.add(tag[1:])
+            elif tag.startswith('id:'):
+                groups.append([tag])
+            elif not tag.startswith(('sort:', 'order:', 'rating:')):
+                include.add(tag)
+
+        def matches(i: int, tags: frozenset) -> bool:
+            post_id = int(self.posts[i]['id'])
+            if not include <= tags or exclude & tags or (below is not None and post_id >= below):
+                return False
+            # OR groups ({a ~ b}), id:N alternatives match the post id exactly
+            return all(any(post_id == int(alt[3:]) if alt.startswith('id:') else alt in tags for alt in alts)
+                       for alts in groups)
+
+        result = [i for i, tags in enumerate(self._tags) if matches(i, tags)]
+        self._queries[query] = result
+        if len(self._queries) > 4096:
+            self._queries.popitem(last=False)
+        return result
+
+    def _render(self, post: dict) -> dict:
+        post = dict(post)
+        for field in ('file_url', 'sample_url', 'preview_url'):
+            if str(post.get(field, '')).startswith('/'):
+                post[field] = self.base_url + post[field]
+        return post
+
+    async def dapi(self, request: web.Request) -> web.Response:
+        self.stats['requests'] += 1
+        await self._delay()
+        roll = self._rng.random()
+        if roll < self.throttle_rate:
+            self.stats['429'] += 1
+            return web.Response(status=429, headers={'Retry-After': '1'})
+        if roll < self.throttle_rate + self.error_rate:
+            self.stats['503'] += 1
+            return web.Response(status=503)
+
+        args = request.query
+        if args.get('s') == 'tag':
+            return self._tag_index(args)
+        limit = min(100, max(0, int(args.get('limit', 100))))
+        pid = max(0, int(args.get('pid', 0)))
+        matched = self._match(args.get('tags', ''))
+        if 'id' in args:
+            matched = [i for i in range(len(self.posts)) if str(self.posts[i]['id']) == args['id']]
+
+        offset = pid * limit
+        page = [] if offset > MAX_OFFSET else [self._render(self.posts[i]) for i in matched[offset:offset + limit]]
+        self.stats['200'] += 1
+        self.stats['posts'] += len(page)
+
+        if args.get('json') == '1':
+            body = json.dumps({'@attributes': {'limit': limit, 'offset': offset, 'count': len(matched)},
+                               'post': page}).encode()
+            return web.Response(body=body, content_type='application/json')
+        items = ''.join('<post>' + ''.join(f'<{k}>{escape(str(v))}</{k}>' for k, v in p.items()) + '</post>'
+                        for p in page)
+        body = (f'<?xml version="1.0" encoding="UTF-8"?>'
+                f'<posts limit="{limit}" offset="{offset}" count="{len(matched)}">{items}</posts>').encode()
+        return web.Response(body=body, content_type='text/xml')
+
+    def _tag_index(self, args) -> web.Response:
+        names = [name for name in args.get('names', '').split() if name in self._tag_counts]
+        names = names[:min(100, max(0, int(args.get('limit', 100))))]
+        tags = [{'id': zlib.crc32(name.encode()), 'name': name, 'count': self._tag_counts[name],
+                 'type': _TAG_TYPES[zlib.crc32(name.encode()) % len(_TAG_TYPES)], 'ambiguous': 0} for name in names]
+        self.stats['200'] += 1
+        self.stats['tags'] += len(tags)
+
+        if args.get('json') == '1':
+            body = json.dumps({'@attributes': {'limit': len(tags), 'offset': 0, 'count': len(tags)}, 'tag': tags})
+            return web.Response(body=body.encode(), content_type='application/json')
+        items = ''.join('<tag>' + ''.join(f'<{k}>{escape(str(v))}</{k}>' for k, v in t.items()) + '</tag>'
+                        for t in tags)
+        body = (f'<?xml version="1.0" encoding="UTF-8"?>'
+                f'<tags type="array" limit="{len(tags)}" offset="0" count="{len(tags)}">{items}</tags>').encode()
+        return web.Response(body=body, content_type='text/xml')
+
+    async def image(self, request: web.Request) -> web.Response:
+        folder = request.match_info['folder']
+        self.stats[f'{folder}_requests'] += 1
+        await self._delay()
+        if folder not in self._images:
+            size = {'images': (1536, 2048), 'samples': (850, 1133), 'thumbnails': (187, 250)}[folder]
+            self._images[folder] = _jpeg(*size)
+        body = self._images[folder]
+        self.stats['image_bytes'] += len(body)
+        return web.Response(body=body, content_type='image/jpeg')
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.stats))
+
+    async def reset(self, request: web.Request) -> web.Response:
+        self.stats.clear()
+        return web.json_response({})
+
+
+async def serve(server: StandInGelbooru, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(server.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    server.base_url = f'http://{host}:{port}'
+    return runner
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8765, help='0 picks a free port')
+    ap.add_argument('--posts', type=int, default=5000, help='synthetic posts, ignored with --fixtures')
+    ap.add_argument('--fixtures', nargs='*', default=[], help='recorded dapi XML/JSON pages')
+    ap.add_argument('--latency-ms', type=float, default=0.0)
+    ap.add_argument('--jitter-ms', type=float, default=0.0)
+    ap.add_argument('--tail-rate', type=float, default=0.0, help='share of responses delayed by --tail-ms more')
+    ap.add_argument('--tail-ms', type=float, default=0.0)
+    ap.add_argument('--error-rate', type=float, default=0.0, help='share of API requests answered with 503')
+    ap.add_argument('--throttle-rate', type=float, default=0.0, help='share of API requests answered with 429')
+    ap.add_argument('--seed', type=int, default=0, help='synthetic posts')
+    ap.add_argument('--rng-seed', type=int, help='latency and failure draws, defaults to --seed. Mirrors serve '
+                                                 'the same posts with the same --seed and differ in --rng-seed')
+    args = ap.parse_args()
+
+    posts = load_fixtures(args.fixtures) if args.fixtures else synthetic_posts(args.posts, seed=args.seed)
+    server = StandInGelbooru(posts, latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                             error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                             seed=args.seed if args.rng_seed is None else args.rng_seed,
+                             tail_rate=args.tail_rate, tail=args.tail_ms / 1000)
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(serve(server, args.host, args.port))
+    print(f'ready {server.base_url}/index.php', flush=True)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
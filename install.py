@@ -1,7 +1,28 @@
-import launch
+import os
+import sys
 
-if not launch.is_installed("xmltodict"):
-    launch.run_pip("install xmltodict", "requests-xmltodict")
-    
-if not launch.is_installed("furl"):
-    launch.run_pip("install furl", "requests-furl")
+# launch.is_installed を毎回の起動で呼ばないよう、確認済みの内容を cache/.installed に記録しておく
+# （リストか Python 環境が変わったときだけもう一度確認する）
+REQUIREMENTS = ("xmltodict",)
+STAMP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", ".installed")
+stamp = "\n".join((sys.executable,) + REQUIREMENTS)
+
+
+def _read_stamp():
+    try:
+        with open(STAMP, "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+if _read_stamp() != stamp:
+    import launch
+
+    for package in REQUIREMENTS:
+        if not launch.is_installed(package):
+            launch.run_pip(f"install {package}", f"requests-{package}")
+
+    os.makedirs(os.path.dirname(STAMP), exist_ok=True)
+    with open(STAMP, "w", encoding="utf-8") as f:
+        f.write(stamp)
@@ -1,16 +1,33 @@
 #The code is based on PyGelbooru https://pypi.org/project/pygelbooru/
+import abc
 import asyncio
+import atexit
+import concurrent.futures
+import contextlib
+import functools
+import itertools
+import json
 import os
 import reprlib
-import xml
-from datetime import datetime
-from random import randint
+import sys
+import threading
+import time
+import xml.parsers.expat
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from random import randint, randrange, shuffle, uniform
 from typing import *
-from urllib.parse import urlparse
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+from xml.etree.ElementTree import ParseError, XMLPullParser
 
-import aiohttp
-import xmltodict
-from furl import furl
+# aiohttp and xmltodict are imported on first use, loading them is most of the extension's share of WebUI startup.
+# WebUI imports every module in scripts/ at startup, so none of them may import these at module level either.
+if TYPE_CHECKING:
+    import aiohttp
+
+
+_UNSET = object()
 
 
 class GelbooruException(Exception):
@@ -25,35 +42,133 @@ class GelbooruImage:
     """
     Container for Gelbooru image results.
     Returns the image URL when cast to str
+
+    Only id, file_url and tags are decoded up front. Every other field is kept as the raw
+    API value and decoded on first access, tags are stored as a tuple of interned strings.
     """
 
-    def __init__(self, payload: dict, gelbooru):
-        self._gelbooru = gelbooru  # type: Gelbooru
+    __slots__ = ('_gelbooru', 'id', 'file_url', '_tags', '_raw', '_created_at', '_change')
 
-        # Cross compatability with older Booru API's
-        payload = {k.strip('@'): v for k, v in payload.items()}
+    # Raw payload fields kept for lazy decoding, in storage order
+    _FIELDS = ('creator_id', 'created_at', 'source', 'md5', 'height', 'width', 'rating',
+               'has_sample', 'has_comments', 'has_notes', 'has_children', 'change',
+               'directory', 'status', 'post_locked', 'score',
+               'sample_url', 'sample_width', 'sample_height',
+               'preview_url', 'preview_width', 'preview_height')
+    _INDEX = {name: i for i, name in enumerate(_FIELDS)}
+
+    def __init__(self, payload: dict, gelbooru):
+        self._gelbooru = gelbooru                                                       # type: Gelbooru
 
         self.id             = int(payload.get('id', 0) or 0)                            # type: int
-        self.creator_id     = int(payload.get('creator_id', 0) or 0) or None            # type: Optional[int]
-        self.created_at     = _datetime(payload.get('created_at'))                      # type: Optional[datetime]
         self.file_url       = payload.get('file_url')                                   # type: str
-        self.filename       = os.path.basename(urlparse(self.file_url).path)            # type: str
-        self.source         = payload.get('source') or None                             # type: Optional[str]
-        self.hash           = payload.get('md5')                                        # type: str
-        self.height         = int(payload.get('height'))                                # type: int
-        self.width          = int(payload.get('width'))                                 # type: int
-        self.rating         = payload.get('rating')                                     # type: str
-        self.has_sample     = payload.get('has_sample', 'false').lower() == 'true'      # type: bool
-        self.has_comments   = payload.get('has_comments', 'false').lower() == 'true'    # type: bool
-        self.has_notes      = payload.get('has_notes', 'false').lower() == 'true'       # type: bool
-        self.has_children   = payload.get('has_children', 'false').lower() == 'true'    # type: bool
-        self.tags           = str(payload.get('tags')).split(' ')                       # type: List[str]
-        self.change         = datetime.fromtimestamp(int(payload.get('change', 0)))     # type: datetime
-        self.directory      = payload.get('directory')                                  # type: str
-        self.status         = payload.get('status')                                     # type: str
-        self.locked         = bool(int(payload.get('post_locked', 0) or 0))             # type: bool
-        self.score          = int(payload.get('score', 0) or 0)                         # type: int
-        self._payload       = payload                                                   # type: dict
+        self._tags          = tuple(map(sys.intern, (payload.get('tags') or '').split()))  # type: Tuple[str, ...]
+        self._raw           = tuple(map(payload.get, self._FIELDS))                     # type: tuple
+        self._created_at    = _UNSET                                                    # type: Optional[datetime]
+        self._change        = _UNSET                                                    # type: datetime
+
+    def _field(self, name: str):
+        return self._raw[self._INDEX[name]]
+
+    @property
+    def tags(self) -> List[str]:
+        return list(self._tags)
+
+    @property
+    def filename(self) -> str:
+        return os.path.basename(urlparse(self.file_url or '').path)
+
+    @property
+    def creator_id(self) -> Optional[int]:
+        return int(self._field('creator_id') or 0) or None
+
+    @property
+    def created_at(self) -> Optional[datetime]:
+        if self._created_at is _UNSET:
+            self._created_at = _datetime(self._field('created_at'))
+        return self._created_at
+
+    @property
+    def source(self) -> Optional[str]:
+        return self._field('source') or None
+
+    @property
+    def hash(self) -> str:
+        return self._field('md5')
+
+    @property
+    def height(self) -> int:
+        return int(self._field('height') or 0)
+
+    @property
+    def width(self) -> int:
+        return int(self._field('width') or 0)
+
+    @property
+    def rating(self) -> str:
+        return self._field('rating')
+
+    @property
+    def has_sample(self) -> bool:
+        return _flag(self._field('has_sample'))
+
+    @property
+    def has_comments(self) -> bool:
+        return _flag(self._field('has_comments'))
+
+    @property
+    def has_notes(self) -> bool:
+        return _flag(self._field('has_notes'))
+
+    @property
+    def has_children(self) -> bool:
+        return _flag(self._field('has_children'))
+
+    @property
+    def change(self) -> datetime:
+        if self._change is _UNSET:
+            self._change = datetime.fromtimestamp(int(self._field('change') or 0))
+        return self._change
+
+    @property
+    def directory(self) -> str:
+        return self._field('directory')
+
+    @property
+    def status(self) -> str:
+        return self._field('status')
+
+    @property
+    def locked(self) -> bool:
+        return bool(int(self._field('post_locked') or 0))
+
+    @property
+    def score(self) -> int:
+        return int(self._field('score') or 0)
+
+    @property
+    def sample_url(self) -> Optional[str]:
+        return self._field('sample_url') or None
+
+    @property
+    def sample_width(self) -> int:
+        return int(self._field('sample_width') or 0)
+
+    @property
+    def sample_height(self) -> int:
+        return int(self._field('sample_height') or 0)
+
+    @property
+    def preview_url(self) -> Optional[str]:
+        return self._field('preview_url') or None
+
+    @property
+    def preview_width(self) -> int:
+        return int(self._field('preview_width') or 0)
+
+    @property
+    def preview_height(self) -> int:
+        return int(self._field('preview_height') or 0)
 
     def __str__(self):
         return f"https://gelbooru.com/index.php?page=post&s=view&id={self.id}"
@@ -68,9 +183,762 @@ class GelbooruImage:
     def get_tags(self):
         return self.tags
 
+    def to_payload(self) -> dict:
+        """
+        The post as an API payload dict, GelbooruImage(post.to_payload(), gelbooru) rebuilds it.
+        Used to hand posts to other processes (GelSidecar)
+        """
+        payload = {name: value for name, value in zip(self._FIELDS, self._raw) if value is not None}
+        payload.update(id=self.id, file_url=self.file_url, tags=' '.join(self._tags))
+        return payload
+
 
 API_GELBOORU = 'https://gelbooru.com/'
 
+
+class GelbooruRuntime:
+    """
+    Process-wide background event loop with a pooled keep-alive HTTP session.
+    Gelbooru clients bound to a runtime reuse its TCP/TLS connections and DNS cache
+    instead of opening a new aiohttp.ClientSession for every request.
+    """
+
+    def __init__(self, pool_size: int = 8, dns_cache_ttl: int = 300, keepalive_timeout: float = 30.0):
+        """
+        Args:
+            pool_size (int): Maximum number of simultaneous connections in the pool
+            dns_cache_ttl (int): Seconds to keep resolved host addresses, 0 disables the DNS cache
+            keepalive_timeout (float): Seconds an idle connection is kept open
+        """
+        self.pool_size = pool_size
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._loop = None       # type: Optional[asyncio.AbstractEventLoop]
+        self._thread = None     # type: Optional[threading.Thread]
+        self._session = None    # type: Optional[aiohttp.ClientSession]
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self.start()
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        """
+        Start the background loop thread if it is not running yet
+        Returns:
+            asyncio.AbstractEventLoop: The runtime loop
+        """
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+                thread = threading.Thread(target=self._run, args=(loop, ready), name='gelbooru-runtime', daemon=True)
+                thread.start()
+                ready.wait()
+                self._loop, self._thread = loop, thread
+            return self._loop
+
+    @staticmethod
+    def _run(loop: asyncio.AbstractEventLoop, ready: threading.Event):
+        asyncio.set_event_loop(loop)
+        loop.call_soon(ready.set)
+        loop.run_forever()
+
+    def configure(self, *, pool_size: Optional[int] = None,
+                  dns_cache_ttl: Optional[int] = None,
+                  keepalive_timeout: Optional[float] = None):
+        """
+        Update the connection pool settings. The current pool is dropped and rebuilt on the next request
+        when any value actually changes.
+        """
+        changed = False
+        for name, value in (('pool_size', pool_size), ('dns_cache_ttl', dns_cache_ttl),
+                            ('keepalive_timeout', keepalive_timeout)):
+            if value is not None and value != getattr(self, name):
+                setattr(self, name, value)
+                changed = True
+
+        if changed and self._session is not None:
+            session, self._session = self._session, None
+            if self._loop is not None and self._loop.is_running():
+                asyncio.run_coroutine_threadsafe(session.close(), self._loop)
+
+    async def session(self) -> 'aiohttp.ClientSession':
+        """
+        Return the pooled session, creating it on first use. Must be awaited on the runtime loop.
+        """
+        if self._session is None or self._session.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self.pool_size,
+                                             use_dns_cache=bool(self.dns_cache_ttl),
+                                             ttl_dns_cache=self.dns_cache_ttl or None,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def in_loop(self) -> bool:
+        """
+        Returns:
+            bool: True if the caller is running on the runtime loop
+        """
+        try:
+            return self._loop is not None and asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def spawn(self, coro) -> concurrent.futures.Future:
+        """
+        Schedule a coroutine on the runtime loop without waiting for it
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.start())
+
+    def submit(self, coro, timeout: Optional[float] = None):
+        """
+        Run a coroutine on the runtime loop and block until it finishes. Intended for sync callers.
+        Args:
+            coro: The coroutine to run
+            timeout (float): Seconds to wait before cancelling the coroutine
+        """
+        if self.in_loop():
+            coro.close()
+            raise RuntimeError("GelbooruRuntime.submit() cannot be called from the runtime loop, await call() instead")
+
+        future = self.spawn(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    async def call(self, coro):
+        """
+        Await a coroutine on the runtime loop from any event loop
+        """
+        if self.in_loop():
+            return await coro
+        return await asyncio.wrap_future(self.spawn(coro))
+
+    def close(self):
+        """
+        Close the pooled session and stop the loop thread
+        """
+        with self._lock:
+            loop, thread, session = self._loop, self._thread, self._session
+            self._loop = self._thread = self._session = None
+
+        if loop is None or loop.is_closed():
+            return
+        if session is not None and loop.is_running():
+            try:
+                asyncio.run_coroutine_threadsafe(session.close(), loop).result(5)
+            except Exception:
+                pass
+        loop.call_soon_threadsafe(loop.stop)
+        if thread is not None:
+            thread.join(5)
+        if not loop.is_running():
+            loop.close()
+
+
+_RUNTIME = None  # type: Optional[GelbooruRuntime]
+_RUNTIME_LOCK = threading.Lock()
+
+
+def get_runtime(**config) -> GelbooruRuntime:
+    """
+    Return the shared process-wide runtime, creating it on first use
+    Args:
+        **config: GelbooruRuntime settings, applied to the existing runtime if it already exists
+    """
+    global _RUNTIME
+    with _RUNTIME_LOCK:
+        if _RUNTIME is None:
+            _RUNTIME = GelbooruRuntime(**config)
+            atexit.register(_RUNTIME.close)
+        elif config:
+            _RUNTIME.configure(**config)
+        return _RUNTIME
+
+
+class CountCache:
+    """
+    LRU cache of post counts keyed by normalized query, optionally persisted to a JSON file.
+    Entries older than the TTL are still served but flagged as stale so the caller can refresh them.
+    Several processes may share the file: a save keeps the newer entries other processes wrote meanwhile.
+    """
+
+    def __init__(self, ttl: float = 600, max_entries: int = 512,
+                 path: Optional[str] = None,
+                 max_stale: float = 86400,
+                 save_interval: float = 30):
+        """
+        Args:
+            ttl (float): Seconds a count is considered fresh
+            max_entries (int): Maximum number of queries to remember
+            path (str): JSON file to load from and save to, in-memory only if omitted
+            max_stale (float): Seconds past the TTL after which an entry is dropped instead of served
+            save_interval (float): Minimum seconds between two writes of the JSON file
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_stale = max_stale
+        self.save_interval = save_interval
+        self._path = path
+        self._entries = OrderedDict()  # type: OrderedDict[str, Tuple[int, float]]
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = 0.0
+        if path:
+            self.load()
+            atexit.register(self.save, True)
+
+    @staticmethod
+    def key(tags: List[str]) -> str:
+        """
+        Normalize the output of Gelbooru._format_tags into a cache key
+        """
+        return ' '.join(sorted({tag for tag in tags if tag}))
+
+    def get(self, key: str) -> Optional[Tuple[int, bool]]:
+        """
+        Returns:
+            (int, bool) or None: The cached count and whether it is stale, None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            count, stored_at = entry
+            age = time.time() - stored_at
+            if age > self.ttl + self.max_stale:
+                del self._entries[key]
+                self._dirty = True
+                return None
+            self._entries.move_to_end(key)
+            return count, age > self.ttl
+
+    def set(self, key: str, count: int, save: bool = True):
+        """
+        Args:
+            save (bool): Write the file right away if it is due, pass False on an event loop and call save() elsewhere
+        """
+        with self._lock:
+            self._entries[key] = (int(count), time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+        if save:
+            self.save()
+
+    def discard(self, key: str):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._dirty = True
+
+    def load(self):
+        data = self._read()
+        with self._lock:
+            for key, (count, stored_at) in sorted(data.items(), key=lambda item: item[1][1]):
+                self._entries[key] = (int(count), float(stored_at))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def save(self, force: bool = False):
+        """
+        Write the cache to disk if it changed, at most once per save_interval unless forced
+        """
+        if not self._path:
+            return
+        with self._lock:
+            if not self._dirty or (not force and time.time() - self._saved_at < self.save_interval):
+                return
+            data = {k: [c, t] for k, (c, t) in self._entries.items()}
+            self._dirty = False
+            self._saved_at = time.time()
+
+        for key, (count, stored_at) in self._read().items():
+            if key not in data or data[key][1] < stored_at:
+                data[key] = [count, stored_at]
+        if len(data) > self.max_entries:
+            data = dict(sorted(data.items(), key=lambda item: item[1][1])[-self.max_entries:])
+
+        tmp = f'{self._path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp, self._path)
+        except OSError:
+            self._dirty = True
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+
+    def _read(self) -> Dict[str, list]:
+        if not self._path or not os.path.exists(self._path):
+            return {}
+        try:
+            with open(self._path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+
+class RateLimiter:
+    """
+    Adaptive token bucket. Requests are spaced to the current rate, which starts at the configured
+    maximum, is halved whenever the server answers 429 and climbs back additively on every success.
+    A Retry-After hint blocks the bucket until it has passed.
+    """
+
+    def __init__(self, rate: float = 8.0, burst: Optional[int] = None, min_rate: float = 0.25,
+                 recovery: float = 0.05):
+        """
+        Args:
+            rate (float): Maximum requests per second
+            burst (int): Requests allowed back to back after an idle period, defaults to the rate
+            min_rate (float): Floor the rate backs off to
+            recovery (float): Requests per second regained per successful request
+        """
+        self.max_rate = max(min_rate, float(rate))
+        self.rate = self.max_rate
+        self.burst = max(1, int(burst if burst is not None else rate))
+        self._fixed_burst = burst is not None
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self._tokens = float(self.burst)
+        self._stamp = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, rate: float):
+        """
+        Change the maximum rate. A limiter that is not backing off moves to the new rate right away
+        """
+        with self._lock:
+            backing_off = self.rate < self.max_rate
+            self.max_rate = max(self.min_rate, float(rate))
+            self.rate = min(self.rate, self.max_rate) if backing_off else self.max_rate
+            if not self._fixed_burst:
+                self.burst = max(1, int(rate))
+
+    def reserve(self) -> float:
+        """
+        Take a token, going into debt if none is left
+        Returns:
+            float: Seconds to wait before sending the request
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1
+            return max(-self._tokens / self.rate, self._blocked_until - now, 0.0)
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def throttled(self, retry_after: Optional[float] = None):
+        """
+        Record a 429 response
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.recovery)
+
+
+class CircuitBreaker:
+    """
+    Fails requests fast after `threshold` consecutive transient failures, instead of queueing them
+    against a server that is down or banning us. After the cooldown a single trial request is let
+    through; its failure reopens the circuit for twice as long.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30, max_cooldown: float = 600):
+        """
+        Args:
+            threshold (int): Consecutive failures that open the circuit
+            cooldown (float): Seconds the circuit stays open the first time
+            max_cooldown (float): Upper bound for the doubled cooldown
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._failures = 0
+        self._open_for = cooldown
+        self._opened_at = None  # type: Optional[float]
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """
+        Returns:
+            bool: Whether a request may be sent now. Claims the trial slot when the cooldown is over
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self._open_for:
+                return False
+            self._trial = True
+            return True
+
+    def retry_in(self) -> float:
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self._opened_at + self._open_for - time.monotonic())
+
+    def succeeded(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._open_for = self.cooldown
+            self._trial = False
+
+    def failed(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial:
+                # The trial request failed, stay open for longer
+                self._open_for = min(self.max_cooldown, self._open_for * 2)
+                self._opened_at = time.monotonic()
+                self._trial = False
+            elif self._opened_at is None and self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """
+        Give the trial slot back when the trial ended without a verdict (e.g. it was cancelled)
+        """
+        with self._lock:
+            self._trial = False
+
+
+class EndpointPool:
+    """
+    Gelbooru compatible API endpoints (mirrors serving the same posts) with per-endpoint health.
+    A request goes to the endpoint with the lowest median latency; when it has not answered within that
+    endpoint's `hedge_quantile` latency, a duplicate is sent to the next endpoint and the first good
+    response wins. Endpoints failing `threshold` times in a row are ranked last for `cooldown` seconds.
+
+    Credentials are only sent to the endpoint they were given for: requests moved to another endpoint
+    lose api_key/user_id and get that endpoint's own ones, written into its URL
+    (https://mirror.example/index.php?api_key=...&user_id=...).
+    """
+
+    def __init__(self, urls: Iterable[str], hedges: int = 1, hedge_quantile: float = 0.95,
+                 min_hedge_delay: float = 0.05, max_hedge_delay: float = 3.0, window: int = 200,
+                 threshold: int = 3, cooldown: float = 30.0):
+        """
+        Args:
+            urls (list of str): dapi URLs, e.g. https://gelbooru.com/index.php. The first one is preferred
+                until latencies are known
+            hedges (int): Duplicates a request may fan out to, at most one per endpoint
+            hedge_quantile (float): Latency quantile of the chosen endpoint after which a duplicate is sent
+            min_hedge_delay (float): Lower bound of the hedge delay, so fast endpoints are not hedged constantly
+            max_hedge_delay (float): Upper bound of the hedge delay, also used until an endpoint has latencies
+            window (int): Latencies kept per endpoint
+            threshold (int): Consecutive failures after which an endpoint is avoided
+            cooldown (float): Seconds an endpoint is avoided
+        """
+        self.endpoints = []     # type: List[_EndpointHealth]
+        for url in urls:
+            url = url.strip()
+            if url and all(url != e.url for e in self.endpoints):
+                self.endpoints.append(_EndpointHealth(url, window))
+        self.hedges = max(0, hedges)
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedge_delay = max_hedge_delay
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.stats = {'requests': 0, 'hedges': 0, 'hedge_wins': 0}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def serves(self, url: str) -> bool:
+        """
+        Whether `url` is a request to one of the endpoints (file downloads from CDNs are not)
+        """
+        base = _Endpoint(url).base
+        return any(base == e.base for e in self.endpoints)
+
+    def rank(self) -> List['_EndpointHealth']:
+        """
+        Endpoints in the order they should be tried: healthy before failing, then by median latency,
+        endpoints without latencies yet keep their configured order behind measured ones
+        """
+        now = time.monotonic()
+        with self._lock:
+            order = {id(e): i for i, e in enumerate(self.endpoints)}
+            return sorted(self.endpoints, key=lambda e: (e.down_until > now,
+                                                          e.latency(0.5) if e.latencies else float('inf'),
+                                                          order[id(e)]))
+
+    def hedge_delay(self, endpoint: '_EndpointHealth') -> float:
+        with self._lock:
+            if len(endpoint.latencies) < 10:
+                return self.max_hedge_delay
+            return min(self.max_hedge_delay, max(self.min_hedge_delay, endpoint.latency(self.hedge_quantile)))
+
+    def observe(self, endpoint: '_EndpointHealth', seconds: float, ok: bool):
+        with self._lock:
+            endpoint.requests += 1
+            if ok:
+                endpoint.latencies.append(seconds)
+                endpoint.failures = 0
+                endpoint.down_until = 0.0
+                return
+            endpoint.errors += 1
+            endpoint.failures += 1
+            if endpoint.failures >= self.threshold:
+                endpoint.down_until = time.monotonic() + self.cooldown
+
+    def snapshot(self) -> List[dict]:
+        """
+        Health of every endpoint: url, requests, errors, p50/p95 latency in seconds and whether it is avoided
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [{'url': e.url, 'requests': e.requests, 'errors': e.errors,
+                     'p50': e.latency(0.5) if e.latencies else None,
+                     'p95': e.latency(0.95) if e.latencies else None,
+                     'down': e.down_until > now} for e in self.endpoints]
+
+
+class _EndpointHealth:
+    __slots__ = ('url', 'base', 'args', 'latencies', 'requests', 'errors', 'failures', 'down_until')
+
+    def __init__(self, url: str, window: int):
+        endpoint = _Endpoint(url)
+        self.url = url
+        self.base = endpoint.base
+        self.args = endpoint.args
+        self.latencies = deque(maxlen=window)  # type: Deque[float]
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0
+        self.down_until = 0.0
+
+    def latency(self, q: float) -> float:
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def rewrite(self, url: str) -> str:
+        """
+        The same request sent to this endpoint, with this endpoint's credentials instead of the original ones
+        """
+        endpoint = _Endpoint(url)
+        if endpoint.base == self.base:
+            return url
+        args = {k: v for k, v in endpoint.args.items() if k not in _CREDENTIAL_ARGS}
+        args.update(self.args)
+        endpoint.base, endpoint.args = self.base, args
+        return str(endpoint)
+
+
+class _Endpoint:
+    """
+    API URL with mutable query arguments, str() gives the encoded URL
+    """
+
+    __slots__ = ('base', 'args')
+
+    def __init__(self, url: str):
+        parts = urlparse(url)
+        self.base = urlunparse(parts._replace(query='', fragment=''))
+        self.args = dict(parse_qsl(parts.query, keep_blank_values=True))  # type: Dict[str, Any]
+
+    def __str__(self) -> str:
+        return f'{self.base}?{urlencode(self.args)}' if self.args else self.base
+
+
+class _ResponseStream(abc.ABC):
+    """
+    Incremental view over a dapi response.
+    The total count is available as soon as the root element has been read and items are yielded
+    one by one while the body is parsed, so callers that only need the first post stop early.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, data: bytes, item: str = 'post'):
+        self._data = data
+        self._item = item
+        self._count = None      # type: Optional[int]
+        self._iter = None       # type: Optional[Iterator[dict]]
+        self._buffered = deque()
+
+    @property
+    def count(self) -> Optional[int]:
+        # Pull items until the root element has been seen, keeping them for iteration
+        while self._count is None and self._pull():
+            pass
+        return self._count
+
+    def __iter__(self) -> Iterator[dict]:
+        while self._buffered or self._pull():
+            if self._buffered:
+                yield self._buffered.popleft()
+
+    def _pull(self) -> bool:
+        if self._iter is None:
+            self._iter = self._parse()
+        try:
+            item = next(self._iter)
+        except StopIteration:
+            return False
+        if item is not None:
+            self._buffered.append(item)
+        return True
+
+    @abc.abstractmethod
+    def _parse(self) -> Iterator[Optional[dict]]:
+        """
+        Yield items as they are parsed, or None after a chunk without one, setting _count once the root is seen
+        """
+
+
+class _ExpatStream(_ResponseStream):
+    """
+    Streaming XML parser for both attribute (<post id=".."/>) and element (<post><id>..</id></post>) layouts
+    """
+
+    def _parse(self) -> Iterator[Optional[dict]]:
+        parser = XMLPullParser(events=('start', 'end'))
+        root = None
+        item = self._item
+        data = self._data
+
+        try:
+            for i in range(0, len(data), self.CHUNK_SIZE):
+                parser.feed(data[i:i + self.CHUNK_SIZE])
+                for event, element in parser.read_events():
+                    if event == 'start':
+                        if root is None:
+                            root = element
+                            _check_root(element.tag, element.attrib, item)
+                            self._count = int(element.get('count', 0) or 0)
+                        continue
+                    if element.tag == item:
+                        payload = dict(element.attrib)
+                        for field in element:
+                            payload[field.tag] = field.text or ''
+                        # Drop the parsed subtree so memory stays flat on large pages
+                        element.clear()
+                        yield payload
+                yield None
+            parser.close()
+        except ParseError:
+            raise GelbooruException("Gelbooru returned a malformed response")
+
+        if self._count is None:
+            self._count = 0
+
+
+class _XmltodictStream(_ResponseStream):
+    """
+    Whole-document parse through xmltodict, kept for compatibility and benchmarking
+    """
+
+    def _parse(self) -> Iterator[Optional[dict]]:
+        import xmltodict
+        try:
+            payload = xmltodict.parse(self._data)
+        except xml.parsers.expat.ExpatError:
+            raise GelbooruException("Gelbooru returned a malformed response")
+
+        # Cross compatability with older Booru API's
+        name, root = next(iter(payload.items()), ('', None))
+        root = root or {}
+        _check_root(name, {k.lstrip('@'): v for k, v in root.items() if k.startswith('@')}
+                    if isinstance(root, dict) else {}, self._item)
+        self._count = int(root.get('@count', 0) or 0) if isinstance(root, dict) else 0
+        items = root.get(self._item, []) if isinstance(root, dict) else []
+        # Single results are not returned as arrays/lists
+        if isinstance(items, dict):
+            items = [items]
+        for item in items:
+            yield {k.strip('@'): v for k, v in item.items()}
+
+
+class _JSONStream(_ResponseStream):
+    """
+    Parser for the json=1 mode of the dapi
+    """
+
+    def _parse(self) -> Iterator[Optional[dict]]:
+        try:
+            payload = json.loads(self._data) if self._data.strip() else []
+        except ValueError:
+            raise GelbooruException("Gelbooru returned a malformed response")
+
+        # Older Booru API's return a bare list of items
+        if isinstance(payload, list):
+            self._count = len(payload)
+            yield from payload
+            return
+        if not isinstance(payload, dict) or payload.get('success') is False \
+                or ('@attributes' not in payload and self._item not in payload):
+            reason = payload.get('message') or payload.get('reason') if isinstance(payload, dict) else None
+            raise GelbooruException(f"Gelbooru returned an error: {reason or 'unexpected response'}")
+
+        self._count = int(payload.get('@attributes', {}).get('count', 0) or 0)
+        items = payload.get(self._item, [])
+        if isinstance(items, dict):
+            items = [items]
+        yield from items
+
+
+def _check_root(tag: str, attrs: Mapping[str, str], item: str):
+    """
+    Raise for replies that are not a result list, which the API also sends with status 200:
+    <response success="false" reason=".."/> when rate limited or blocked, HTML pages, other roots
+    """
+    if str(attrs.get('success', '')).lower() == 'false' or tag != item + 's':
+        reason = attrs.get('reason') or attrs.get('message') or f'unexpected <{tag}> response'
+        raise GelbooruException(f"Gelbooru returned an error: {reason}")
+
+
+_PARSERS = {
+    'expat': _ExpatStream,
+    'json': _JSONStream,
+    'xmltodict': _XmltodictStream,
+}
+
+
+def parse_response(data: bytes, parser: str = 'expat', item: str = 'post') -> _ResponseStream:
+    """
+    Parse a dapi response body incrementally
+    Args:
+        data (bytes): The response body
+        parser (str): One of Gelbooru.PARSER_EXPAT, PARSER_JSON or PARSER_XMLTODICT
+        item (str): Name of the repeated item element, 'post' or 'tag'
+    Returns:
+        A stream with a `count` attribute that yields one dict per item
+    """
+    try:
+        return _PARSERS[parser](data, item)
+    except KeyError:
+        raise ValueError(f"Unknown response parser: {parser}")
+
+
 class Gelbooru:
     SORT_COUNT = 'count'
     SORT_DATE = 'date'
@@ -79,10 +947,31 @@ class Gelbooru:
     SORT_ASC = 'ASC'
     SORT_DESC = 'DESC'
 
+    PARSER_EXPAT = 'expat'
+    PARSER_JSON = 'json'
+    PARSER_XMLTODICT = 'xmltodict'
+
+    # Deepest offset the API serves, and how many id:<N probes deep sampling may spend to get below it
+    MAX_OFFSET = 20000
+    MAX_PROBES = 16
+    # Seconds the (id, count) points learned by probing a query are reused for later deep samples
+    KNOT_TTL = 600
+
     def __init__(self, api_key: Optional[str] = None,
                  user_id: Optional[str] = None,
                  loop: Optional[asyncio.AbstractEventLoop] = None,
-                 api: Optional[str] = API_GELBOORU):
+                 api: Optional[str] = None,
+                 runtime: Optional[GelbooruRuntime] = None,
+                 count_cache: Optional[CountCache] = None,
+                 parser: str = PARSER_EXPAT,
+                 max_concurrency: int = 4,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 max_retries: int = 3,
+                 timer: Optional[Callable[[str], ContextManager]] = None,
+                 response_cache=None,
+                 post_hooks: Optional[List[Callable[[List['GelbooruImage']], None]]] = None,
+                 endpoints: Optional[EndpointPool] = None):
         """
         API credentials can be obtained here (registration required):
         https://gelbooru.com/index.php?page=account&s=options
@@ -91,11 +980,49 @@ class Gelbooru:
             user_id (str): User ID
             loop (asyncio.AbstractEventLoop): Event loop to use
             api (str): Gelbooru compatible API endpoint to use
+            runtime (GelbooruRuntime): Shared loop and connection pool to send requests through.
+                A new session is opened for every request if omitted
+            count_cache (CountCache): Cache of post counts used by random_post to skip the count query
+            parser (str): Response parser, PARSER_EXPAT (streaming XML), PARSER_JSON (json=1 mode)
+                or PARSER_XMLTODICT (legacy whole-document parse)
+            max_concurrency (int): Maximum number of requests this client has on the wire at once.
+                Identical concurrent requests are coalesced and only count once
+            rate_limiter (RateLimiter): Request pacing, share one between clients talking to the same host.
+                A private 8 requests/s limiter is used if omitted
+            circuit_breaker (CircuitBreaker): Fails requests fast while the server keeps erroring,
+                a private one is used if omitted
+            max_retries (int): How many times a request is retried after a 429, 5xx or connection error
+            timer (callable): Returns a context manager timing the named stage, e.g. Metrics.timer.
+                Stages: count, locate, search, parse, tag, http (every attempt on the wire), head, download
+            response_cache (GelResponseCache.ResponseCache): On-disk cache of API responses, keyed by URL
+                without credentials, with per-endpoint TTLs and conditional revalidation
+            post_hooks (list of callable): Called with every page of posts search_posts returns, on the loop the
+                search ran on, e.g. to index tags. Must not block; exceptions raised by a hook are ignored
+            endpoints (EndpointPool): Mirrors API requests are spread and hedged over, `api` is used alone if omitted
         """
+        if parser not in _PARSERS:
+            raise ValueError(f"Unknown response parser: {parser}")
         self._api_key = api_key
         self._user_id = user_id
         self._loop = loop
-        self._base_url = api
+        self._base_url = api or API_GELBOORU
+        self._runtime = runtime
+        self._count_cache = count_cache
+        self._parser = parser
+        self._max_concurrency = max(1, max_concurrency)
+        self._semaphore = None      # type: Optional[asyncio.Semaphore]
+        self._limiter = rate_limiter or RateLimiter()
+        self._breaker = circuit_breaker or CircuitBreaker()
+        self.max_retries = max(0, max_retries)
+        self._timer = timer or _untimed
+        self._response_cache = response_cache
+        self.post_hooks = list(post_hooks or [])
+        self._endpoints = endpoints
+        self._inflight = {}         # type: Dict[str, asyncio.Future]
+        self._top_ids = OrderedDict()  # type: OrderedDict[str, int]
+        self._knots = OrderedDict()    # type: OrderedDict[str, Tuple[float, List[int], List[int]]]
+        self._refreshing = set()    # type: Set[str]
+        self._tasks = set()         # type: Set[asyncio.Task]
 
     async def get_post(self, post_id: int) -> Optional[GelbooruImage]:
         """
@@ -108,17 +1035,64 @@ class Gelbooru:
         endpoint = self._endpoint('post')
         endpoint.args['id'] = post_id
 
-        # Fetch and parse XML, then make sure we actually have results
-        payload = await self._request(str(endpoint))
-        payload = xmltodict.parse(payload)
+        # Fetch and parse the response, then make sure we actually have results
+        payload = await self._request(str(endpoint), kind='post')
+        post = next(iter(self._parse(payload)), None)
+        if post is None:
+            raise GelbooruNotFoundException(f"Could not find a post with the ID {post_id}")
 
-        # Cross compatability with older Booru API's
-        payload = {k.strip('@'): v for k, v in payload.items()}
+        return GelbooruImage(post, self)
 
-        if 'posts' not in payload:
-            raise GelbooruNotFoundException(f"Could not find a post with the ID {post_id}")
+    async def get_posts(self, post_ids: Iterable[int], chunk_size: int = 100) -> Dict[int, GelbooruImage]:
+        """
+        Get many posts by ID in as few requests as possible.
+        IDs are looked up `chunk_size` at a time with an OR search ({id:1 ~ id:2 ~ ...}), chunks run concurrently
+        within the client's max_concurrency and rate limit.
+        Args:
+            post_ids (list of int): Post IDs, duplicates are looked up once
+            chunk_size (int): IDs per request, at most 100 (the page limit)
+        Returns:
+            dict of int to GelbooruImage: Posts by ID, IDs that were not found (e.g. deleted posts) are missing
+        """
+        ids = list(dict.fromkeys(int(post_id) for post_id in post_ids))
+        chunk_size = max(1, min(chunk_size, _PAGE_LIMIT))
+
+        async def lookup(chunk: List[int]) -> List[GelbooruImage]:
+            endpoint = self._endpoint('post')
+            endpoint.args['limit'] = len(chunk)
+            endpoint.args['tags'] = f"{{{' ~ '.join(f'id:{post_id}' for post_id in chunk)}}}" if len(chunk) > 1 \
+                else f'id:{chunk[0]}'
+            with self._timer('search'):
+                payload = await self._request(str(endpoint), kind='post')
+            with self._timer('parse'):
+                return [GelbooruImage(p, self) for p in self._parse(payload)]
+
+        pages = await asyncio.gather(*(lookup(ids[i:i + chunk_size]) for i in range(0, len(ids), chunk_size)))
+        return {post.id: post for page in pages for post in page}
+
+    async def get_tags_by_name(self, names: Iterable[str], chunk_size: int = 100) -> List[dict]:
+        """
+        Look up tags by exact name, `chunk_size` names per request (s=tag&names=...), chunks run concurrently
+        Args:
+            names (list of str): Tag names as they appear on posts, duplicates are looked up once
+            chunk_size (int): Names per request, at most 100 (the page limit)
+        Returns:
+            list of dict: One item per known tag with at least name, type (category number) and count.
+                Names the API does not know are missing
+        """
+        names = list(dict.fromkeys(name for name in names if name))
+        chunk_size = max(1, min(chunk_size, _PAGE_LIMIT))
 
-        return GelbooruImage(payload['posts']['post'], self)
+        async def lookup(chunk: List[str]) -> List[dict]:
+            endpoint = self._endpoint('tag')
+            endpoint.args['limit'] = len(chunk)
+            endpoint.args['names'] = ' '.join(chunk)
+            with self._timer('tag'):
+                payload = await self._request(str(endpoint), kind='tag')
+            return list(self._parse(payload, 'tag'))
+
+        pages = await asyncio.gather(*(lookup(names[i:i + chunk_size]) for i in range(0, len(names), chunk_size)))
+        return [tag for page in pages for tag in page]
 
     async def random_post(self, *, tags: Optional[List[str]] = None,
                           exclude_tags: Optional[List[str]] = None) -> Optional[List[GelbooruImage]]:
@@ -130,33 +1104,81 @@ class Gelbooru:
         Returns:
             GelbooruImage or None: Returns None if no posts are found with the specified tags.
         """
-        endpoint = self._endpoint('post')
-        endpoint.args['limit'] = 1
-
         # Apply basic tag formatting
         tags = self._format_tags(tags, exclude_tags)
-        if tags:
-            endpoint.args['tags'] = ' '.join(tags)
 
-        # Run the initial query to get the number of posts available
-        payload = await self._request(str(endpoint))
-        try:
-            payload = xmltodict.parse(payload)
-
-            # Cross compatability with older Booru API's
-            payload = {k.strip('@'): v for k, v in payload.items()}
-        except xml.parsers.expat.ExpatError:
-            raise GelbooruException("Gelbooru returned a malformed response")
+        # Get the number of posts available, from the count cache when possible
+        count = await self._cached_count(tags)
 
         # Count is 0? We have no results to fetch then
-        count = int(payload['posts']['@count'])
         if not count:
             return None
 
-        # Otherwise, let's pull a random ID from the number of posts
-        offset = randint(0, min(count, 20000))
+        # Otherwise, let's pull a uniformly random post out of all of them
+        post = await self._random_page(tags, count, limit=1)
+
+        if not post and self._count_cache is not None:
+            # The cached count ran ahead of the live result set, refresh it and try once more
+            count = await self._cached_count(tags, refresh=True)
+            if not count:
+                return None
+            post = await self._random_page(tags, count, limit=1)
+
+        return post or None
+
+    async def random_posts(self, n: int, *, tags: Optional[List[str]] = None,
+                           exclude_tags: Optional[List[str]] = None) -> List[GelbooruImage]:
+        """
+        Get up to `n` distinct random posts with the optionally specified tag(s), in as few requests as possible.
+        Each request pulls a full page from a uniformly random position, so up to 100 posts cost one request
+        (plus the count query unless it is cached); more are fetched as concurrent pages.
+        Args:
+            n (int): Number of posts wanted
+            tags (list of str): A list of tags to search for
+            exclude_tags (list of str): A list of tags to EXCLUDE from search results
+        Returns:
+            list of GelbooruImage: In random order, shorter than `n` when fewer posts match
+        """
+        if n <= 0:
+            return []
+        tags = self._format_tags(tags, exclude_tags)
+        count = await self._cached_count(tags)
+        if not count:
+            return []
+
+        picked = OrderedDict()  # type: OrderedDict[int, GelbooruImage]
+        for _ in range(3):
+            missing = min(n, count) - len(picked)
+            if missing <= 0:
+                break
+            pages = await asyncio.gather(*(self._random_page(tags, count, limit=_PAGE_LIMIT)
+                                           for _ in range(-(-missing // _PAGE_LIMIT))))
+            before = len(picked)
+            for page in pages:
+                shuffle(page)
+                for post in page:
+                    picked.setdefault(post.id, post)
+            if len(picked) == before and self._count_cache is not None:
+                # The cached count ran ahead of the live result set
+                count = await self._cached_count(tags, refresh=True)
+                if not count:
+                    break
+
+        posts = list(picked.values())
+        shuffle(posts)
+        return posts[:n]
 
-        return await self.search_posts(tags=tags, exclude_tags=exclude_tags, limit=1, page=offset)
+    async def count(self, *, tags: Optional[List[str]] = None,
+                    exclude_tags: Optional[List[str]] = None) -> int:
+        """
+        Get the number of posts matching the specified tags
+        Args:
+            tags (list of str): A list of tags to search for
+            exclude_tags (list of str): A list of tags to EXCLUDE from search results
+        Returns:
+            int
+        """
+        return await self._cached_count(self._format_tags(tags, exclude_tags))
 
     async def search_posts(self, *, tags: Optional[List[str]] = None,
                            exclude_tags: Optional[List[str]] = None,
@@ -181,32 +1203,196 @@ class Gelbooru:
         if tags:
             endpoint.args['tags'] = ' '.join(tags)
 
-        # Fetch and parse XML, then make sure we actually have results
-        payload = await self._request(str(endpoint))
-        try:
-            payload = xmltodict.parse(payload)
-        except xml.parsers.expat.ExpatError:
-            raise GelbooruException("Gelbooru returned a malformed response")
-        if 'posts' not in payload or 'post' not in payload["posts"]:
-            return []
+        # Fetch and parse the response, posts are built while the body is being parsed
+        with self._timer('search'):
+            payload = await self._request(str(endpoint))
+        with self._timer('parse'):
+            posts = iter(self._parse(payload))
 
-        # Single results are not returned as arrays/lists and need to be processed directly instead of iterated
-        result = [GelbooruImage(p, self) for p in payload['posts']['post']] \
-            if isinstance(payload['posts']['post'], list) \
-            else [GelbooruImage(payload['posts']['post'], self)]
+            page = [GelbooruImage(p, self) for p in (posts if limit != 1 else itertools.islice(posts, 1))]
+        for hook in self.post_hooks:
+            with contextlib.suppress(Exception):
+                hook(page)
 
         # Return the first result if we have a limit of 1 explicitly set
         if limit == 1:
-            return result[0]
-        else:
-            return result
+            return page[0] if page else []
+        return page
+
+    async def _random_page(self, tags: List[str], count: int, limit: int = 1) \
+            -> Union[List[GelbooruImage], GelbooruImage]:
+        """
+        Fetch the post at a uniformly random rank of an already formatted query (limit=1),
+        or the page of `limit` posts containing it
+        """
+        with self._timer('locate'):
+            extra, offset = await self._locate(tags, count, limit)
+        return await self.search_posts(tags=tags + extra, limit=limit, page=offset if limit == 1 else offset // limit)
+
+    async def _locate(self, tags: List[str], count: int, limit: int = 1) -> Tuple[List[str], int]:
+        """
+        Pick a uniformly random rank among `count` posts and work out how to reach it.
+
+        Ranks within MAX_OFFSET of the newest post are reached with a plain offset. Deeper ranks are
+        reached by narrowing the query with id:<N until the target falls within the offset window of the
+        narrowed result set, using interpolation on the reported counts (usually 1-3 probes).
+        Every probe is remembered per query for KNOT_TTL seconds as a point (id, posts with a lower id),
+        so once the known points are less than a window apart a deep sample needs no probe at all.
+        Queries with their own ordering cannot be narrowed by id and stay on the capped offset.
+        Returns:
+            (list of str, int): Extra tags to add to the query and the offset of the chosen post in it
+        """
+        window = self.MAX_OFFSET - (limit if limit > 1 else 0)
+        if count <= window + 1 or any(tag.startswith(_ORDERING_TAGS) for tag in tags):
+            return [], randrange(min(count, window + 1))
+
+        # Ascending rank of the chosen post: exactly `rank` posts have an id <= its id
+        rank = randint(1, count)
+        if count - rank <= window:
+            return [], count - rank
+
+        key = CountCache.key(tags)
+        ids, counts = self._known_points(key)
+        # The nearest known point at or above the target rank, within the window: no probe needed
+        i = bisect_left(counts, rank)
+        if i < len(counts) and counts[i] <= rank + window:
+            return [f'id:<{ids[i] + 1}'], counts[i] - rank
+
+        top = await self._top_id(tags)
+        lo_id, lo_count, hi_id, hi_count = 0, 0, top, count
+        if i:
+            lo_id, lo_count = ids[i - 1], counts[i - 1]
+        if i < len(counts):
+            hi_id, hi_count = ids[i], counts[i]
+        target = rank + window // 2
+        for probe in range(self.MAX_PROBES):
+            if hi_id - lo_id <= 1:
+                break
+            if probe < 4 and hi_count > lo_count:
+                guess = lo_id + (hi_id - lo_id) * (target - lo_count) // (hi_count - lo_count)
+            else:
+                guess = (lo_id + hi_id) // 2
+            guess = min(max(guess, lo_id + 1), hi_id - 1)
+
+            narrowed = [f'id:<{guess + 1}']
+            found = await self._query_count(tags + narrowed, record_top=False)
+            self._remember_point(key, guess, found)
+            if rank <= found <= rank + window:
+                return narrowed, found - rank
+            if found < rank:
+                lo_id, lo_count = guess, found
+            else:
+                hi_id, hi_count = guess, found
+
+        # Counts moved under us (posts added or deleted), settle for the capped window
+        return [], randrange(window + 1)
+
+    async def _top_id(self, tags: List[str]) -> int:
+        """
+        ID of the newest post of an already formatted query, remembered from its count queries.
+        When the count came from the count cache, the query that fetches the ID refreshes the cached count too
+        """
+        key = CountCache.key(tags)
+        if key not in self._top_ids:
+            await self._cached_count(tags, refresh=True)
+        return self._top_ids.get(key, 0)
+
+    def _known_points(self, key: str) -> Tuple[List[int], List[int]]:
+        """
+        Points (id, posts with a lower id) probed for a query, sorted by id. Both lists grow together
+        """
+        entry = self._knots.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.KNOT_TTL:
+            entry = self._knots[key] = (time.monotonic(), [], [])
+        self._knots.move_to_end(key)
+        while len(self._knots) > 512:
+            self._knots.popitem(last=False)
+        return entry[1], entry[2]
+
+    def _remember_point(self, key: str, post_id: int, count: int):
+        ids, counts = self._known_points(key)
+        i = bisect_left(ids, post_id)
+        if i < len(ids) and ids[i] == post_id:
+            return
+        # Deletions between probes could break the ordering, start over rather than mix inconsistent points
+        if (i and counts[i - 1] > count) or (i < len(counts) and counts[i] < count):
+            del ids[:], counts[:]
+            i = 0
+        ids.insert(i, post_id)
+        counts.insert(i, count)
+
+    async def _query_count(self, tags: List[str], record_top: bool = True, cached: bool = True) -> int:
+        """
+        Run a limit=1 query with already formatted tags and return the reported post count.
+        The newest post's ID comes along for free and is kept for deep sampling.
+        """
+        endpoint = self._endpoint('post')
+        endpoint.args['limit'] = 1
+        if tags:
+            endpoint.args['tags'] = ' '.join(tags)
+
+        with self._timer('count'):
+            payload = await self._request(str(endpoint), cached=cached, kind='count')
+        stream = self._parse(payload)
+        count = stream.count
+        if record_top:
+            first = next(iter(stream), None)
+            if first is not None:
+                key = CountCache.key(tags)
+                self._top_ids[key] = int(first.get('id', 0) or 0)
+                self._top_ids.move_to_end(key)
+                while len(self._top_ids) > 512:
+                    self._top_ids.popitem(last=False)
+        return count
+
+    async def _cached_count(self, tags: List[str], refresh: bool = False) -> int:
+        """
+        Return the post count for already formatted tags, going through the count cache if one is set.
+        Stale entries are served immediately and refreshed in the background.
+        """
+        cache = self._count_cache
+        if cache is None:
+            return await self._query_count(tags)
+
+        key = CountCache.key(tags)
+        if refresh:
+            self._knots.pop(key, None)
+        hit = None if refresh else cache.get(key)
+        if hit is None:
+            count = await self._query_count(tags, cached=not refresh)
+            cache.set(key, count, save=False)
+            await self._off_loop(cache.save)
+            return count
+
+        count, stale = hit
+        if stale and key not in self._refreshing:
+            self._refreshing.add(key)
+            self._background(self._refresh_count(key, tags))
+        return count
+
+    async def _refresh_count(self, key: str, tags: List[str]):
+        try:
+            self._count_cache.set(key, await self._query_count(tags, cached=False), save=False)
+            await self._off_loop(self._count_cache.save)
+        except Exception:
+            pass
+        finally:
+            self._refreshing.discard(key)
 
-    def _endpoint(self, s: str) -> furl:
-        endpoint = furl(self._base_url)
+    def _background(self, coro) -> asyncio.Task:
+        # Keep a reference so the task is not garbage collected before it finishes
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _endpoint(self, s: str) -> '_Endpoint':
+        endpoint = _Endpoint(self._base_url)
         endpoint.args['page'] = 'dapi'
         endpoint.args['s'] = s
         endpoint.args['q'] = 'index'
-        # endpoint.args['json'] = '1'
+        if self._parser == self.PARSER_JSON:
+            endpoint.args['json'] = '1'
 
         # Append API key if available
         if self._api_key:
@@ -216,6 +1402,9 @@ class Gelbooru:
 
         return endpoint
 
+    def _parse(self, payload: bytes, item: str = 'post') -> _ResponseStream:
+        return parse_response(payload, self._parser, item)
+
     def _format_tags(self, tags: list, exclude_tags: list):
         """
         Apply basic tag formatting
@@ -232,20 +1421,466 @@ class Gelbooru:
 
         return tags + exclude_tags
 
-    async def _request(self, url: str) -> bytes:
+    @property
+    def max_concurrency(self) -> int:
+        return self._max_concurrency
+
+    @max_concurrency.setter
+    def max_concurrency(self, value: int):
+        value = max(1, int(value))
+        if value != self._max_concurrency:
+            # Requests holding the old semaphore finish normally, new ones queue on the new limit
+            self._max_concurrency = value
+            self._semaphore = None
+
+    async def check_file(self, url: str) -> bool:
+        """
+        Check that a file URL (e.g. GelbooruImage.file_url) is reachable with a HEAD request
+        Returns:
+            bool
+        """
+        async def head(session: 'aiohttp.ClientSession') -> int:
+            async with session.head(url, allow_redirects=True) as response:
+                return response.status
+
+        async def scheduled() -> int:
+            await self._limiter.acquire()
+            async with self._scheduler():
+                return await self._with_session(head)
+
+        with self._timer('head'):
+            return await self._on_runtime(scheduled()) == 200
+
+    async def fetch_file(self, url: str) -> bytes:
+        """
+        Download a file (e.g. GelbooruImage.file_url) through the client's connection pool.
+        Concurrent downloads of the same URL share one transfer.
+        Raises:
+            GelbooruException: Raised on a non 200 status code
+        """
+        with self._timer('download'):
+            status_code, response, _ = await self._get(url)
+        if status_code != 200:
+            raise GelbooruException(f"Image download returned status code {status_code}")
+        return response
+
+    async def _with_session(self, fn: Callable[['aiohttp.ClientSession'], Awaitable]):
+        """
+        Run `fn(session)` on the shared pooled session, or on a throwaway session without a runtime
+        """
+        if self._runtime is not None:
+            return await self._runtime.call(self._pooled(fn))
+        import aiohttp
         async with aiohttp.ClientSession(loop=self._loop) as session:
-            status_code, response = await self._fetch(session, url)
+            return await fn(session)
+
+    async def _pooled(self, fn: Callable[['aiohttp.ClientSession'], Awaitable]):
+        return await fn(await self._runtime.session())
+
+    async def _on_runtime(self, coro):
+        if self._runtime is not None:
+            return await self._runtime.call(coro)
+        return await coro
+
+    def _scheduler(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        return self._semaphore
+
+    async def _get(self, url: str, headers: Optional[Dict[str, str]] = None) -> Tuple[int, bytes, Mapping[str, str]]:
+        """
+        GET through single-flight coalescing and the bounded scheduler.
+        Callers asking for the same URL (credentials aside) while a request is in flight share its response.
+        """
+        if self._runtime is not None and not self._runtime.in_loop():
+            # Coalescing state lives on the runtime loop
+            return await self._runtime.call(self._get(url, headers))
+
+        key = _request_key(url)
+        if headers:
+            # A conditional request may come back 304, which is no answer for an unconditional one
+            key += '\n' + repr(sorted(headers.items()))
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._get_scheduled(url, headers))
+            self._inflight[key] = future
+            future.add_done_callback(functools.partial(self._flight_done, key))
+        # Shielded so one caller giving up does not cancel the request for everybody else
+        return await asyncio.shield(future)
+
+    async def _get_scheduled(self, url: str, headers: Optional[Dict[str, str]] = None) \
+            -> Tuple[int, bytes, Mapping[str, str]]:
+        """
+        GET paced by the rate limiter, retrying 429, 5xx and connection errors with jittered exponential backoff.
+        The last failed response is returned (or its error raised) once retries run out.
+        """
+        import aiohttp
+        for attempt in range(self.max_retries + 1):
+            if not self._breaker.allow():
+                raise GelbooruException(f"Gelbooru keeps failing, requests are paused for "
+                                        f"{self._breaker.retry_in():.0f}s")
+            retry_after = None
+            try:
+                await self._limiter.acquire()
+                async with self._scheduler():
+                    with self._timer('http'):
+                        status_code, response, response_headers = await self._send(url, headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self._breaker.failed()
+                if attempt == self.max_retries:
+                    raise
+            except BaseException:
+                self._breaker.release()
+                raise
+            else:
+                if status_code not in _TRANSIENT_STATUS:
+                    self._breaker.succeeded()
+                    self._limiter.succeeded()
+                    return status_code, response, response_headers
+                self._breaker.failed()
+                if status_code == 429:
+                    retry_after = _retry_after(response_headers.get('Retry-After'))
+                    self._limiter.throttled(retry_after)
+                if attempt == self.max_retries:
+                    return status_code, response, response_headers
+
+            # Full jitter keeps clients that failed together from retrying together
+            backoff = uniform(0, min(_BACKOFF_CAP, _BACKOFF_BASE * 2 ** attempt))
+            await asyncio.sleep(max(backoff, retry_after or 0))
 
+    def _flight_done(self, key: str, future: asyncio.Future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if not future.cancelled():
+            future.exception()
+
+    async def _request(self, url: str, cached: bool = True, kind: str = 'search') -> bytes:
+        """
+        GET an API URL, through the response cache if one is set.
+        Fresh cache entries are served without a request, expired ones are revalidated when possible.
+        Args:
+            cached (bool): False to skip the cache lookup (the response is still stored)
+            kind (str): Response cache kind the entry is stored under (post, search, count or tag), picks its TTL
+        """
+        cache = self._response_cache
+        key = _request_key(url) if cache is not None else None
+        entry = None
+        if cache is not None and cached:
+            entry = await self._off_loop(cache.get, key)
+        if entry is not None and entry.fresh:
+            return entry.body
+
+        validators = entry.validators() if entry is not None else None
+        status_code, response, headers = await self._get(url, validators)
+
+        if status_code == 304 and entry is not None:
+            await self._off_loop(cache.revalidated, key)
+            return entry.body
         if status_code == 401:
             raise GelbooruException("Gelbooru returned 401 status code, you need to log in to your account")
         elif status_code not in [200, 201]:
             raise GelbooruException(f"Gelbooru returned a non 200 status code: {response}, code is: {status_code}")
 
+        if cache is not None:
+            # Error replies come with status 200 too, parsing up to the root raises for them before they are stored
+            _ = self._parse(response, 'tag' if kind == 'tag' else 'post').count
+            await self._off_loop(cache.put, key, kind, response, headers.get('ETag'), headers.get('Last-Modified'))
         return response
 
-    async def _fetch(self, session: aiohttp.ClientSession, url) -> Tuple[int, bytes]:
-        async with session.get(url) as response:
-            return response.status, await response.read()
+    @staticmethod
+    async def _off_loop(function: Callable, *args):
+        """
+        Run blocking cache I/O (SQLite, zlib, JSON files) in the loop's default executor, so a cache file locked by
+        another process stalls only this request and not every request on the loop.
+        A locked or broken cache must not fail the request, errors are swallowed and None is returned
+        """
+        with contextlib.suppress(Exception):
+            return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def _send(self, url: str, headers: Optional[Dict[str, str]] = None) -> Tuple[int, bytes, Mapping[str, str]]:
+        """
+        One attempt of a GET, hedged over the endpoint pool when the URL is an API request
+        """
+        pool = self._endpoints
+        if pool is None or len(pool) < 2 or not pool.serves(url):
+            return await self._with_session(lambda session: self._fetch(session, url, headers))
+        return await self._hedged(pool, url, headers)
+
+    async def _hedged(self, pool: EndpointPool, url: str,
+                      headers: Optional[Dict[str, str]] = None) -> Tuple[int, bytes, Mapping[str, str]]:
+        """
+        Send to the best ranked endpoint, add a duplicate on the next one whenever the newest attempt has not
+        answered within its hedge delay or has failed, and return the first non-transient response.
+        Losing attempts are cancelled. If every attempt fails, the last failure is returned or raised
+        """
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        candidates = pool.rank()[:pool.hedges + 1]
+        attempts = {}   # type: Dict[asyncio.Task, _EndpointHealth]
+        failure = None  # type: Union[None, BaseException, Tuple[int, bytes, Mapping[str, str]]]
+
+        async def attempt(endpoint: _EndpointHealth):
+            started = loop.time()
+            try:
+                result = await self._with_session(lambda session: self._fetch(session, endpoint.rewrite(url), headers))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pool.observe(endpoint, loop.time() - started, False)
+                raise
+            pool.observe(endpoint, loop.time() - started, result[0] not in _TRANSIENT_STATUS)
+            return result
+
+        def launch():
+            endpoint = candidates.pop(0)
+            attempts[loop.create_task(attempt(endpoint))] = endpoint
+            return endpoint
+
+        pool.stats['requests'] += 1
+        newest = primary = launch()
+        try:
+            while attempts:
+                done, _ = await asyncio.wait(list(attempts), return_when=asyncio.FIRST_COMPLETED,
+                                             timeout=pool.hedge_delay(newest) if candidates else None)
+                for task in done:
+                    endpoint = attempts.pop(task)
+                    try:
+                        result = task.result()
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        failure = e
+                        continue
+                    if result[0] in _TRANSIENT_STATUS:
+                        failure = result
+                        continue
+                    if endpoint is not primary:
+                        pool.stats['hedge_wins'] += 1
+                    return result
+                if candidates and (not done or not attempts):
+                    pool.stats['hedges'] += 1
+                    newest = launch()
+        finally:
+            for task in attempts:
+                task.cancel()
+        if isinstance(failure, BaseException):
+            raise failure
+        return failure
+
+    async def _fetch(self, session: 'aiohttp.ClientSession', url,
+                     headers: Optional[Dict[str, str]] = None) -> Tuple[int, bytes, Mapping[str, str]]:
+        async with session.get(url, headers=headers) as response:
+            return response.status, await response.read(), response.headers
+
+
+class PostReservoir:
+    """
+    Per-query pool of prefetched posts.
+    Pools are filled a page at a time from random offsets and drained one post per call,
+    a background refill is started as soon as a pool drops below the low-water mark.
+    """
+
+    def __init__(self, gelbooru: Gelbooru, page_size: int = 100, low_water: int = 20, max_queries: int = 32,
+                 recent=None):
+        """
+        Args:
+            gelbooru (Gelbooru): Client used to fetch pages
+            page_size (int): Number of posts requested per page
+            low_water (int): Pool size below which a background refill is started
+            max_queries (int): Maximum number of queries to keep pools for
+            recent (GelRecent.RecentPosts): Posts already handed out per query. Pooled posts found in it are
+                skipped, a repeat is only returned when the query has nothing else left
+        """
+        self.page_size = max(2, page_size)
+        self.low_water = low_water
+        self.max_queries = max_queries
+        self.recent = recent
+        self._gelbooru = gelbooru
+        self._pools = OrderedDict()  # type: OrderedDict[str, deque]
+        self._refills = {}           # type: Dict[str, asyncio.Task]
+
+    async def take(self, *, tags: Optional[List[str]] = None,
+                   exclude_tags: Optional[List[str]] = None) -> Optional[GelbooruImage]:
+        """
+        Return a random post with the specified tags, waiting for the network only when the pool is empty
+        Args:
+            tags (list of str): A list of tags to search for
+            exclude_tags (list of str): A list of tags to EXCLUDE from search results
+        Returns:
+            GelbooruImage or None: Returns None if no posts are found with the specified tags.
+        """
+        tags = self._gelbooru._format_tags(tags, exclude_tags)
+        key = CountCache.key(tags)
+        pool = self._pool(key)
+
+        if not pool:
+            await self._refill(key, tags)
+        post, repeats, seen = None, [], set()
+        for attempt in range(2):
+            while pool:
+                candidate = pool.popleft()
+                if candidate.id in seen:
+                    continue
+                seen.add(candidate.id)
+                if not self._used(key, candidate):
+                    post = candidate
+                    break
+                repeats.append(candidate)
+            if post is not None or not repeats or attempt or not await self._more_than_a_page(tags):
+                break
+            # Only repeats were pooled but the query has more pages, try one page from another offset first
+            await self._refill(key, tags)
+        if post is None:
+            if not repeats:
+                return None
+            # Everything was used recently, hand out repeats and keep the rest pooled for the next calls
+            post = repeats.pop(0)
+            pool.extendleft(reversed(repeats))
+
+        self._remember(key, [post])
+        if len(pool) < self.low_water:
+            self._schedule_refill(key, tags)
+        return post
+
+    async def take_many(self, n: int, *, tags: Optional[List[str]] = None,
+                        exclude_tags: Optional[List[str]] = None) -> List[GelbooruImage]:
+        """
+        Return up to `n` distinct random posts, refilling the pool as often as needed (at most a few times)
+        Returns:
+            list of GelbooruImage: Shorter than `n` when fewer posts match
+        """
+        tags = self._gelbooru._format_tags(tags, exclude_tags)
+        key = CountCache.key(tags)
+        pool = self._pool(key)
+
+        posts, repeats, seen = [], [], set()
+        for _ in range(-(-n // self.page_size) + 2):
+            while pool and len(posts) < n:
+                post = pool.popleft()
+                if post.id in seen:
+                    continue
+                seen.add(post.id)
+                (repeats if self._used(key, post) else posts).append(post)
+            if len(posts) >= n or (repeats and not await self._more_than_a_page(tags)):
+                break
+            await self._refill(key, tags)
+            if not pool:
+                break
+        # Top up with recently used posts when the query has run out of others
+        posts += repeats[:n - len(posts)]
+
+        self._remember(key, posts)
+        if len(pool) < self.low_water:
+            self._schedule_refill(key, tags)
+        return posts
+
+    def peek(self, *, tags: Optional[List[str]] = None,
+             exclude_tags: Optional[List[str]] = None) -> Optional[GelbooruImage]:
+        """
+        Return the post the next take() would hand out without removing it, None if the pool is empty
+        """
+        pool = self._pools.get(CountCache.key(self._gelbooru._format_tags(tags, exclude_tags)))
+        return pool[0] if pool else None
+
+    def clear(self):
+        for task in self._refills.values():
+            task.cancel()
+        self._refills.clear()
+        self._pools.clear()
+
+    def _used(self, key: str, post: GelbooruImage) -> bool:
+        return self.recent is not None and self.recent.seen(key, post.id)
+
+    def _remember(self, key: str, posts: List[GelbooruImage]):
+        if self.recent is not None:
+            for post in posts:
+                self.recent.add(key, post.id)
+
+    async def _more_than_a_page(self, tags: List[str]) -> bool:
+        return (await self._gelbooru._cached_count(tags)) > self.page_size
+
+    def _pool(self, key: str) -> deque:
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = deque()
+            while len(self._pools) > self.max_queries:
+                self._pools.popitem(last=False)
+        self._pools.move_to_end(key)
+        return pool
+
+    def _schedule_refill(self, key: str, tags: List[str]) -> asyncio.Task:
+        task = self._refills.get(key)
+        if task is None or task.done():
+            task = self._refills[key] = asyncio.get_running_loop().create_task(self._fill(key, tags))
+            task.add_done_callback(lambda t, key=key: self._refill_done(key, t))
+        return task
+
+    def _refill_done(self, key: str, task: asyncio.Task):
+        if self._refills.get(key) is task:
+            del self._refills[key]
+        # Failures of background refills surface on the next take() that has to wait
+        if not task.cancelled():
+            task.exception()
+
+    async def _refill(self, key: str, tags: List[str]):
+        await asyncio.shield(self._schedule_refill(key, tags))
+
+    async def _fill(self, key: str, tags: List[str]):
+        count = await self._gelbooru._cached_count(tags)
+        if not count:
+            return
+
+        posts = await self._gelbooru._random_page(tags, count, limit=self.page_size)
+        shuffle(posts)
+
+        pool = self._pool(key)
+        known = {post.id for post in pool}
+        pool.extend(post for post in posts if post.id not in known)
+
+
+_CREDENTIAL_ARGS = ('api_key', 'user_id')
+_ORDERING_TAGS = ('sort:', 'order:', 'id:')
+_PAGE_LIMIT = 100
+_TRANSIENT_STATUS = frozenset((429, 500, 502, 503, 504, 520, 521, 522, 524))
+_BACKOFF_BASE = 0.5
+_BACKOFF_CAP = 8.0
+
+
+def _request_key(url: str) -> str:
+    """
+    Identify a request by its URL with the credentials removed
+    """
+    parts = urlparse(url)
+    if not parts.query:
+        return url
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in _CREDENTIAL_ARGS]
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+
+def _untimed(stage: str) -> ContextManager:
+    return contextlib.nullcontext()
+
+
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Seconds to wait from a Retry-After header, given either as delta-seconds or as an HTTP date
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _flag(value) -> bool:
+    """
+    Convert a 'true'/'false' string (XML) or a bool (JSON) to a bool
+    """
+    if isinstance(value, str):
+        return value.lower() == 'true'
+    return bool(value)
 
 
 def _datetime(date: str, format='%a %b %d %H:%M:%S %z %Y') -> Optional[datetime]:
@@ -259,5 +1894,5 @@ def _datetime(date: str, format='%a %b %d %H:%M:%S %z %Y') -> Optional[datetime]
     """
     try:
         return datetime.strptime(date, format)
-    except ValueError:
+    except (TypeError, ValueError):
         return None
@@ -0,0 +1,358 @@
+"""
+Tag co-occurrence model, for prompts synthesized locally instead of copied from a fetched post.
+
+Every page search_posts returns is counted into a sparse, symmetric co-occurrence matrix: the
+number of posts carrying each tag and each pair of tags. The matrix is kept in COO form sorted by
+row (int64 keys `row << 32 | col` and int32 counts), so a row is one binary search and a slice.
+New pairs are buffered and merged in bulk, and when the matrix grows past `max_pairs` entries the
+rarest pairs are dropped. Ratings are counted as the pseudo tags `rating:<value>` so a query can be
+conditioned on them, but they never show up in a synthesized prompt.
+
+A prompt for an include/exclude query is sampled one tag at a time. A tag's weight starts as its
+post count, is multiplied by P(include tag | tag) for every include tag and by
+1 - P(exclude tag | tag) for every exclude tag, and after each pick by `smoothing` + P(pick | tag),
+so later tags agree with the earlier ones. The number of tags follows the tag counts of the
+observed posts.
+
+The model is saved to an .npz file (cache/cooc.npz in the extension), with the ids of the posts
+already counted in a GelRecent.RecentPosts filter next to it, so pages fetched again are not
+counted twice.
+"""
+import contextlib
+import os
+import threading
+import time
+from typing import *
+
+import numpy as np
+
+from scripts.GelRecent import RecentPosts
+from scripts.GelTags import normalize_tag
+
+COOC_VERSION = 1
+
+_RATING = 'rating:'
+_COL_MASK = (1 << 32) - 1
+_MAX_LENGTH = 256
+
+
+class CoocModel:
+    """
+    Incremental tag co-occurrence counts and a sampler of tag sets
+    """
+
+    def __init__(self, path: Optional[str] = None,
+                 max_pairs: int = 4000000,
+                 merge_every: int = 500000,
+                 save_interval: float = 300.0,
+                 min_posts: int = 200,
+                 min_seed_posts: int = 10,
+                 smoothing: float = 0.05):
+        """
+        Args:
+            path (str): .npz file the model is loaded from and saved to, memory only if omitted
+            max_pairs (int): Matrix entries kept (both halves, 12 bytes each), the rarest pairs are dropped beyond it
+            merge_every (int): Buffered pair entries that trigger a merge into the matrix
+            save_interval (float): Minimum seconds between two saves after a merge, in a background thread
+            min_posts (int): Posts to observe before synthesize() answers at all
+            min_seed_posts (int): Posts an include tag must have been seen on to be used as a condition
+            smoothing (float): Weight kept by tags never seen together with an already picked tag
+        """
+        self.path = path
+        self.max_pairs = max_pairs
+        self.merge_every = merge_every
+        self.save_interval = save_interval
+        self.min_posts = min_posts
+        self.min_seed_posts = min_seed_posts
+        self.smoothing = smoothing
+        self._lock = threading.RLock()
+        self._rng = np.random.default_rng()
+        self._names = []                                # type: List[str]
+        self._ids = {}                                  # type: Dict[str, int]
+        self._tag_counts = np.zeros(1024, dtype=np.int64)
+        self._lengths = np.zeros(_MAX_LENGTH + 1, dtype=np.int64)
+        self._keys = np.empty(0, dtype=np.int64)
+        self._counts = np.empty(0, dtype=np.int32)
+        self._pending = []                              # type: List[np.ndarray]
+        self._pending_size = 0
+        self._posts = 0
+        self._hidden = np.zeros(0, dtype=bool)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._saving = None                             # type: Optional[threading.Thread]
+        self._seen = RecentPosts(path + '.posts' if path else None, capacity=200000)
+        if path:
+            self.load()
+
+    def __len__(self) -> int:
+        """
+        Number of distinct tags
+        """
+        return len(self._names)
+
+    @property
+    def posts(self) -> int:
+        """
+        Number of posts counted
+        """
+        return self._posts
+
+    @property
+    def pairs(self) -> int:
+        """
+        Number of matrix entries, not counting buffered ones
+        """
+        return len(self._keys)
+
+    def count(self, tag: str) -> int:
+        i = self._ids.get(normalize_tag(tag))
+        return int(self._tag_counts[i]) if i is not None else 0
+
+    def observe(self, posts: Iterable) -> int:
+        """
+        Count the tags of posts not counted before. Suitable as a Gelbooru post hook
+        Args:
+            posts (list of GelbooruImage): Posts as returned by search_posts
+        Returns:
+            int: Number of posts counted
+        """
+        added = 0
+        with self._lock:
+            for post in posts:
+                post_id = getattr(post, 'id', 0)
+                if not post_id or self._seen.seen('', post_id):
+                    continue
+                self._seen.add('', post_id)
+                tags = set(post.get_tags())
+                self._lengths[min(len(tags), _MAX_LENGTH)] += 1
+                rating = getattr(post, 'rating', None)
+                if rating:
+                    tags.add(_RATING + rating)
+                ids = np.fromiter(map(self._id, tags), dtype=np.int64, count=len(tags))
+                self._tag_counts[ids] += 1
+                if len(ids) > 1:
+                    keys = (ids[:, None] << 32 | ids[None, :]).ravel()
+                    keys = keys[np.repeat(ids, len(ids)) != np.tile(ids, len(ids))]
+                    self._pending.append(keys)
+                    self._pending_size += len(keys)
+                self._posts += 1
+                added += 1
+            if added:
+                self._dirty = True
+            if self._pending_size >= self.merge_every:
+                self._merge()
+                if self.path and time.monotonic() - self._saved_at >= self.save_interval:
+                    self.save(background=True)
+        return added
+
+    def synthesize(self, include: Sequence[str] = (), exclude: Sequence[str] = (),
+                   length: Optional[int] = None) -> Optional[List[str]]:
+        """
+        Sample a tag set for a query, as Gelbooru would tag a post (sorted, underscores)
+        Args:
+            include (list of str): Tags the set is conditioned on, they are part of the result (ratings excepted)
+            exclude (list of str): Tags never returned, tags often seen with them are unlikely
+            length (int): Number of tags, drawn from the observed posts if omitted
+        Returns:
+            list of str or None: None when the model does not know the query well enough yet: fewer than
+                `min_posts` posts observed, or an include tag seen on fewer than `min_seed_posts` posts
+                (including tags the model cannot know, like score:>10)
+        """
+        with self._lock:
+            if self._pending:
+                self._merge()
+            if self._posts < self.min_posts:
+                return None
+            size = len(self._names)
+            counts = self._tag_counts[:size].astype(np.float64)
+            denominator = np.maximum(counts, 1.0)
+            weights = counts.copy()
+            weights[self._hidden_mask()] = 0.0
+
+            seeds = []
+            for tag in include:
+                i = self._ids.get(normalize_tag(tag))
+                if i is None or counts[i] < self.min_seed_posts:
+                    return None
+                if i not in seeds:
+                    seeds.append(i)
+                    weights *= self._row(i, size) / denominator
+            for tag in exclude:
+                i = self._ids.get(normalize_tag(tag))
+                if i is not None:
+                    weights *= 1.0 - np.minimum(self._row(i, size) / denominator, 1.0)
+                    weights[i] = 0.0
+            weights[seeds] = 0.0
+
+            picked = [self._names[i] for i in seeds if not self._names[i].startswith(_RATING)]
+            if length is None:
+                length = self._draw_length()
+            for _ in range(max(0, length - len(picked))):
+                total = weights.sum()
+                if not total > 0:
+                    break
+                i = int(np.searchsorted(np.cumsum(weights), self._rng.random() * total, side='right'))
+                i = min(i, size - 1)
+                picked.append(self._names[i])
+                weights *= self.smoothing + self._row(i, size) / denominator
+                weights[i] = 0.0
+            return sorted(picked)
+
+    def clear(self):
+        with self._lock:
+            self._names, self._ids = [], {}
+            self._tag_counts = np.zeros(1024, dtype=np.int64)
+            self._lengths = np.zeros(_MAX_LENGTH + 1, dtype=np.int64)
+            self._keys = np.empty(0, dtype=np.int64)
+            self._counts = np.empty(0, dtype=np.int32)
+            self._pending, self._pending_size = [], 0
+            self._posts = 0
+            self._dirty = True
+            self._seen.clear()
+
+    def load(self):
+        """
+        Read the saved model. A missing, damaged or older file leaves the model empty
+        """
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                meta = data['meta']
+                if int(meta[0]) != COOC_VERSION:
+                    return
+                names = data['names'].tolist()
+                tag_counts = data['tag_counts']
+                lengths = data['lengths']
+                keys, counts = data['keys'], data['counts']
+        except (OSError, KeyError, ValueError):
+            return
+        if len(tag_counts) != len(names) or len(lengths) != _MAX_LENGTH + 1 or len(keys) != len(counts):
+            return
+        with self._lock:
+            self._names = names
+            self._ids = {name: i for i, name in enumerate(names)}
+            self._tag_counts = np.zeros(max(1024, 2 * len(names)), dtype=np.int64)
+            self._tag_counts[:len(names)] = tag_counts
+            self._lengths = lengths.astype(np.int64)
+            self._keys, self._counts = keys.astype(np.int64), counts.astype(np.int32)
+            self._posts = int(meta[1])
+            self._dirty = False
+
+    def save(self, background: bool = False):
+        """
+        Write the model if it changed since the last save (atomically, through a temporary file)
+        Args:
+            background (bool): Write in a daemon thread, at most one at a time
+        """
+        if not self.path:
+            return
+        with self._lock:
+            if background and self._saving is not None and self._saving.is_alive():
+                return
+            if self._pending:
+                self._merge()
+            if not self._dirty:
+                return
+            # Merges replace the arrays instead of changing them, so references are a consistent snapshot
+            snapshot = {
+                'meta': np.asarray([COOC_VERSION, self._posts], dtype=np.int64),
+                'names': np.asarray(self._names, dtype=str),
+                'tag_counts': self._tag_counts[:len(self._names)].copy(),
+                'lengths': self._lengths.copy(),
+                'keys': self._keys,
+                'counts': self._counts,
+            }
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        if background:
+            self._saving = threading.Thread(target=self._write, args=(snapshot,), daemon=True)
+            self._saving.start()
+        else:
+            self._write(snapshot)
+
+    def _write(self, snapshot: Dict[str, np.ndarray]):
+        tmp = f'{self.path}.{os.getpid()}.tmp.npz'
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            np.savez(tmp, **snapshot)
+            os.replace(tmp, self.path)
+        except OSError:
+            self._dirty = True
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+        self._seen.save()
+
+    def _id(self, tag: str) -> int:
+        i = self._ids.get(tag)
+        if i is None:
+            i = self._ids[tag] = len(self._names)
+            self._names.append(tag)
+            if i >= len(self._tag_counts):
+                grown = np.zeros(2 * len(self._tag_counts), dtype=np.int64)
+                grown[:len(self._tag_counts)] = self._tag_counts
+                self._tag_counts = grown
+        return i
+
+    def _merge(self):
+        """
+        Fold buffered pairs into the matrix. Only the buffer is sorted, the matrix is already sorted by key
+        """
+        if not self._pending:
+            return
+        new = np.concatenate(self._pending)
+        self._pending, self._pending_size = [], 0
+        new.sort()
+        first = np.empty(len(new), dtype=bool)
+        first[0] = True
+        np.not_equal(new[1:], new[:-1], out=first[1:])
+        starts = np.flatnonzero(first)
+        new, added = new[starts], np.diff(np.append(starts, len(first))).astype(np.int32)
+
+        keys, counts = self._keys, self._counts.copy()
+        at = np.searchsorted(keys, new)
+        known = keys[np.minimum(at, len(keys) - 1)] == new if len(keys) else np.zeros(len(new), dtype=bool)
+        counts[at[known]] += added[known]
+        fresh = ~known
+        keys = np.insert(keys, at[fresh], new[fresh])
+        counts = np.insert(counts, at[fresh], added[fresh])
+        if len(keys) > self.max_pairs:
+            keep = self._strongest(keys, counts)
+            keys, counts = keys[keep], counts[keep]
+        self._keys, self._counts = keys, counts
+
+    def _strongest(self, keys: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        """
+        Mask of the `max_pairs` entries with the highest counts. Entries at the cut-off count are kept in
+        order of their pair (smaller tag id first), so both halves of a pair are kept or dropped together
+        """
+        threshold = np.partition(counts, len(counts) - self.max_pairs)[len(counts) - self.max_pairs]
+        keep = counts > threshold
+        room = self.max_pairs - int(np.count_nonzero(keep))
+        tied = np.flatnonzero(counts == threshold)
+        rows, cols = keys[tied] >> 32, keys[tied] & _COL_MASK
+        pairs = np.minimum(rows, cols) << 32 | np.maximum(rows, cols)
+        order = np.argsort(pairs, kind='stable')
+        if 0 < room < len(order) and pairs[order[room - 1]] == pairs[order[room]]:
+            room -= 1
+        keep[tied[order[:room]]] = True
+        return keep
+
+    def _row(self, i: int, size: int) -> np.ndarray:
+        """
+        Dense row i of the matrix: number of posts carrying tag i and each other tag
+        """
+        lo, hi = np.searchsorted(self._keys, [i << 32, (i + 1) << 32])
+        row = np.zeros(size, dtype=np.float64)
+        row[self._keys[lo:hi] & _COL_MASK] = self._counts[lo:hi]
+        return row
+
+    def _hidden_mask(self) -> np.ndarray:
+        if len(self._hidden) != len(self._names):
+            self._hidden = np.fromiter((name.startswith(_RATING) for name in self._names),
+                                       dtype=bool, count=len(self._names))
+        return self._hidden
+
+    def _draw_length(self) -> int:
+        total = self._lengths.sum()
+        if not total:
+            return 20
+        return int(np.searchsorted(np.cumsum(self._lengths), self._rng.integers(total), side='right'))
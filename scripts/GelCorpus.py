@@ -0,0 +1,416 @@
+"""
+Offline tag corpus with an inverted index.
+
+A corpus is a directory of flat NumPy arrays that are opened memory-mapped, so several WebUI
+processes sampling from the same corpus share one copy through the OS page cache:
+
+    meta.json               format version and sizes
+    ids.npy                 int64[N]    post ids
+    post_offsets.npy        int64[N+1]  slice of post_tags.npy for each post
+    post_tags.npy           int32[...]  tag ids of every post (forward index)
+    posting_offsets.npy     int64[V+1]  slice of postings.npy for each tag
+    postings.npy            int32[...]  sorted post indices of every tag (inverted index)
+    vocab_blob.npy / vocab_offsets.npy  sorted tag names, utf-8
+    urls_blob.npy / urls_offsets.npy    file_url of every post, utf-8
+    md5_blob.npy / md5_offsets.npy      md5 of every post, utf-8
+
+Ratings are indexed as the pseudo tags `rating:<value>` so they can be used in queries,
+but they are not part of the forward index and never show up in the sampled tags.
+"""
+import json
+import os
+import shutil
+import time
+from random import randrange
+from typing import *
+
+import numpy as np
+
+from scripts.Gel import Gelbooru, GelbooruImage, parse_response
+from scripts.GelTags import normalize_tag
+
+CORPUS_VERSION = 1
+
+
+class _StringTable:
+    """
+    Memory-mapped table of utf-8 strings addressed by index
+    """
+
+    def __init__(self, path: str, name: str):
+        self._blob = np.load(os.path.join(path, f'{name}_blob.npy'), mmap_mode='r')
+        self._offsets = np.load(os.path.join(path, f'{name}_offsets.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].tobytes().decode('utf-8')
+
+    def find(self, s: str) -> int:
+        """
+        Binary search in a table written in sorted order
+        Returns:
+            int: Index of the string or -1
+        """
+        key = s.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self._blob[self._offsets[mid]:self._offsets[mid + 1]].tobytes()
+            if value < key:
+                lo = mid + 1
+            elif value > key:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    @staticmethod
+    def write(path: str, name: str, strings: List[str]):
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        np.save(os.path.join(path, f'{name}_blob.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        np.save(os.path.join(path, f'{name}_offsets.npy'), offsets)
+
+
+class CorpusBuilder:
+    """
+    Collects posts and writes them out as a corpus directory
+    """
+
+    def __init__(self):
+        self._posts = {}  # type: Dict[int, Tuple[Tuple[str, ...], str, str, str]]
+
+    def __len__(self):
+        return len(self._posts)
+
+    def add(self, post: Union[GelbooruImage, dict]):
+        """
+        Add a post from the API or a raw payload dict. Later additions of the same ID replace earlier ones.
+        """
+        if not isinstance(post, GelbooruImage):
+            post = GelbooruImage(post, None)
+        if post.id:
+            self._posts[post.id] = (tuple(post.tags), post.rating or '', post.file_url or '', post.hash or '')
+
+    def add_file(self, path: str) -> int:
+        """
+        Import a dump file: saved dapi XML or json=1 pages, a JSON list of posts or JSON lines
+        Returns:
+            int: Number of posts read from the file
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        stripped = data.lstrip()
+        if stripped.startswith(b'<'):
+            posts = list(parse_response(data, Gelbooru.PARSER_EXPAT))
+        else:
+            try:
+                payload = json.loads(data)
+                posts = payload if isinstance(payload, list) else list(parse_response(data, Gelbooru.PARSER_JSON))
+            except ValueError:
+                posts = [json.loads(line) for line in data.splitlines() if line.strip()]
+
+        for post in posts:
+            self.add(post)
+        return len(posts)
+
+    def write(self, path: str):
+        """
+        Write the corpus to `path`, replacing an existing corpus atomically
+        """
+        ids = sorted(self._posts)
+        vocab = set()
+        for tags, rating, _, _ in self._posts.values():
+            vocab.update(tags)
+            if rating:
+                vocab.add('rating:' + rating)
+        vocab = sorted(vocab, key=lambda t: t.encode('utf-8'))
+        tag_ids = {tag: i for i, tag in enumerate(vocab)}
+
+        # Forward index, in post order
+        post_offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        forward = []
+        for i, post_id in enumerate(ids):
+            tags = self._posts[post_id][0]
+            forward.extend(tag_ids[t] for t in tags)
+            post_offsets[i + 1] = len(forward)
+        post_tags = np.asarray(forward, dtype=np.int32)
+
+        # Inverted index: (tag, post) pairs grouped by tag, posts stay sorted within a tag
+        pair_tags = [post_tags]
+        pair_posts = [np.repeat(np.arange(len(ids), dtype=np.int32), np.diff(post_offsets))]
+        rated = [(i, tag_ids['rating:' + self._posts[post_id][1]])
+                 for i, post_id in enumerate(ids) if self._posts[post_id][1]]
+        if rated:
+            pair_posts.append(np.asarray([i for i, _ in rated], dtype=np.int32))
+            pair_tags.append(np.asarray([t for _, t in rated], dtype=np.int32))
+        pair_tags = np.concatenate(pair_tags)
+        pair_posts = np.concatenate(pair_posts)
+        order = np.lexsort((pair_posts, pair_tags))
+        postings = pair_posts[order]
+        posting_offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pair_tags, minlength=len(vocab)), out=posting_offsets[1:])
+
+        tmp = path.rstrip('/\\') + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, 'ids.npy'), np.asarray(ids, dtype=np.int64))
+        np.save(os.path.join(tmp, 'post_offsets.npy'), post_offsets)
+        np.save(os.path.join(tmp, 'post_tags.npy'), post_tags)
+        np.save(os.path.join(tmp, 'posting_offsets.npy'), posting_offsets)
+        np.save(os.path.join(tmp, 'postings.npy'), postings)
+        _StringTable.write(tmp, 'vocab', vocab)
+        _StringTable.write(tmp, 'urls', [self._posts[i][2] for i in ids])
+        _StringTable.write(tmp, 'md5', [self._posts[i][3] for i in ids])
+        with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'version': CORPUS_VERSION, 'posts': len(ids), 'tags': len(vocab), 'created': time.time()}, f)
+
+        old = path.rstrip('/\\') + '.old'
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(path):
+            os.replace(path, old)
+        os.replace(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+
+
+class LocalCorpus:
+    """
+    Read-only, memory-mapped corpus that resolves include/exclude/OR queries with set operations
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): Corpus directory written by CorpusBuilder
+        Raises:
+            FileNotFoundError: If the directory does not hold a corpus
+        """
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != CORPUS_VERSION:
+            raise ValueError(f"Unsupported corpus version: {self.meta.get('version')}")
+
+        def load(name):
+            return np.load(os.path.join(path, name), mmap_mode='r')
+
+        self.path = path
+        self._ids = load('ids.npy')
+        self._post_offsets = load('post_offsets.npy')
+        self._post_tags = load('post_tags.npy')
+        self._posting_offsets = load('posting_offsets.npy')
+        self._postings = load('postings.npy')
+        self._vocab = _StringTable(path, 'vocab')
+        self._urls = _StringTable(path, 'urls')
+        self._md5 = _StringTable(path, 'md5')
+        self._rng = np.random.default_rng()
+        self._posting_cache = {}  # type: Dict[str, np.ndarray]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def postings(self, tag: str) -> np.ndarray:
+        """
+        Returns:
+            numpy.ndarray: Sorted indices of the posts carrying `tag`, empty if the tag is unknown
+        """
+        tag = normalize_tag(tag)
+        posting = self._posting_cache.get(tag)
+        if posting is None:
+            i = self._vocab.find(tag)
+            posting = self._postings[self._posting_offsets[i]:self._posting_offsets[i + 1]] if i >= 0 \
+                else np.empty(0, dtype=np.int32)
+            if len(self._posting_cache) >= 4096:
+                self._posting_cache.clear()
+            self._posting_cache[tag] = posting
+        return posting
+
+    def match(self, include: Optional[List[List[str]]] = None,
+              exclude: Optional[List[str]] = None) -> Optional[np.ndarray]:
+        """
+        Resolve a query to the sorted indices of matching posts
+        Args:
+            include (list of list of str): Groups of tags, a post must carry at least one tag of every group
+            exclude (list of str): Tags a post must not carry
+        Returns:
+            numpy.ndarray or None: None means every post matches (no include groups and no exclusions)
+        """
+        groups, excluded = self._resolve(include, exclude)
+        if groups is None:
+            return np.empty(0, dtype=np.int32)
+
+        if groups:
+            # Materialize the smallest group and filter it by membership in all others
+            groups.sort(key=lambda g: sum(map(len, g)))
+            result = _union(groups[0])
+            for group in groups[1:]:
+                result = result[_member_any(group, result)]
+        elif excluded:
+            result = np.arange(len(self._ids), dtype=np.int32)
+        else:
+            return None
+
+        if excluded:
+            result = result[~_member_any(excluded, result)]
+        return result
+
+    def count(self, include: Optional[List[List[str]]] = None, exclude: Optional[List[str]] = None) -> int:
+        matched = self.match(include, exclude)
+        return len(self._ids) if matched is None else len(matched)
+
+    def sample(self, include: Optional[List[List[str]]] = None,
+               exclude: Optional[List[str]] = None) -> Optional[GelbooruImage]:
+        """
+        Return a uniformly random post matching the query
+        Args:
+            include (list of list of str): Groups of tags, a post must carry at least one tag of every group
+            exclude (list of str): Tags a post must not carry
+        Returns:
+            GelbooruImage or None: Returns None if no posts match
+        """
+        groups, excluded = self._resolve(include, exclude)
+        if groups is None or not len(self._ids):
+            return None
+
+        # Rejection sampling from the smallest group is uniform over the result set and avoids
+        # materializing it. Fall back to an exact match when almost every draw would be rejected.
+        if groups:
+            groups.sort(key=lambda g: sum(map(len, g)))
+            base, others = groups[0], groups[1:]
+        else:
+            base, others = None, []
+
+        for _ in range(self.SAMPLE_ROUNDS):
+            if base is None:
+                draws = self._rng.integers(0, len(self._ids), self.SAMPLE_BATCH).astype(np.int32)
+                accept = np.ones(len(draws), dtype=bool)
+            else:
+                draws, accept = self._draw_union(base)
+            for group in others:
+                accept &= _member_any(group, draws)
+            if excluded:
+                accept &= ~_member_any(excluded, draws)
+            hits = np.flatnonzero(accept)
+            if len(hits):
+                return self.post(int(draws[hits[0]]))
+
+        matched = self.match(include, exclude)
+        if matched is None:
+            return self.post(randrange(len(self._ids)))
+        if not len(matched):
+            return None
+        return self.post(int(matched[randrange(len(matched))]))
+
+    SAMPLE_BATCH = 64
+    SAMPLE_ROUNDS = 4
+
+    def _draw_union(self, postings: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Draw uniformly from the union of several postings.
+        Posts present in k postings are drawn k times as often, so they are accepted with probability 1/k.
+        """
+        sizes = np.cumsum([len(p) for p in postings])
+        picks = self._rng.integers(0, sizes[-1], self.SAMPLE_BATCH)
+        which = np.searchsorted(sizes, picks, side='right')
+        draws = np.empty(len(picks), dtype=np.int32)
+        for i, posting in enumerate(postings):
+            mask = which == i
+            draws[mask] = posting[picks[mask] - (sizes[i - 1] if i else 0)]
+
+        if len(postings) == 1:
+            return draws, np.ones(len(draws), dtype=bool)
+        multiplicity = sum(_member(p, draws).astype(np.int32) for p in postings)
+        return draws, self._rng.random(len(draws)) * multiplicity < 1
+
+    def _resolve(self, include: Optional[List[List[str]]],
+                 exclude: Optional[List[str]]) -> Tuple[Optional[List[List[np.ndarray]]], List[np.ndarray]]:
+        """
+        Look up postings. Groups come back as None if any include group cannot match at all.
+        """
+        groups = []
+        for group in include or []:
+            tags = [t for t in group if t and t.strip()]
+            if not tags:
+                continue
+            postings = [p for p in map(self.postings, tags) if len(p)]
+            if not postings:
+                return None, []
+            groups.append(postings)
+
+        excluded = [p for p in map(self.postings, [t for t in exclude or [] if t and t.strip()]) if len(p)]
+        return groups, excluded
+
+    def post(self, index: int) -> GelbooruImage:
+        start, end = self._post_offsets[index], self._post_offsets[index + 1]
+        tags = ' '.join(self._vocab[int(t)] for t in self._post_tags[start:end])
+        return GelbooruImage({
+            'id': int(self._ids[index]),
+            'tags': tags,
+            'file_url': self._urls[index] or None,
+            'md5': self._md5[index] or None,
+        }, None)
+
+
+def _member(posting: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Vectorized membership test of `values` in a sorted posting list
+    """
+    if not len(posting):
+        return np.zeros(len(values), dtype=bool)
+    idx = np.searchsorted(posting, values)
+    return posting[np.minimum(idx, len(posting) - 1)] == values
+
+
+def _member_any(postings: List[np.ndarray], values: np.ndarray) -> np.ndarray:
+    found = np.zeros(len(values), dtype=bool)
+    for posting in postings:
+        found |= _member(posting, values)
+    return found
+
+
+def _union(postings: List[np.ndarray]) -> np.ndarray:
+    if len(postings) == 1:
+        return np.asarray(postings[0])
+    merged = np.sort(np.concatenate(postings), kind='stable')
+    return merged[np.concatenate(([True], merged[1:] != merged[:-1]))]
+
+
+async def build_from_api(gelbooru: Gelbooru, path: str, *,
+                         tags: Optional[List[str]] = None,
+                         exclude_tags: Optional[List[str]] = None,
+                         pages: int = 50,
+                         page_size: int = 100,
+                         builder: Optional[CorpusBuilder] = None) -> int:
+    """
+    Bulk-page the API with keyset pagination (id:<last) and write the result as a corpus.
+    Keyset pagination is not subject to the API's 20000 offset cap.
+    Args:
+        gelbooru (Gelbooru): Client to fetch pages with
+        path (str): Corpus directory to write
+        tags (list of str): A list of tags to search for
+        exclude_tags (list of str): A list of tags to EXCLUDE from search results
+        pages (int): Maximum number of pages to fetch
+        page_size (int): Posts per page
+        builder (CorpusBuilder): Existing builder to add to, e.g. one pre-filled from dumps
+    Returns:
+        int: Number of posts in the written corpus
+    """
+    builder = builder or CorpusBuilder()
+    last_id = None
+    for _ in range(pages):
+        cursor = [f'id:<{last_id}'] if last_id else []
+        posts = await gelbooru.search_posts(tags=(tags or []) + cursor, exclude_tags=exclude_tags,
+                                            limit=page_size, page=0)
+        if not posts:
+            break
+        for post in posts:
+            builder.add(post)
+        last_id = min(post.id for post in posts)
+        if len(posts) < page_size:
+            break
+
+    builder.write(path)
+    return len(builder)
@@ -0,0 +1,157 @@
+"""
+Content-addressed disk cache for downloaded images.
+
+Files are stored as <root>/<key[:2]>/<key>, keyed by the post's md5 (GelbooruImage.hash).
+Writes go to a temporary file that is atomically renamed into place, so readers in this or any
+other WebUI process never see a partial image. Reads are memory-mapped.
+"""
+import contextlib
+import mmap
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import *
+
+_KEY_RE = re.compile(r'[^0-9A-Za-z_.-]')
+
+
+class ImageCache:
+    """
+    LRU disk cache with a size cap. Recency is tracked in memory and mirrored to the file mtime,
+    so the order survives restarts.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 2 * 1024 ** 3):
+        """
+        Args:
+            root (str): Cache directory
+            max_bytes (int): Total size cap, least recently used files are evicted beyond it
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # type: OrderedDict[str, int]
+        self._size = 0
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._path(_KEY_RE.sub('_', key)))
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @contextlib.contextmanager
+    def open(self, key: str) -> Iterator[Optional[mmap.mmap]]:
+        """
+        Memory-map a cached file
+        Args:
+            key (str): Cache key, normally the post md5
+        Yields:
+            mmap.mmap or None: Read-only map of the file, None on a miss
+        """
+        key = _KEY_RE.sub('_', key)
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self._forget(key)
+            yield None
+            return
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                yield None
+                return
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._touch(key, path, size)
+            try:
+                yield mapped
+            finally:
+                mapped.close()
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Returns:
+            bytes or None: Cached content, None on a miss
+        """
+        with self.open(key) as mapped:
+            return mapped[:] if mapped is not None else None
+
+    def put(self, key: str, data: bytes):
+        """
+        Atomically store `data` under `key` and evict least recently used files beyond the size cap
+        """
+        if not data or self.max_bytes <= 0:
+            return
+        key = _KEY_RE.sub('_', key)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            raise
+
+        with self._lock:
+            self._size -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self._size += len(data)
+        self._evict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def _scan(self):
+        entries = []
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.startswith('.'):
+                    # Leftover temporary file of an interrupted write, younger ones may belong to another process
+                    with contextlib.suppress(OSError):
+                        if time.time() - entry.stat().st_mtime > 3600:
+                            os.remove(entry.path)
+                    continue
+                with contextlib.suppress(OSError):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+
+        with self._lock:
+            for _, key, size in sorted(entries):
+                self._index[key] = size
+                self._size += size
+        self._evict()
+
+    def _touch(self, key: str, path: str, size: int):
+        with self._lock:
+            if key not in self._index:
+                self._size += size
+            self._index[key] = size
+            self._index.move_to_end(key)
+        with contextlib.suppress(OSError):
+            os.utime(path)
+
+    def _forget(self, key: str):
+        with self._lock:
+            self._size -= self._index.pop(key, 0)
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._size <= self.max_bytes or not self._index:
+                    return
+                key, size = self._index.popitem(last=False)
+                self._size -= size
+            with contextlib.suppress(OSError):
+                os.remove(self._path(key))
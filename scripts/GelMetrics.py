@@ -0,0 +1,148 @@
+"""
+Stage latency metrics.
+
+Every timed stage feeds a rolling histogram (the last `window` samples) from which p50/p95/p99
+are read, plus running totals. Metrics can be rendered in the Prometheus text format as a summary:
+
+    gpr_stage_seconds{stage="search",quantile="0.95"} 0.412
+    gpr_stage_seconds_sum{stage="search"} 51.2
+    gpr_stage_seconds_count{stage="search"} 130
+
+Timings observed inside a trace() block are also summed per stage into that trace, which is
+how a single generation collects its own breakdown. The trace follows the context into tasks and
+runtime-loop coroutines started from inside the block.
+"""
+import contextlib
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from typing import *
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+_TRACE = contextvars.ContextVar('gpr_trace', default=None)  # type: contextvars.ContextVar[Optional[Dict[str, float]]]
+
+
+class Histogram:
+    """
+    Rolling window of samples with running count and sum
+    """
+
+    def __init__(self, window: int = 1024):
+        self._samples = deque(maxlen=window)  # type: deque
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self._samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self, qs: Sequence[float] = QUANTILES) -> List[float]:
+        """
+        Nearest-rank quantiles of the window, NaN when empty
+        """
+        samples = sorted(self._samples)
+        if not samples:
+            return [float('nan')] * len(qs)
+        last = len(samples) - 1
+        return [samples[min(last, max(0, int(round(q * last))))] for q in qs]
+
+
+class Metrics:
+    """
+    Registry of stage histograms, safe to use from the WebUI thread and the runtime loop at once
+    """
+
+    def __init__(self, window: int = 1024, prefix: str = 'gpr'):
+        """
+        Args:
+            window (int): Number of recent samples per stage the quantiles are computed over
+            prefix (str): Metric name prefix in the Prometheus output
+        """
+        self.window = window
+        self.prefix = prefix
+        self._histograms = {}  # type: Dict[str, Histogram]
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram(self.window)
+            histogram.observe(seconds)
+        trace = _TRACE.get()
+        if trace is not None:
+            trace[stage] = trace.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """
+        Time the enclosed block (awaits included) as `stage`, whether it succeeds or raises
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns:
+            dict: stage -> {'count', 'sum', 'p50', 'p95', 'p99'}
+        """
+        with self._lock:
+            result = {}
+            for stage, histogram in sorted(self._histograms.items()):
+                p50, p95, p99 = histogram.quantiles()
+                result[stage] = {'count': histogram.count, 'sum': histogram.sum, 'p50': p50, 'p95': p95, 'p99': p99}
+            return result
+
+    def prometheus(self) -> str:
+        name = f'{self.prefix}_stage_seconds'
+        lines = [f'# HELP {name} Latency of each stage over the last {self.window} samples',
+                 f'# TYPE {name} summary']
+        with self._lock:
+            for stage, histogram in sorted(self._histograms.items()):
+                label = stage.replace('\\', '\\\\').replace('"', '\\"')
+                for q, value in zip(QUANTILES, histogram.quantiles()):
+                    lines.append(f'{name}{{stage="{label}",quantile="{q:g}"}} {value:.6f}')
+                lines.append(f'{name}_sum{{stage="{label}"}} {histogram.sum:.6f}')
+                lines.append(f'{name}_count{{stage="{label}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        """
+        Atomically write the Prometheus text to `path`, e.g. for node_exporter's textfile collector
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+@contextlib.contextmanager
+def trace() -> Iterator[Dict[str, float]]:
+    """
+    Collect the stage timings observed in this context into a dict of stage -> total seconds
+    """
+    timings = {}  # type: Dict[str, float]
+    token = _TRACE.set(timings)
+    try:
+        yield timings
+    finally:
+        _TRACE.reset(token)
+
+
+def format_trace(timings: Dict[str, float]) -> str:
+    """
+    "search=120ms parse=3ms" in the order the stages were first seen, safe for infotext (no commas)
+    """
+    return ' '.join(f'{stage}={seconds * 1000:.0f}ms' for stage, seconds in timings.items())
@@ -0,0 +1,214 @@
+"""
+Template engine for the Include/Exclude fields.
+
+A field is a comma separated list of terms. Spaces are removed, as the fields always did.
+A term is a tag, optionally containing OR groups:
+
+    1girl, {blue|red|green::3}_hair, {smile|open_mouth}, -monochrome
+
+    {a|b|c}     one of the alternatives; `alt::3` weights an alternative (default 1)
+    (a|b)       legacy spelling of an OR group, only when it contains a `|` so that tags like
+                hatsune_miku_(cosplay) keep their parentheses
+
+Templates are parsed once and cached per input string. QueryPlanner picks the combination of
+alternatives to search for, optionally looking at the (cached) post count of every combination
+first so that no request is spent on a combination without posts.
+"""
+import asyncio
+import functools
+import random
+import re
+from itertools import product
+from typing import *
+
+# Sampling modes of QueryPlanner
+SAMPLING_UNIFORM = 'uniform'              # pick alternatives by weight alone, without counting
+SAMPLING_NONEMPTY = 'nonempty'            # by weight, over combinations that have posts
+SAMPLING_PROPORTIONAL = 'proportional'    # by weight times post count, i.e. uniform over the matching posts
+SAMPLING_MODES = (SAMPLING_UNIFORM, SAMPLING_NONEMPTY, SAMPLING_PROPORTIONAL)
+
+_GROUP_RE = re.compile(r'\{([^{}]*)\}|\(([^()]*\|[^()]*)\)')
+_WEIGHT_RE = re.compile(r'^(.*?)::(\d+(?:\.\d*)?|\.\d+)$')
+
+
+class Group:
+    """
+    One OR group: alternatives with their weights
+    """
+    __slots__ = ('alternatives', 'weights')
+
+    def __init__(self, alternatives: Tuple[str, ...], weights: Tuple[float, ...]):
+        self.alternatives = alternatives
+        self.weights = weights
+
+    def __repr__(self):
+        return '{' + '|'.join(f'{a}::{w:g}' if w != 1 else a for a, w in zip(self.alternatives, self.weights)) + '}'
+
+
+class Template:
+    """
+    A parsed field. Every term is a tuple of literal strings and Groups that are concatenated
+    """
+
+    def __init__(self, terms: List[Tuple[Union[str, Group], ...]]):
+        self.terms = terms
+        self.groups = [part for term in terms for part in term if isinstance(part, Group)]
+
+    def __repr__(self):
+        return ', '.join(''.join(map(str, term)) for term in self.terms)
+
+    @property
+    def combinations(self) -> int:
+        n = 1
+        for group in self.groups:
+            n *= len(group.alternatives)
+        return n
+
+    def expand(self, choice: Sequence[int]) -> List[str]:
+        """
+        Args:
+            choice (list of int): Index of the alternative taken in every group, in order
+        Returns:
+            list of str: The tags of that combination
+        """
+        tags, picks = [], iter(choice)
+        for term in self.terms:
+            tag = ''.join(part if isinstance(part, str) else part.alternatives[next(picks)] for part in term)
+            if tag:
+                tags.append(tag)
+        return tags
+
+    def weight(self, choice: Sequence[int]) -> float:
+        w = 1.0
+        for group, i in zip(self.groups, choice):
+            w *= group.weights[i]
+        return w
+
+    def choices(self) -> Iterator[Tuple[int, ...]]:
+        return product(*(range(len(group.alternatives)) for group in self.groups))
+
+    def sample(self, rng: random.Random = random) -> List[str]:
+        """
+        Pick every group's alternative by weight alone
+        """
+        return self.expand([_weighted_index(group.weights, rng) for group in self.groups])
+
+    def alternatives(self) -> List[List[str]]:
+        """
+        Every term as the list of tags it can expand to, e.g. for the local corpus which matches OR groups directly.
+        Weights are dropped.
+        """
+        result = []
+        for term in self.terms:
+            single = Template([term])
+            options = dict.fromkeys(tags[0] for tags in map(single.expand, single.choices()) if tags)
+            if options:
+                result.append(list(options))
+        return result
+
+
+@functools.lru_cache(maxsize=256)
+def compile_template(text: Optional[str]) -> Template:
+    """
+    Parse an Include/Exclude field. Results are cached per input string, treat them as read-only
+    """
+    terms = []
+    for raw in (text or '').replace(' ', '').split(','):
+        if not raw:
+            continue
+        term, pos = [], 0
+        for match in _GROUP_RE.finditer(raw):
+            if match.start() > pos:
+                term.append(raw[pos:match.start()])
+            group = _parse_group(match.group(1) if match.group(1) is not None else match.group(2))
+            if group is not None:
+                term.append(group)
+            pos = match.end()
+        if pos < len(raw):
+            term.append(raw[pos:])
+        if term:
+            terms.append(tuple(term))
+    return Template(terms)
+
+
+def _parse_group(body: str) -> Optional[Group]:
+    alternatives, weights = [], []
+    for alt in body.split('|'):
+        weight = 1.0
+        match = _WEIGHT_RE.match(alt)
+        if match:
+            alt, weight = match.group(1), float(match.group(2))
+        if alt and weight > 0:
+            alternatives.append(alt)
+            weights.append(weight)
+    return Group(tuple(alternatives), tuple(weights)) if alternatives else None
+
+
+def _weighted_index(weights: Sequence[float], rng: random.Random = random) -> int:
+    return rng.choices(range(len(weights)), weights=weights)[0]
+
+
+class QueryPlanner:
+    """
+    Chooses which combination of a template's alternatives to search for
+    """
+
+    def __init__(self, count: Callable[[List[str]], Awaitable[int]],
+                 mode: str = SAMPLING_PROPORTIONAL,
+                 max_combinations: int = 32,
+                 rng: random.Random = random):
+        """
+        Args:
+            count (callable): Coroutine function returning the post count of a list of tags.
+                It should be backed by a count cache, every combination is counted once per plan
+            mode (str): SAMPLING_UNIFORM, SAMPLING_NONEMPTY or SAMPLING_PROPORTIONAL
+            max_combinations (int): Templates with more combinations are planned term by term,
+                counting each term's alternatives together with the template's fixed tags only
+        """
+        if mode not in SAMPLING_MODES:
+            raise ValueError(f"Unknown sampling mode: {mode}")
+        self.count = count
+        self.mode = mode
+        self.max_combinations = max_combinations
+        self.rng = rng
+
+    async def choose(self, template: Template) -> Optional[List[str]]:
+        """
+        Returns:
+            list of str or None: Tags to search for, None when every combination is known to have no posts
+        """
+        if not template.groups or self.mode == SAMPLING_UNIFORM:
+            return template.sample(self.rng)
+        if template.combinations <= self.max_combinations:
+            return await self._choose_joint(template)
+        return await self._choose_per_term(template)
+
+    async def _choose_joint(self, template: Template) -> Optional[List[str]]:
+        choices = list(template.choices())
+        counts = await asyncio.gather(*(self.count(template.expand(choice)) for choice in choices))
+        weights = [template.weight(choice) * self._mass(count) for choice, count in zip(choices, counts)]
+        if not any(weights):
+            return None
+        return template.expand(choices[_weighted_index(weights, self.rng)])
+
+    async def _choose_per_term(self, template: Template) -> Optional[List[str]]:
+        # Too many combinations to count them all: plan every term on its own next to the fixed terms
+        # (the other terms' groups left out), which still rules out alternatives that have no posts at all
+        fixed = Template([term for term in template.terms if all(isinstance(part, str) for part in term)]).expand(())
+        choice = []
+        for term in template.terms:
+            single = Template([term])
+            if not single.groups:
+                continue
+            options = list(single.choices())
+            counts = await asyncio.gather(*(self.count(fixed + single.expand(option)) for option in options))
+            weights = [single.weight(option) * self._mass(count) for option, count in zip(options, counts)]
+            if not any(weights):
+                return None
+            choice.extend(options[_weighted_index(weights, self.rng)])
+        return template.expand(choice)
+
+    def _mass(self, count: int) -> float:
+        if self.mode == SAMPLING_PROPORTIONAL:
+            return float(max(0, count or 0))
+        return 1.0 if count else 0.0
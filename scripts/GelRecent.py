@@ -0,0 +1,192 @@
+"""
+Fixed-size memory of recently used posts per query, so long runs do not hand out the same post twice.
+
+A rotating Bloom filter over (query key, post id) pairs: two generations of `capacity` entries each,
+new pairs go into the current one and when it is full the older one is dropped. A pair is
+remembered for at least `capacity` and at most 2 * `capacity` later additions, across all queries,
+and memory stays at two bit arrays whatever the number of queries or posts. A false positive only
+means a post is skipped as if it had been used (`error_rate` of the time).
+
+The filter is saved to a small binary file (list/recent_posts.bloom in the extension), at most
+every `save_interval` seconds while it changes. Several processes may share the file (WebUI
+instances and the GelSidecar). Every rotation advances an epoch stored in the file, and a save
+merges the saved filter into this one before writing: generations of the same epoch are ORed, a
+file one rotation ahead is adopted with this process's current generation as its previous one, and
+generations older than the in-memory previous one are never brought back. Posts another process
+remembered are kept, and this process learns them too, without undoing any rotation.
+"""
+import contextlib
+import hashlib
+import math
+import os
+import struct
+import threading
+import time
+from typing import *
+
+_MAGIC = b'GPRB2'
+_HEADER = struct.Struct('<5sIIIIQ')  # magic, capacity, bits, hashes, count in the current generation, epoch
+
+
+class RecentPosts:
+    """
+    Rotating Bloom filter of (query, post id) pairs
+    """
+
+    def __init__(self, path: Optional[str] = None, capacity: int = 50000, error_rate: float = 0.01,
+                 save_interval: float = 30.0):
+        """
+        Args:
+            path (str): File the filter is loaded from and saved to, memory only if omitted
+            capacity (int): Pairs per generation
+            error_rate (float): False positive rate of a full generation
+            save_interval (float): Minimum seconds between two saves
+        """
+        self.path = path
+        self.capacity = max(1, capacity)
+        self.bits = max(64, int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / self.capacity * math.log(2))))
+        self.save_interval = save_interval
+        self._size = (self.bits + 7) // 8
+        self._current = bytearray(self._size)
+        self._previous = bytearray(self._size)
+        self._count = 0
+        self._epoch = 0
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._lock = threading.Lock()
+        if path:
+            self.load()
+
+    def __contains__(self, pair: Tuple[str, int]) -> bool:
+        return self.seen(*pair)
+
+    def seen(self, query: str, post_id: int) -> bool:
+        positions = self._positions(query, post_id)
+        return self._test(self._current, positions) or self._test(self._previous, positions)
+
+    def add(self, query: str, post_id: int):
+        positions = self._positions(query, post_id)
+        with self._lock:
+            if self._test(self._current, positions):
+                return
+            if self._count >= self.capacity:
+                self._previous, self._current = self._current, bytearray(self._size)
+                self._count = 0
+                self._epoch += 1
+            current = self._current
+            for position in positions:
+                current[position >> 3] |= 1 << (position & 7)
+            self._count += 1
+            self._dirty = True
+        if self.path and time.monotonic() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def clear(self):
+        with self._lock:
+            self._current = bytearray(self._size)
+            self._previous = bytearray(self._size)
+            self._count = 0
+            self._dirty = True
+
+    def load(self):
+        """
+        Read the saved filter. A missing, damaged or differently sized file leaves the filter empty
+        """
+        saved = self._read()
+        if saved is None:
+            return
+        with self._lock:
+            self._current, self._previous, self._count, self._epoch = saved
+            self._dirty = False
+
+    def save(self):
+        """
+        Write the filter if it changed since the last save (atomically, through a temporary file)
+        """
+        if not self.path or not self._dirty:
+            return
+        saved = self._read()
+        with self._lock:
+            if not self._dirty:
+                return
+            if saved is not None:
+                self._merge(*saved)
+            data = _HEADER.pack(_MAGIC, self.capacity, self.bits, self.hashes, self._count, self._epoch) \
+                + bytes(self._current) + bytes(self._previous)
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError:
+            self._dirty = True
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+
+    def _merge(self, current: bytearray, previous: bytearray, count: int, epoch: int):
+        """
+        Merge saved generations of the given epoch into this filter. Must be called with the lock held
+        """
+        if epoch == self._epoch:
+            self._current = _union(self._current, current)
+            self._previous = _union(self._previous, previous)
+            self._count = max(self._count, count, self._estimate(self._current))
+        elif epoch == self._epoch + 1:
+            # The other process rotated once more: our current generation is its previous one
+            self._previous = _union(self._current, previous)
+            self._current = current
+            self._count = count
+            self._epoch = epoch
+        elif epoch == self._epoch - 1:
+            # We rotated once more: the saved current generation is our previous one, its previous is dropped
+            self._previous = _union(self._previous, current)
+        elif epoch > self._epoch:
+            self._current, self._previous, self._count, self._epoch = current, previous, count, epoch
+        self._count = min(self._count, self.capacity)
+
+    def _estimate(self, array: bytearray) -> int:
+        """
+        Number of pairs in a generation estimated from its set bits (Swamidass-Baldi)
+        """
+        ones = bin(int.from_bytes(array, 'little')).count('1')
+        if ones >= self.bits:
+            return self.capacity
+        return int(round(-self.bits / self.hashes * math.log(1 - ones / self.bits)))
+
+    def _read(self) -> Optional[Tuple[bytearray, bytearray, int, int]]:
+        """
+        The saved generations, count and epoch, None if the file is missing, damaged or of other parameters
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) != _HEADER.size + 2 * self._size:
+            return None
+        magic, capacity, bits, hashes, count, epoch = _HEADER.unpack_from(data)
+        if (magic, capacity, bits, hashes) != (_MAGIC, self.capacity, self.bits, self.hashes):
+            return None
+        offset = _HEADER.size
+        return (bytearray(data[offset:offset + self._size]), bytearray(data[offset + self._size:]),
+                min(count, self.capacity), epoch)
+
+    def _positions(self, query: str, post_id: int) -> List[int]:
+        # Double hashing (Kirsch-Mitzenmacher): k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(f'{query}\0{post_id}'.encode(), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        h2 |= 1
+        bits = self.bits
+        return [(h1 + i * h2) % bits for i in range(self.hashes)]
+
+    @staticmethod
+    def _test(array: bytearray, positions: List[int]) -> bool:
+        return all(array[position >> 3] & (1 << (position & 7)) for position in positions)
+
+
+def _union(a: bytearray, b: bytearray) -> bytearray:
+    return bytearray((int.from_bytes(a, 'little') | int.from_bytes(b, 'little')).to_bytes(len(a), 'little'))
@@ -0,0 +1,179 @@
+"""
+On-disk cache of API responses, for Gelbooru(response_cache=...).
+
+Bodies are stored zlib-compressed in one SQLite database (WAL mode, so several WebUI processes
+can share it), keyed by the request URL without credentials. Every entry belongs to an endpoint
+kind with its own TTL:
+
+    post      get_post / get_posts by id      metadata rarely changes
+    search    search_posts / random_post pages
+    count     limit=1 count queries           counts move as posts are uploaded
+    tag       tag lookups
+
+Expired entries are kept for `max_stale` seconds so they can be revalidated with
+If-None-Match / If-Modified-Since when the server sent an ETag or Last-Modified; a 304 makes them
+fresh again without a download. Least recently used entries are evicted beyond the size cap.
+"""
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import *
+
+DEFAULT_TTLS = {
+    'post': 86400.0,
+    'search': 3600.0,
+    'count': 600.0,
+    'tag': 7 * 86400.0,
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    body BLOB NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    stored_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at);
+"""
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fresh: bool
+
+    def validators(self) -> Dict[str, str]:
+        """
+        Conditional request headers for revalidating this entry
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    SQLite response store with per-kind TTLs and an LRU size cap
+    """
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 ** 2,
+                 ttls: Optional[Dict[str, float]] = None,
+                 default_ttl: float = 600.0,
+                 max_stale: float = 7 * 86400.0,
+                 level: int = 6):
+        """
+        Args:
+            path (str): Database file
+            max_bytes (int): Cap on the total compressed size, least recently used entries are evicted beyond it
+            ttls (dict): Seconds an entry stays fresh per endpoint kind, merged over DEFAULT_TTLS
+            default_ttl (float): TTL of kinds not listed
+            max_stale (float): Seconds past the TTL an entry is kept for revalidation
+            level (int): zlib compression level
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.max_stale = max_stale
+        self.level = level
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(_SCHEMA)
+            self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def ttl(self, kind: str) -> float:
+        return self.ttls.get(kind, self.default_ttl)
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """
+        Returns:
+            CachedResponse or None: None on a miss or when the entry is past revalidation
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT kind, body, etag, last_modified, stored_at FROM responses WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                return None
+            kind, body, etag, last_modified, stored_at = row
+            age = now - stored_at
+            if age > self.ttl(kind) + self.max_stale:
+                self._delete(key)
+                return None
+            self._db.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+        try:
+            body = zlib.decompress(body)
+        except zlib.error:
+            self.discard(key)
+            return None
+        return CachedResponse(body, etag, last_modified, age <= self.ttl(kind))
+
+    def put(self, key: str, kind: str, body: bytes,
+            etag: Optional[str] = None, last_modified: Optional[str] = None):
+        if self.max_bytes <= 0:
+            return
+        blob = zlib.compress(body, self.level)
+        now = time.time()
+        with self._lock:
+            old = self._db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (key, kind, blob, etag, last_modified, now, now, len(blob)))
+            self._size += len(blob) - (old[0] if old else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def revalidated(self, key: str):
+        """
+        Mark an entry fresh again after a 304 Not Modified
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?', (now, now, key))
+
+    def discard(self, key: str):
+        with self._lock:
+            self._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+            self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _delete(self, key: str):
+        row = self._db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        if row:
+            self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self._size -= row[0]
+
+    def _evict(self):
+        # Drop the least recently used entries down to 90% of the cap, so eviction does not run on every put
+        target = self.max_bytes * 0.9
+        doomed = []
+        for key, size in self._db.execute('SELECT key, size FROM responses ORDER BY accessed_at'):
+            if self._size <= target:
+                break
+            doomed.append((key,))
+            self._size -= size
+        self._db.executemany('DELETE FROM responses WHERE key = ?', doomed)
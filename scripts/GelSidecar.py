@@ -0,0 +1,352 @@
+"""
+Sidecar process owning the Gelbooru client for several WebUI processes on one machine.
+
+Without it every WebUI instance keeps its own connection pool, post count cache, reservoir and rate
+budget, and hits Gelbooru on its own. With the sidecar running, the instances send their searches
+to it over a Unix socket and it answers from one set of caches behind one rate limiter and circuit
+breaker. Tag post-processing (removal list, categories) stays in the WebUI processes, which share
+the removal list, tag database and image cache through files already. The recently used posts
+filter and the count cache file are merged on save, so a WebUI process saving its own copy (from
+fetching in-process while the sidecar was down) adds to the sidecar's state instead of replacing it.
+
+Protocol: one JSON object per line in both directions. Requests on one connection may be
+pipelined, every answer carries the `id` of its request and answers may come out of order:
+
+    {"id": 1, "op": "post", "tags": [...], "exclude": [...], "api_key": "...", "user_id": "...",
+     "reservoir": true, "no_repeat": true}           -> {"id": 1, "post": {...} or null}
+    {"id": 2, "op": "posts", "n": 8, ...}              -> {"id": 2, "posts": [{...}, ...]}
+    {"id": 3, "op": "peek", ...}                       -> {"id": 3, "post": {...} or null}
+    {"id": 4, "op": "count", ...}                      -> {"id": 4, "count": 1234}
+    {"id": 5, "op": "ping"}                            -> {"id": 5, "pid": 4321, "stats": {...}}
+
+Posts are API payload dicts (GelbooruImage.to_payload). A failed request is answered with
+{"id": ..., "error": "message"}.
+
+Run it with tools/sidecar.py.
+"""
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import time
+from collections import Counter
+from typing import *
+
+from scripts.Gel import (Gelbooru, GelbooruException, GelbooruImage, CountCache, PostReservoir, RateLimiter,
+                         CircuitBreaker, get_runtime)
+
+# A page of 100 posts is about 100 KB of JSON, well above asyncio's 64 KiB line limit
+_LINE_LIMIT = 16 * 1024 ** 2
+
+
+class SidecarUnavailable(GelbooruException):
+    """
+    The sidecar is not running or stopped answering, fetch in-process instead
+    """
+    pass
+
+
+class SidecarError(GelbooruException):
+    """
+    The sidecar answered the request with an error
+    """
+    pass
+
+
+class SidecarServer:
+    """
+    Serves random posts and counts over a Unix socket, one Gelbooru client per account
+    """
+
+    def __init__(self, path: str, *, cache_dir: Optional[str] = None,
+                 api: Optional[str] = None,
+                 rate: float = 8.0,
+                 max_concurrency: int = 4,
+                 max_retries: int = 3,
+                 parser: str = Gelbooru.PARSER_EXPAT,
+                 response_cache_mb: float = 256,
+                 recent_path: Optional[str] = None,
+                 low_water: int = 20):
+        """
+        Args:
+            path (str): Socket path
+            cache_dir (str): Directory of the count cache and response cache, no disk caches if omitted
+            api (str): Gelbooru compatible API endpoint
+            rate (float): Requests per second to the API, shared by every WebUI process
+            max_concurrency (int): Concurrent requests to the API
+            max_retries (int): Retries on 429 / 5xx / connection errors
+            parser (str): Response parser, see Gelbooru.PARSER_*
+            response_cache_mb (float): Size of the response cache in cache_dir, 0 disables it
+            recent_path (str): File of the recently used posts filter for no_repeat requests (GelRecent)
+            low_water (int): Reservoir refill threshold
+        """
+        self.path = path
+        self.cache_dir = cache_dir
+        self.api = api
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.parser = parser
+        self.low_water = low_water
+        self.stats = Counter()
+        self._rate_limiter = RateLimiter(rate=rate)
+        self._breaker = CircuitBreaker()
+        self._count_cache = CountCache(path=os.path.join(cache_dir, 'count_cache.json') if cache_dir else None)
+        self._response_cache = None
+        if cache_dir and response_cache_mb > 0:
+            from scripts.GelResponseCache import ResponseCache
+            self._response_cache = ResponseCache(os.path.join(cache_dir, 'responses.sqlite'),
+                                                 max_bytes=int(response_cache_mb * 1024 ** 2))
+        self._recent_path = recent_path
+        self._recent = None
+        self._clients = {}      # type: Dict[Tuple[str, str], Gelbooru]
+        self._reservoirs = {}   # type: Dict[Tuple[str, str], PostReservoir]
+        self._server = None     # type: Optional[asyncio.AbstractServer]
+
+    async def start(self):
+        """
+        Listen on the socket. Must be awaited on the runtime loop. A stale socket file is replaced
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Requests carry API credentials: the socket is created owner-only rather than restricted after bind()
+        umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(self._handle, self.path, limit=_LINE_LIMIT)
+        finally:
+            os.umask(umask)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+        if self._recent is not None:
+            self._recent.save()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stats['connections'] += 1
+        tasks = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ConnectionError, ValueError):
+                    break
+                if not line:
+                    break
+                task = asyncio.get_running_loop().create_task(self._answer(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def _answer(self, line: bytes, writer: asyncio.StreamWriter):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            response = await self._dispatch(request)
+        except Exception as e:
+            self.stats['errors'] += 1
+            response = {'error': str(e) or type(e).__name__}
+        response['id'] = request_id
+        with contextlib.suppress(ConnectionError):
+            writer.write(json.dumps(response, separators=(',', ':')).encode() + b'\n')
+            await writer.drain()
+
+    async def _dispatch(self, request: dict) -> dict:
+        op = request.get('op')
+        self.stats[f'op_{op}'] += 1
+        if op == 'ping':
+            return {'pid': os.getpid(), 'stats': dict(self.stats)}
+
+        key = (request.get('api_key'), request.get('user_id'))
+        gel = self._client(key)
+        tags, exclude = request.get('tags'), request.get('exclude')
+        if op == 'count':
+            return {'count': await gel._cached_count(gel._format_tags(tags, exclude))}
+
+        reservoir = self._reservoir(key, bool(request.get('no_repeat'))) if request.get('reservoir', True) else None
+        if op == 'post':
+            if reservoir is not None:
+                post = await reservoir.take(tags=tags, exclude_tags=exclude)
+            else:
+                post = await gel.random_post(tags=tags, exclude_tags=exclude)
+            return {'post': post.to_payload() if post else None}
+        if op == 'posts':
+            n = max(1, int(request.get('n') or 1))
+            if reservoir is not None:
+                posts = await reservoir.take_many(n, tags=tags, exclude_tags=exclude)
+            else:
+                posts = await gel.random_posts(n, tags=tags, exclude_tags=exclude)
+            return {'posts': [post.to_payload() for post in posts]}
+        if op == 'peek':
+            post = reservoir.peek(tags=tags, exclude_tags=exclude) if reservoir is not None else None
+            return {'post': post.to_payload() if post else None}
+        raise ValueError(f'Unknown op: {op}')
+
+    def _client(self, key: Tuple[str, str]) -> Gelbooru:
+        gel = self._clients.get(key)
+        if gel is None:
+            api_key, user_id = key
+            gel = self._clients[key] = Gelbooru(api_key=api_key, user_id=user_id, api=self.api,
+                                                runtime=get_runtime(), count_cache=self._count_cache,
+                                                parser=self.parser, max_concurrency=self.max_concurrency,
+                                                rate_limiter=self._rate_limiter, circuit_breaker=self._breaker,
+                                                max_retries=self.max_retries, response_cache=self._response_cache)
+        return gel
+
+    def _reservoir(self, key: Tuple[str, str], no_repeat: bool) -> PostReservoir:
+        reservoir = self._reservoirs.get(key)
+        if reservoir is None:
+            reservoir = self._reservoirs[key] = PostReservoir(self._client(key), low_water=self.low_water)
+        if no_repeat and self._recent is None:
+            from scripts.GelRecent import RecentPosts
+            self._recent = RecentPosts(self._recent_path)
+        reservoir.recent = self._recent if no_repeat else None
+        return reservoir
+
+
+class SidecarClient:
+    """
+    Connection to a SidecarServer, shared by all requests of a process and bound to the loop it was first used on.
+    After a failure the sidecar is not tried again for `retry_after` seconds
+    """
+
+    def __init__(self, path: str, timeout: float = 20.0, retry_after: float = 30.0):
+        """
+        Args:
+            path (str): Socket path
+            timeout (float): Seconds to wait for an answer before giving up on the sidecar
+            retry_after (float): Seconds to fall back to in-process fetching after a failure
+        """
+        self.path = path
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._ids = itertools.count(1)
+        self._waiting = {}      # type: Dict[int, asyncio.Future]
+        self._writer = None     # type: Optional[asyncio.StreamWriter]
+        self._reading = None    # type: Optional[asyncio.Task]
+        self._connecting = None  # type: Optional[asyncio.Lock]
+        self._down_until = 0.0
+
+    @property
+    def available(self) -> bool:
+        """
+        False while in the back-off period after a failure
+        """
+        return time.monotonic() >= self._down_until
+
+    async def random_post(self, *, tags: Optional[List[str]] = None,
+                          exclude_tags: Optional[List[str]] = None, **options) -> Optional[GelbooruImage]:
+        """
+        Args:
+            tags (list of str): A list of tags to search for
+            exclude_tags (list of str): A list of tags to EXCLUDE from search results
+            **options: api_key, user_id, reservoir, no_repeat
+        Raises:
+            SidecarUnavailable: The sidecar did not answer
+            SidecarError: The sidecar failed to fetch the post
+        """
+        payload = (await self.request('post', tags=tags, exclude=exclude_tags, **options))['post']
+        return GelbooruImage(payload, None) if payload else None
+
+    async def random_posts(self, n: int, *, tags: Optional[List[str]] = None,
+                           exclude_tags: Optional[List[str]] = None, **options) -> List[GelbooruImage]:
+        response = await self.request('posts', n=n, tags=tags, exclude=exclude_tags, **options)
+        return [GelbooruImage(payload, None) for payload in response['posts']]
+
+    async def peek(self, *, tags: Optional[List[str]] = None,
+                   exclude_tags: Optional[List[str]] = None, **options) -> Optional[GelbooruImage]:
+        """
+        The post the next reservoir take would hand out, see PostReservoir.peek
+        """
+        payload = (await self.request('peek', tags=tags, exclude=exclude_tags, **options))['post']
+        return GelbooruImage(payload, None) if payload else None
+
+    async def count(self, *, tags: Optional[List[str]] = None,
+                    exclude_tags: Optional[List[str]] = None, **options) -> int:
+        return int((await self.request('count', tags=tags, exclude=exclude_tags, **options))['count'])
+
+    async def ping(self) -> dict:
+        return await self.request('ping')
+
+    async def request(self, op: str, **fields) -> dict:
+        """
+        Send one request and wait for its answer
+        Raises:
+            SidecarUnavailable: Not connected and the socket cannot be reached, the connection broke
+                or no answer came within `timeout`
+            SidecarError: The sidecar answered with an error
+        """
+        if not self.available:
+            raise SidecarUnavailable(f'Sidecar at {self.path} is backing off')
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[request_id] = future
+        try:
+            writer = await self._connect()
+            writer.write(json.dumps({'id': request_id, 'op': op, **fields}, separators=(',', ':')).encode() + b'\n')
+            await writer.drain()
+            response = await asyncio.wait_for(future, self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self._fail()
+            raise SidecarUnavailable(f'Sidecar at {self.path}: {e or type(e).__name__}') from e
+        finally:
+            self._waiting.pop(request_id, None)
+        if 'error' in response:
+            raise SidecarError(response['error'])
+        return response
+
+    async def close(self):
+        writer, self._writer = self._writer, None
+        if self._reading is not None:
+            self._reading.cancel()
+        if writer is not None:
+            writer.close()
+            with contextlib.suppress(OSError):
+                await writer.wait_closed()
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        if self._connecting is None:
+            self._connecting = asyncio.Lock()
+        async with self._connecting:
+            if self._writer is None or self._writer.is_closing():
+                if not hasattr(asyncio, 'open_unix_connection'):
+                    raise OSError('Unix sockets are not available on this platform')
+                reader, self._writer = await asyncio.open_unix_connection(self.path, limit=_LINE_LIMIT)
+                self._reading = asyncio.get_running_loop().create_task(self._read(reader))
+            return self._writer
+
+    async def _read(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self._waiting.get(response.get('id'))
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (OSError, ValueError):
+            pass
+        finally:
+            # Everything still waiting lost its answer with the connection
+            self._writer = None
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError('Sidecar closed the connection'))
+
+    def _fail(self):
+        self._down_until = time.monotonic() + self.retry_after
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
@@ -0,0 +1,176 @@
+"""
+Local database of tag categories and post counts, for category rules (artist:*, metadata:*) in the removal list.
+
+Tags are looked up on the dapi tag endpoint (s=tag&names=...), 100 names per request, and kept in
+SQLite (WAL mode) with an in-memory copy, so a category lookup is a dict access. Unknown tags are
+never fetched on the generation path: category() returns None for them and queues the name, and
+fill() resolves the queue later, typically in the background while the reservoir prefetches posts.
+Names the API does not return are stored without a category and asked about again after
+`retry_after` seconds.
+"""
+import html
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from typing import *
+
+# Gelbooru tag "type" numbers. 2 is unused
+TYPE_NAMES = {
+    0: 'general',
+    1: 'artist',
+    3: 'copyright',
+    4: 'character',
+    5: 'metadata',
+    6: 'deprecated',
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    name TEXT PRIMARY KEY,
+    type INTEGER,
+    count INTEGER NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+
+
+class TagDB:
+    """
+    Tag name -> (category, post count), persisted and filled lazily
+    """
+
+    def __init__(self, path: Optional[str] = None,
+                 retry_after: float = 30 * 86400.0,
+                 max_pending: int = 100000):
+        """
+        Args:
+            path (str): Database file, kept in memory only if omitted
+            retry_after (float): Seconds before a name the API did not know is looked up again
+            max_pending (int): Cap on queued unknown names, further names are dropped until fill() catches up
+        """
+        self.path = path
+        self.retry_after = retry_after
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False, isolation_level=None, timeout=5)
+        with self._lock:
+            if path:
+                self._db.execute('PRAGMA journal_mode=WAL')
+                self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(_SCHEMA)
+            self._tags = {name: (type_, count, fetched_at) for name, type_, count, fetched_at
+                          in self._db.execute('SELECT name, type, count, fetched_at FROM tags')}
+        self._pending = {}  # type: Dict[str, None]
+
+    def __len__(self) -> int:
+        return len(self._tags)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tags
+
+    @property
+    def pending(self) -> int:
+        """
+        Number of names waiting for fill()
+        """
+        return len(self._pending)
+
+    def category(self, name: str) -> Optional[str]:
+        """
+        Category name of a tag (one of GelTags.CATEGORIES), or None if it is not known yet.
+        Unknown names are queued for the next fill()
+        """
+        entry = self._tags.get(name)
+        if entry is None or (entry[0] is None and time.time() - entry[2] > self.retry_after):
+            self._queue(name)
+            return None
+        return TYPE_NAMES.get(entry[0])
+
+    def count(self, name: str) -> Optional[int]:
+        entry = self._tags.get(name)
+        return entry[1] if entry is not None and entry[0] is not None else None
+
+    def observe(self, names: Iterable[str]) -> int:
+        """
+        Queue the names that are not in the database yet, e.g. every tag of a freshly fetched page of posts
+        Returns:
+            int: Number of names waiting for fill()
+        """
+        tags = self._tags
+        for name in names:
+            if name not in tags:
+                self._queue(name)
+        return len(self._pending)
+
+    def add(self, items: Iterable[dict], requested: Iterable[str] = ()):
+        """
+        Store tag items as returned by the tag endpoint. Requested names missing from `items` are stored
+        without a category
+        """
+        now = time.time()
+        rows = {}
+        # The API returns some names HTML-escaped (&#039;), store them under the name that was asked for
+        spelled = {}
+        for name in requested:
+            rows[name] = (name, None, 0, now)
+            spelled[html.unescape(name)] = name
+        for item in items:
+            name = item.get('name')
+            if not name:
+                continue
+            name = spelled.get(html.unescape(name), name)
+            try:
+                type_ = int(item.get('type', 0) or 0)
+            except (TypeError, ValueError):
+                type_ = 0
+            rows[name] = (name, type_, int(item.get('count', 0) or 0), now)
+        if not rows:
+            return
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?)', rows.values())
+            for name, type_, count, fetched_at in rows.values():
+                self._tags[name] = (type_, count, fetched_at)
+                self._pending.pop(name, None)
+
+    async def fill(self, gel, batch: int = 100, max_batches: Optional[int] = None) -> int:
+        """
+        Look up queued names, `batch` per request, one request at a time so generations keep priority
+        on the shared rate limit. Names of a failed request are queued again and the error is raised
+        Args:
+            gel (Gelbooru): Client to query
+            batch (int): Names per request, at most 100
+            max_batches (int): Stop after this many requests, None drains the queue
+        Returns:
+            int: Number of names resolved
+        """
+        done = 0
+        while self._pending and (max_batches is None or max_batches > 0):
+            with self._lock:
+                chunk = list(itertools.islice(self._pending, batch))
+                for name in chunk:
+                    del self._pending[name]
+            try:
+                items = await gel.get_tags_by_name(chunk, chunk_size=batch)
+            except BaseException:
+                with self._lock:
+                    for name in chunk:
+                        self._pending.setdefault(name, None)
+                raise
+            self.add(items, chunk)
+            done += len(chunk)
+            if max_batches is not None:
+                max_batches -= 1
+        return done
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _queue(self, name: str):
+        if name and len(self._pending) < self.max_pending:
+            with self._lock:
+                self._pending[name] = None
@@ -0,0 +1,162 @@
+"""
+Compiled post-processing of post tags: removal rules and underscore replacement.
+
+Removal rules, one per line or comma separated; lines starting with # are comments:
+
+    watermark           exact tag
+    *_background        wildcard, `*` matches any run of characters (`?` and everything else is literal)
+    /.*_\\(cosplay\\)/    regular expression (the whole line between slashes), matched against the whole tag
+    artist:*            rule on a tag category: artist, character, copyright, metadata, general
+                        or deprecated. Only applies when the transform knows tag categories
+                        (GelTagDB), tags whose category is not known yet are kept
+
+Every rule also removes the tag spelled exactly like it, so lists written for plain tag matching
+keep working: `re:creators` or `!?` still remove those very tags.
+
+All wildcard and regex rules are joined into one alternation, so a tag is checked with a single
+match, and results are memoized per tag, so filtering a batch of posts is one pass of dict lookups.
+"""
+import re
+from typing import *
+
+CATEGORIES = ('general', 'artist', 'copyright', 'character', 'metadata', 'deprecated')
+
+_MEMO_LIMIT = 200000
+
+
+def normalize_tag(s: str) -> str:
+    return s.strip().lower().replace(' ', '_')
+
+
+def _regex_rule(rule: str) -> bool:
+    return len(rule) > 2 and rule.startswith('/') and rule.endswith('/')
+
+
+def parse_rules(text: Optional[str]) -> List[str]:
+    """
+    Split a removal list into normalized rules. /regex/ rules keep their line intact
+    """
+    rules = []
+    for line in (text or '').replace('\r', '\n').split('\n'):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        if _regex_rule(stripped):
+            rules.append(stripped)
+            continue
+        for part in line.split(','):
+            rule = normalize_tag(part)
+            if rule:
+                rules.append(rule)
+    return rules
+
+
+def _category_rule(rule: str) -> bool:
+    head, sep, _ = rule.partition(':')
+    return bool(sep) and head in CATEGORIES
+
+
+def uses_categories(rules: Iterable[str]) -> bool:
+    """
+    Whether any rule needs tag categories (artist:* and the like)
+    """
+    return any(_category_rule(rule) for rule in rules)
+
+
+def keep_categories_rules(keep: Iterable[str]) -> List[str]:
+    """
+    Rules removing every category that is not in `keep`. Keeping all categories needs no rules
+    """
+    keep = set(keep)
+    return [f'{name}:*' for name in CATEGORIES if name not in keep]
+
+
+def _compile(patterns: List[str]) -> Optional[Pattern]:
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{p})' for p in patterns))
+
+
+def _glob(rule: str) -> str:
+    return '.*'.join(map(re.escape, rule.split('*')))
+
+
+class TagTransform:
+    """
+    Removal rules plus underscore replacement, compiled once
+    """
+
+    def __init__(self, rules: Iterable[str] = (),
+                 replace_underscores: bool = True,
+                 keep_underscores: Iterable[str] = (),
+                 category: Optional[Callable[[str], Optional[str]]] = None):
+        """
+        Args:
+            rules (list of str): Removal rules as returned by parse_rules
+            replace_underscores (bool): Turn underscores into spaces in the output
+            keep_underscores (list of str): Tags whose underscores are kept, e.g. emoticons like ^_^
+            category (callable): Returns the category name of a tag or None when unknown.
+                Category rules are ignored without it
+        """
+        self.exact = set()      # type: Set[str]
+        patterns, category_patterns = [], []
+        for rule in rules:
+            # The literal rule always matches, whatever else it does
+            self.exact.add(normalize_tag(rule))
+            if _regex_rule(rule):
+                patterns.append(rule[1:-1])
+            elif _category_rule(rule):
+                head, _, tail = rule.partition(':')
+                category_patterns.append(re.escape(head + ':') + _glob(tail))
+            elif '*' in rule:
+                patterns.append(_glob(rule))
+
+        self.pattern = _compile(patterns)
+        self.category_pattern = _compile(category_patterns) if category is not None else None
+        self.replace_underscores = replace_underscores
+        self.keep_underscores = {tag.strip() for tag in keep_underscores if tag.strip()}
+        self.category = category
+        self._memo = {}  # type: Dict[str, Optional[str]]
+
+    def __call__(self, tags: Iterable[str]) -> List[str]:
+        """
+        Filter and rewrite the tags of one post, as Gelbooru returns them (lowercase, underscores)
+        """
+        memo, out = self._memo, []
+        for tag in tags:
+            try:
+                result = memo[tag]
+            except KeyError:
+                result = self._transform(tag)
+                # Tags of unknown category are decided again once the category is known
+                if self.category_pattern is None or self.category(tag) is not None:
+                    if len(memo) >= _MEMO_LIMIT:
+                        memo.clear()
+                    memo[tag] = result
+            if result:
+                out.append(result)
+        return out
+
+    def apply_many(self, posts_tags: Iterable[Iterable[str]]) -> List[List[str]]:
+        """
+        Transform the tags of several posts (e.g. a page of 100), sharing the memo
+        """
+        return [self(tags) for tags in posts_tags]
+
+    def removes(self, tag: str) -> bool:
+        if not tag or tag in self.exact:
+            return True
+        if self.pattern is not None and self.pattern.fullmatch(tag):
+            return True
+        if self.category_pattern is not None:
+            name = self.category(tag)
+            if name and self.category_pattern.fullmatch(f'{name}:{tag}'):
+                return True
+        return False
+
+    def _transform(self, tag: str) -> Optional[str]:
+        if self.removes(tag):
+            return None
+        if self.replace_underscores and tag not in self.keep_underscores:
+            return tag.replace('_', ' ')
+        return tag
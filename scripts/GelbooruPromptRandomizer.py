@@ -1,54 +1,384 @@
-import contextlib
 import asyncio
-import requests
+import contextlib
 import os
 import io
 import gradio as gr
 import re
-import random
+import time
 
 from modules import scripts, shared, script_callbacks
-from scripts.Gel import Gelbooru
 from modules.processing import StableDiffusionProcessingImg2Img
-from PIL import Image
 
-def _expand_or_pattern_simple(s: str) -> str:
-    if not s:
-        return s
-    pattern = re.compile(r"\(([^()]+)\)")
-    def repl(match):
-        parts = match.group(1).split("|")
-        parts = [p.strip() for p in parts if p.strip()]
-        return random.choice(parts) if parts else ""
-    return pattern.sub(repl, s)
+# WebUI が scripts/ の補助モジュールを先に読み込んでいる場合、ここで計るのはこのスクリプト本体の分だけ
+_STARTUP = {"started": time.perf_counter(), "import_ms": None, "settings_ms": 0.0}
 
+from scripts.Gel import Gelbooru, GelbooruImage, CountCache, PostReservoir, RateLimiter, CircuitBreaker, EndpointPool, get_runtime  # noqa: E402
+from scripts.GelQuery import QueryPlanner, compile_template, SAMPLING_MODES, SAMPLING_PROPORTIONAL  # noqa: E402
+from scripts.GelTags import CATEGORIES, TagTransform, keep_categories_rules, parse_rules, uses_categories  # noqa: E402
+from scripts.GelMetrics import Metrics, trace, format_trace  # noqa: E402
 
 # ==========================================================
-# Utility: async-safe runner
+# Utility: shared runtime / client
+#   - 1プロセスに1つのイベントループスレッドと接続プールを共有
+#   - before_process からは submit で同期的に待つだけ（毎回ループを作らない）
 # ==========================================================
-def _run_async(coro):
+_CLIENTS = {}
+_RESERVOIRS = {}
+_COUNT_CACHE = None
+_RESPONSE_CACHE = None
+# API クライアントは同じホストに投げるので、レート制限とサーキットブレーカーは全員で共有
+_RATE_LIMITER = None
+_BREAKER = CircuitBreaker()
+# 段階ごとのレイテンシ（p50/p95/p99）。/gpr/metrics と cache/metrics.prom で Prometheus 形式に出力
+_METRICS = Metrics()
+_METRICS_WRITE_INTERVAL = 10.0
+_METRICS_WRITTEN = {"at": 0.0}
+
+def _cache_dir() -> str:
+    ext_root = os.path.dirname(os.path.dirname(__file__))
+    cache_dir = os.path.join(ext_root, "cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def _count_cache() -> CountCache:
+    global _COUNT_CACHE
+    if _COUNT_CACHE is None:
+        _COUNT_CACHE = CountCache(path=os.path.join(_cache_dir(), "count_cache.json"))
+    _COUNT_CACHE.ttl = max(0, float(getattr(shared.opts, "gpr_count_cache_ttl", 600) or 0))
+    return _COUNT_CACHE
+
+def _response_cache():
+    """
+    API レスポンスのディスクキャッシュ（cache/responses.sqlite）。gpr_response_cache_mb が 0 なら無効
+    """
+    global _RESPONSE_CACHE
+    max_bytes = int(float(getattr(shared.opts, "gpr_response_cache_mb", 256) or 0) * 1024 * 1024)
+    if max_bytes <= 0:
+        return None
+    if _RESPONSE_CACHE is None:
+        from scripts.GelResponseCache import ResponseCache
+        try:
+            _RESPONSE_CACHE = ResponseCache(os.path.join(_cache_dir(), "responses.sqlite"), max_bytes=max_bytes)
+        except Exception as e:
+            print("[GPR] Response cache unavailable:", e)
+            return None
+    _RESPONSE_CACHE.max_bytes = max_bytes
+    return _RESPONSE_CACHE
+
+def _rate_limiter() -> RateLimiter:
+    global _RATE_LIMITER
+    rate = max(0.5, float(getattr(shared.opts, "gpr_rate_limit", 8) or 8))
+    if _RATE_LIMITER is None:
+        _RATE_LIMITER = RateLimiter(rate=rate)
+    elif _RATE_LIMITER.max_rate != rate:
+        _RATE_LIMITER.configure(rate)
+    return _RATE_LIMITER
+
+_ENDPOINTS = {"key": None, "pool": None}
+
+def _endpoint_pool(api):
+    """
+    gpr_endpoints にミラーがあれば、本体(api)と合わせたヘッジ用プールを返す。なければ None（本体のみ）。
+    設定が変わるまで同じプールを使い回すので、レイテンシの統計はリクエストをまたいで蓄積される
+    """
+    text = getattr(shared.opts, "gpr_endpoints", "") or ""
+    mirrors = [line.strip() for line in text.splitlines() if line.strip() and not line.strip().startswith("#")]
+    key = (api, tuple(mirrors))
+    if _ENDPOINTS["key"] != key:
+        _ENDPOINTS["key"] = key
+        _ENDPOINTS["pool"] = EndpointPool([api] + mirrors) if mirrors else None
+    return _ENDPOINTS["pool"]
+
+def _runtime():
+    return get_runtime(
+        pool_size=max(1, int(getattr(shared.opts, "gpr_pool_size", 8) or 8)),
+        dns_cache_ttl=max(0, int(getattr(shared.opts, "gpr_dns_cache_ttl", 300) or 0)),
+    )
+
+def _gel_client(api_key, user_id) -> Gelbooru:
+    runtime = _runtime()
+    count_cache = _count_cache()
+    parser = getattr(shared.opts, "gpr_response_parser", Gelbooru.PARSER_EXPAT) or Gelbooru.PARSER_EXPAT
+    key = (api_key, user_id)
+    gel = _CLIENTS.get(key)
+    if gel is None or gel._parser != parser:
+        # (None, None) はファイル取得用（CDN 宛て）なので API 用のレート制限は共有しない
+        api_options = {} if key == (None, None) else {"rate_limiter": _rate_limiter(), "circuit_breaker": _BREAKER,
+                                                      "post_hooks": [_observe_posts]}
+        gel = _CLIENTS[key] = Gelbooru(api_key=api_key, user_id=user_id, runtime=runtime,
+                                       count_cache=count_cache, parser=parser, timer=_METRICS.timer, **api_options)
+        _RESERVOIRS.pop(key, None)
+    elif key != (None, None):
+        _rate_limiter()
+    gel.max_concurrency = int(getattr(shared.opts, "gpr_max_concurrency", 4) or 4)
+    gel.max_retries = max(0, int(getattr(shared.opts, "gpr_max_retries", 3) or 0))
+    if key != (None, None):
+        gel._response_cache = _response_cache()
+        gel._endpoints = _endpoint_pool(gel._base_url)
+    return gel
+
+def _reservoir(api_key, user_id) -> PostReservoir:
+    gel = _gel_client(api_key, user_id)
+    key = (api_key, user_id)
+    reservoir = _RESERVOIRS.get(key)
+    if reservoir is None:
+        reservoir = _RESERVOIRS[key] = PostReservoir(gel)
+    reservoir.low_water = max(0, int(getattr(shared.opts, "gpr_reservoir_low_water", 20) or 0))
+    reservoir.recent = _recent_posts() if getattr(shared.opts, "gpr_no_repeat", True) else None
+    return reservoir
+
+_RECENT = None
+
+def _recent_posts():
+    """
+    クエリごとの「最近使った投稿」(固定サイズの Bloom フィルタ)。list/recent_posts.bloom に保存し、
+    Generate Forever を止めて再開しても同じ投稿を引き直さない
+    """
+    global _RECENT
+    if _RECENT is None:
+        import atexit
+        from scripts.GelRecent import RecentPosts
+        list_dir = os.path.dirname(_removal_file_path())
+        _RECENT = RecentPosts(os.path.join(list_dir, "recent_posts.bloom"))
+        atexit.register(_RECENT.save)
+    return _RECENT
+
+def _run_async(coro, timeout=None):
+    return _runtime().submit(coro, timeout)
+
+# ==========================================================
+# Sidecar（同じマシンの複数 WebUI で API クライアント・キャッシュ・レート制限を共有）
+#   - gpr_sidecar_socket に tools/sidecar.py の Unix ソケットを指定すると検索をそちらに任せる
+#   - 起動していない・応答しないときはしばらくプロセス内で取得する
+# ==========================================================
+_SIDECAR = {"path": None, "client": None}
+_NO_SIDECAR = object()
+
+def _sidecar():
+    path = (getattr(shared.opts, "gpr_sidecar_socket", "") or "").strip()
+    if not path:
+        return None
+    if _SIDECAR["path"] != path:
+        from scripts.GelSidecar import SidecarClient
+        old = _SIDECAR["client"]
+        if old is not None:
+            _runtime().spawn(old.close())
+        _SIDECAR.update(path=path, client=SidecarClient(path))
+    client = _SIDECAR["client"]
+    client.timeout = _time_budget()
+    return client if client.available else None
+
+def _sidecar_options(api_key, user_id) -> dict:
+    return {"api_key": api_key, "user_id": user_id,
+            "reservoir": bool(getattr(shared.opts, "gpr_reservoir", True)),
+            "no_repeat": bool(getattr(shared.opts, "gpr_no_repeat", True))}
+
+async def _sidecar_call(method, *args, **kwargs):
+    """
+    Sidecar 経由で呼ぶ。使えなければ _NO_SIDECAR を返すので、呼び出し側はプロセス内で取得する
+    """
+    sidecar = _sidecar()
+    if sidecar is None:
+        return _NO_SIDECAR
+    from scripts.GelSidecar import SidecarUnavailable
     try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            new_loop = asyncio.new_event_loop()
-            try:
-                asyncio.set_event_loop(new_loop)
-                return new_loop.run_until_complete(coro)
-            finally:
-                new_loop.close()
-                asyncio.set_event_loop(loop)
-        else:
-            return loop.run_until_complete(coro)
-    except RuntimeError:
-        return asyncio.run(coro)
+        return await getattr(sidecar, method)(*args, **kwargs)
+    except SidecarUnavailable as e:
+        print("[GPR] Sidecar unavailable, fetching in-process:", e)
+        return _NO_SIDECAR
+
+async def _random_post(api_key, user_id, include_list, exclude_list, prefetch_image=False):
+    """
+    1件ランダム取得。Reservoir有効時はプール済みの投稿から取り出す（不足分はバックグラウンド補充）。
+    prefetch_image=True なら次に出る投稿の画像を裏でキャッシュに先読みする。
+    Runtime のループ上で実行すること。
+    """
+    options = _sidecar_options(api_key, user_id)
+    post = await _sidecar_call("random_post", tags=include_list, exclude_tags=exclude_list, **options)
+    if post is not _NO_SIDECAR:
+        # sidecar が取ったページはこのプロセスのフックを通らないので、渡された投稿だけ数える
+        _observe_posts([post] if post else [])
+        if prefetch_image and options["reservoir"]:
+            upcoming = await _sidecar_call("peek", tags=include_list, exclude_tags=exclude_list, **options)
+            _prefetch_image(upcoming if upcoming is not _NO_SIDECAR else None)
+        return post
+
+    if getattr(shared.opts, "gpr_reservoir", True):
+        reservoir = _reservoir(api_key, user_id)
+        post = await reservoir.take(tags=include_list, exclude_tags=exclude_list)
+        if prefetch_image:
+            _prefetch_image(reservoir.peek(tags=include_list, exclude_tags=exclude_list))
+        return post
+    return await _gel_client(api_key, user_id).random_post(tags=include_list, exclude_tags=exclude_list)
+
+async def _random_posts(api_key, user_id, include_list, exclude_list, n):
+    """
+    N件の重複なしランダム取得（バッチ生成用）。1ページ(最大100件)から切り出すので 8枚バッチでも1リクエスト。
+    Runtime のループ上で実行すること。
+    """
+    posts = await _sidecar_call("random_posts", n, tags=include_list, exclude_tags=exclude_list,
+                                **_sidecar_options(api_key, user_id))
+    if posts is not _NO_SIDECAR:
+        _observe_posts(posts)
+        return posts
+
+    if getattr(shared.opts, "gpr_reservoir", True):
+        return await _reservoir(api_key, user_id).take_many(n, tags=include_list, exclude_tags=exclude_list)
+    return await _gel_client(api_key, user_id).random_posts(n, tags=include_list, exclude_tags=exclude_list)
+
+# ==========================================================
+# Init image cache (content-addressed by md5)
+#   - cache/images に保存、容量上限を超えたら LRU で削除
+# ==========================================================
+_IMAGE_CACHE = None
+
+def _image_cache():
+    global _IMAGE_CACHE
+    max_bytes = int(float(getattr(shared.opts, "gpr_image_cache_mb", 2048) or 0) * 1024 * 1024)
+    if _IMAGE_CACHE is None:
+        from scripts.GelImageCache import ImageCache
+        _IMAGE_CACHE = ImageCache(os.path.join(_cache_dir(), "images"), max_bytes=max_bytes)
+    _IMAGE_CACHE.max_bytes = max_bytes
+    return _IMAGE_CACHE
+
+_PREFETCHING = set()
+
+# ----------------------------------------------------
+# SDXL 推奨解像度への自動調整（縮小のみ・比率最適化）
+# ----------------------------------------------------
+_SDXL_PRESETS = [
+    (1024, 1024),
+    (1152, 896), (1216, 832), (1344, 768),
+    (1536, 640), (1568, 672), (1728, 576),
+    (896, 1152), (832, 1216), (768, 1344),
+    (640, 1536), (576, 1728), (512, 2048),
+]
+_KEEP_SIZE_PIXELS = 1_100_000  # 1.1M以下は拡大も縮小も禁止
+
+def _find_best_sdxl_size(w, h):
+    aspect = w / h
+    best = None
+    best_diff = 999.0
+
+    for pw, ph in _SDXL_PRESETS:
+        # ソースより大きいサイズはスキップ（縮小のみ）
+        if pw > w or ph > h:
+            continue
+
+        diff = abs(aspect - (pw / ph))
+        if diff < best_diff:
+            best_diff = diff
+            best = (pw, ph)
+
+    return best
+
+def _target_size(w, h):
+    """
+    元画像サイズから生成サイズを決定。None は「元サイズのまま・プリセット無し」。
+    """
+    if w * h <= _KEEP_SIZE_PIXELS:
+        return (w, h)
+    return _find_best_sdxl_size(w, h)
+
+def _init_image_source(post):
+    """
+    目標サイズを満たす最小の画像（preview / sample / original）を選ぶ。
+    Returns (cache_key, url, decode_target) — メタデータにサイズが無ければ original を全デコード。
+    """
+    w, h = post.width, post.height
+    target = _target_size(w, h) if w and h else None
+    if target is None:
+        return post.hash, post.file_url, None
+
+    tw, th = target
+    candidates = [
+        (post.preview_width * post.preview_height, post.preview_url, "preview",
+         post.preview_width >= tw and post.preview_height >= th),
+        (post.sample_width * post.sample_height, post.sample_url, "sample",
+         post.sample_width >= tw and post.sample_height >= th),
+    ]
+    for _, url, variant, fits in sorted(candidates, key=lambda c: c[0]):
+        if url and fits:
+            return (f"{post.hash}.{variant}" if post.hash else None), url, target
+    return post.hash, post.file_url, target
+
+def _decode_image(fp, target):
+    """
+    目標サイズ付近でデコード（JPEG は draft、その他は reduce）。ワーカースレッドで実行する。
+    """
+    from PIL import Image
+    img = Image.open(fp)
+    if target and img.format == "JPEG":
+        img.draft("RGB", target)
+    img.load()
+    if target:
+        factor = min(img.width // target[0], img.height // target[1])
+        if factor >= 2:
+            img = img.reduce(factor)
+    return img.convert("RGB")
+
+async def _load_init_image(post, image_url=None):
+    """
+    キャッシュにあれば mmap から、無ければ接続プール経由でダウンロード・保存してからデコード。
+    デコードはワーカースレッドで行い Runtime のループを止めない。
+    """
+    loop = asyncio.get_running_loop()
+    cache = _image_cache()
+    key, url, target = _init_image_source(post)
+    url = url or image_url
+
+    if key:
+        def decode_cached():
+            with cache.open(key) as mapped:
+                return _decode_image(mapped, target) if mapped is not None else None
+        with _METRICS.timer("decode"):
+            img = await loop.run_in_executor(None, decode_cached)
+        if img is not None:
+            return img
+
+    data = await _gel_client(None, None).fetch_file(url)
+    if key:
+        try:
+            with _METRICS.timer("image_cache_put"):
+                await loop.run_in_executor(None, cache.put, key, data)
+        except OSError as e:
+            print("[GPR] Image cache write failed:", e)
+    with _METRICS.timer("decode"):
+        return await loop.run_in_executor(None, _decode_image, io.BytesIO(data), target)
+
+def _prefetch_image(post):
+    """
+    次の投稿の画像をバックグラウンドでキャッシュへ（Runtime のループ上から呼ぶこと）
+    """
+    if post is None or not post.file_url or not post.hash:
+        return
+    key, url, _ = _init_image_source(post)
+    if not key or key in _PREFETCHING or key in _image_cache():
+        return
+
+    async def run():
+        try:
+            data = await _gel_client(None, None).fetch_file(url)
+            await asyncio.get_running_loop().run_in_executor(None, _image_cache().put, key, data)
+        except Exception as e:
+            print("[GPR] Image prefetch failed:", e)
+        finally:
+            _PREFETCHING.discard(key)
+
+    _PREFETCHING.add(key)
+    _runtime().spawn(run())
 
 # ==========================================================
 # Removal list: file-backed helpers (extensions-local)
 #   - File: extensions/Gelbooru-Prompt-Randomizer/removal_tags.txt
 #   - UTF-8 / 1行1タグ / 空行OK / 先頭が#の行はコメント
 #   - 比較は：trim -> lower -> " "→"_" の正規化で一致判定
+#   - *_background のようなワイルドカード（* のみ）、/.../ の行は正規表現。どのルールも文字どおりのタグには常に一致（scripts/GelTags.py 参照）
+#   - artist:* のようなカテゴリルールはタグDB（cache/tags.sqlite）で判定
+#   - 除外リストと設定から TagTransform を1回だけ組み立て、ファイルの mtime 確認は数秒に1回まで
 # ==========================================================
-_REMOVAL_CACHE = {"mtime": None, "set": set()}
+_REMOVAL_CHECK_INTERVAL = 2.0
+_TRANSFORM = {"key": None, "checked": 0.0, "mtime": None, "transform": None}
 
 def _removal_file_path() -> str:
     ext_root = os.path.dirname(os.path.dirname(__file__))
@@ -56,26 +386,6 @@ def _removal_file_path() -> str:
     os.makedirs(list_dir, exist_ok=True)
     return os.path.join(list_dir, "removal_tags.txt")
 
-def _normalize_tag(s: str) -> str:
-    return s.strip().lower().replace(" ", "_")
-
-def _parse_removal_text_to_set(text: str) -> set:
-    out = set()
-    if not text:
-        return out
-    text = text.replace("\r", "\n")
-    for line in text.split("\n"):
-        if not line:
-            continue
-        if line.lstrip().startswith("#"):
-            continue
-        parts = [p for p in line.split(",")] if "," in line else [line]
-        for p in parts:
-            t = _normalize_tag(p)
-            if t:
-                out.add(t)
-    return out
-
 def _read_removal_text() -> str:
     path = _removal_file_path()
     if not os.path.exists(path):
@@ -94,122 +404,450 @@ def _write_removal_text(content: str) -> None:
         f.write(content if content is not None else "")
     os.replace(tmp, path)
 
-def _load_removal_set(force: bool = False) -> set:
-    path = _removal_file_path()
-    mtime = os.path.getmtime(path) if os.path.exists(path) else None
-    if not force and _REMOVAL_CACHE["mtime"] == mtime:
-        return _REMOVAL_CACHE["set"]
-    text = _read_removal_text()
-    s = _parse_removal_text_to_set(text)
-    _REMOVAL_CACHE["mtime"] = mtime
-    _REMOVAL_CACHE["set"] = s
-    return s
+def _removal_mtime(force: bool = False):
+    now = time.monotonic()
+    if force or now - _TRANSFORM["checked"] >= _REMOVAL_CHECK_INTERVAL:
+        path = _removal_file_path()
+        _TRANSFORM["mtime"] = os.path.getmtime(path) if os.path.exists(path) else None
+        _TRANSFORM["checked"] = now
+    return _TRANSFORM["mtime"]
 
-def _apply_removal_filter(raw_tags: list) -> list:
+def _tag_transform(force: bool = False) -> TagTransform:
     """
-    Gelbooruの生タグ列（lower/underscore想定）に除外集合を適用。
-    失敗しても生成は止めない。
+    除外リスト＋アンダースコア置換をまとめたコンパイル済み変換。
+    除外リストの mtime と関連オプションの値が変わったときだけ作り直す。
     """
+    replace = bool(getattr(shared.opts, "gpr_replaceUnderscores", True))
+    keep = getattr(shared.opts, "gpr_undersocreReplacementExclusionList", "") or ""
+    # 全部外すと何も残らないので、未選択は「全カテゴリ残す」扱い
+    keep_categories = tuple(getattr(shared.opts, "gpr_keep_categories", None) or CATEGORIES)
+    key = (_removal_mtime(force), replace, keep, keep_categories)
+    if force or _TRANSFORM["transform"] is None or _TRANSFORM["key"] != key:
+        try:
+            rules = parse_rules(_read_removal_text()) + keep_categories_rules(keep_categories)
+            db = _tag_db() if uses_categories(rules) else None
+            transform = TagTransform(rules, replace_underscores=replace, keep_underscores=keep.split(","),
+                                     category=db.category if db is not None else None)
+        except re.error as e:
+            # 壊れた正規表現があっても生成は止めない（除外なしで続行）
+            print("[GPR] Invalid removal rule, removal list ignored:", e)
+            transform = TagTransform((), replace_underscores=replace, keep_underscores=keep.split(","))
+        _TRANSFORM["transform"] = transform
+        _TRANSFORM["key"] = key
+    return _TRANSFORM["transform"]
+
+# ==========================================================
+# Tag category DB (artist:* などのカテゴリルールと gpr_keep_categories 用)
+#   - cache/tags.sqlite にタグ名→カテゴリ/件数を保存、起動時にメモリへ読み込む
+#   - 未知のタグは生成中には問い合わせず、s=tag&names= で100件ずつバックグラウンドで埋める
+#   - 取得したページ（リザーバーの先読み含む）のタグも先に登録しておくので、生成時の追加リクエストは0
+# ==========================================================
+_TAG_DB = None
+_TAG_FILL = {"future": None}
+
+def _tag_db():
+    global _TAG_DB
+    if _TAG_DB is None:
+        from scripts.GelTagDB import TagDB
+        try:
+            _TAG_DB = TagDB(os.path.join(_cache_dir(), "tags.sqlite"))
+        except Exception as e:
+            print("[GPR] Tag database unavailable, category rules ignored:", e)
+            return None
+    return _TAG_DB
+
+async def _fill_tag_db(gel, db):
     try:
-        removal = _load_removal_set(force=False)
-        if not removal:
-            return raw_tags
-        return [t for t in raw_tags if t and _normalize_tag(t) not in removal]
-    except Exception:
-        return raw_tags
+        await db.fill(gel)
+    except Exception as e:
+        print("[GPR] Tag category lookup failed:", e)
+
+def _schedule_tag_fill():
+    db = _TAG_DB
+    if db is None or not db.pending:
+        return
+    running = _TAG_FILL["future"]
+    if running is not None and not running.done():
+        return  # 実行中の fill が新しく積まれた分もまとめて処理する
+    api_key = getattr(shared.opts, "gpr_api_key", None)
+    user_id = getattr(shared.opts, "gpr_user_id", None)
+    if not api_key or not user_id:
+        return
+    _TAG_FILL["future"] = _runtime().spawn(_fill_tag_db(_gel_client(api_key, user_id), db))
+
+def _observe_posts(posts):
+    """
+    search_posts のフック。カテゴリルール使用中のときだけ、ページ内の未知タグを登録して裏で引く。
+    共起モデル使用中はページをモデルにも数える
+    """
+    if not posts:
+        return
+    if _use_cooc():
+        _cooc_model().observe(posts)
+    if _tag_transform().category is None or _TAG_DB is None:
+        return
+    if _TAG_DB.observe(tag for post in posts for tag in post.get_tags()):
+        _schedule_tag_fill()
 
 # ---------- UI glue for Removal List ----------
 def _ui_load_removal_text() -> str:
     return _read_removal_text()
 
 def _ui_reload_removal_text():
-    _load_removal_set(force=True)
+    _tag_transform(force=True)
     return _read_removal_text()
 
 def _ui_save_removal_text(content: str):
     _write_removal_text(content or "")
-    _load_removal_set(force=True)
+    _tag_transform(force=True)
     return content or ""
 
+# ==========================================================
+# Local corpus (offline mode)
+#   - cache/corpus に mmap 可能な転置インデックスを保存
+#   - {a|b} は乱択せず OR 集合として解決
+# ==========================================================
+SOURCE_API = "Gelbooru API"
+SOURCE_CORPUS = "Local corpus"
+_CORPUS = {"path": None, "mtime": None, "corpus": None}
+
+def _corpus_path() -> str:
+    path = (getattr(shared.opts, "gpr_corpus_dir", "") or "").strip()
+    return path or os.path.join(_cache_dir(), "corpus")
+
+def _use_local_corpus() -> bool:
+    return getattr(shared.opts, "gpr_source", SOURCE_API) == SOURCE_CORPUS
+
+def _local_corpus():
+    from scripts.GelCorpus import LocalCorpus
+
+    path = _corpus_path()
+    meta = os.path.join(path, "meta.json")
+    mtime = os.path.getmtime(meta) if os.path.exists(meta) else None
+    if mtime is None:
+        return None
+    if _CORPUS["path"] != path or _CORPUS["mtime"] != mtime:
+        _CORPUS.update(path=path, mtime=mtime, corpus=LocalCorpus(path))
+    return _CORPUS["corpus"]
+
+def _local_post(include_str, exclude_str):
+    corpus = _local_corpus()
+    if corpus is None:
+        return None
+    include, exclude = [], []
+    # コーパスは OR グループをそのまま和集合で引けるので、候補を展開して渡す（重みは使わない）
+    for group in compile_template(include_str).alternatives():
+        # include 側の "-tag" は除外扱い（Gelbooru の検索構文と同じ）
+        if len(group) == 1 and group[0].startswith("-"):
+            exclude.append(group[0][1:])
+        else:
+            include.append(group)
+    exclude += [t.lstrip("-") for t in compile_template(exclude_str).sample()]
+    return corpus.sample(include, exclude)
+
+def _ui_build_corpus(include_str, exclude_str, pages):
+    from scripts.GelCorpus import build_from_api
+
+    api_key = getattr(shared.opts, "gpr_api_key", None)
+    user_id = getattr(shared.opts, "gpr_user_id", None)
+    if not api_key or not user_id:
+        return "You need to log in to your gelbooru account"
+    include, exclude = _split_query(include_str), _split_query(exclude_str)
+    try:
+        n = _run_async(build_from_api(_gel_client(api_key, user_id), _corpus_path(),
+                                      tags=include, exclude_tags=exclude, pages=int(pages or 1)))
+    except Exception as e:
+        return f"Corpus build failed: {e}"
+    return f"Corpus built: {n} posts -> {_corpus_path()}"
+
+def _ui_import_corpus(dump_paths):
+    from scripts.GelCorpus import CorpusBuilder
+
+    builder = CorpusBuilder()
+    files = []
+    for raw in (dump_paths or "").replace("\r", "\n").split("\n"):
+        raw = raw.strip()
+        if not raw:
+            continue
+        if os.path.isdir(raw):
+            files += sorted(os.path.join(raw, f) for f in os.listdir(raw) if f.lower().endswith((".xml", ".json", ".jsonl")))
+        else:
+            files.append(raw)
+    try:
+        for f in files:
+            builder.add_file(f)
+        builder.write(_corpus_path())
+    except Exception as e:
+        return f"Corpus import failed: {e}"
+    return f"Corpus imported: {len(builder)} posts from {len(files)} file(s) -> {_corpus_path()}"
+
+# ==========================================================
+# Co-occurrence model (synthesized prompts)
+#   - API から取得したページのタグ共起を cache/cooc.npz に数えていき、クエリ条件付きでタグ集合を合成
+#   - モデルがクエリをまだ知らない間は API から取得しつつ、そのクエリのページを裏で数ページ取ってモデルに数える
+#     （ウォームアップはクエリごとに1プロセス1回）
+# ==========================================================
+SOURCE_COOC = "Co-occurrence model"
+_COOC = None
+_COOC_WARMUPS = {}
+
+def _use_cooc() -> bool:
+    return getattr(shared.opts, "gpr_source", SOURCE_API) == SOURCE_COOC
+
+def _cooc_model():
+    global _COOC
+    if _COOC is None:
+        import atexit
+        from scripts.GelCooc import CoocModel
+        _COOC = CoocModel(os.path.join(_cache_dir(), "cooc.npz"))
+        atexit.register(_COOC.save)
+    return _COOC
+
+def _cooc_post(include_str, exclude_str):
+    """
+    合成したタグだけを持つ投稿（id 0、画像なし）。モデルが答えられなければ None
+    """
+    include, exclude = [], []
+    for tag in compile_template(include_str).sample():
+        # include 側の "-tag" は除外扱い（Gelbooru の検索構文と同じ）
+        if tag.startswith("-"):
+            exclude.append(tag[1:])
+        else:
+            include.append(tag)
+    exclude += [t.lstrip("-") for t in compile_template(exclude_str).sample()]
+    tags = _cooc_model().synthesize(include, exclude)
+    if tags is None:
+        _schedule_cooc_warmup(include_str, exclude_str)
+        return None
+    return GelbooruImage({"tags": " ".join(tags)}, None)
+
+async def _warm_up_cooc(gel, include, exclude, pages):
+    # 取得したページは search_posts のフック（_observe_posts）でモデルに数えられる
+    try:
+        for page in range(pages):
+            posts = await gel.search_posts(tags=include, exclude_tags=exclude, limit=100, page=page)
+            if len(posts) < 100:
+                break
+    except Exception as e:
+        print("[GPR] Co-occurrence warm-up failed:", e)
+
+def _schedule_cooc_warmup(include_str, exclude_str):
+    key = (include_str or "", exclude_str or "")
+    pages = max(0, int(getattr(shared.opts, "gpr_cooc_warmup_pages", 10) or 0))
+    api_key = getattr(shared.opts, "gpr_api_key", None)
+    user_id = getattr(shared.opts, "gpr_user_id", None)
+    if key in _COOC_WARMUPS or not pages or not api_key or not user_id:
+        return
+    gel = _gel_client(api_key, user_id)
+    _COOC_WARMUPS[key] = _runtime().spawn(_warm_up_cooc(gel, _split_query(include_str), _split_query(exclude_str), pages))
+
 # ==========================================================
 # Core tag fetcher (shared between UI & auto mode)
 # ==========================================================
-async def get_random_tags(include, exclude):
-    include = _expand_or_pattern_simple(include)
-    exclude = _expand_or_pattern_simple(exclude)
-    # 既存仕様：スペースはすべて削除、カンマ区切り
-    include = include.replace(" ", "")
-    exclude = exclude.replace(" ", "")
+def _split_query(s):
+    # 既存仕様：スペースはすべて削除、カンマ区切り。OR グループは件数を見ずに重みだけで選ぶ
+    return compile_template(s).sample() or None
+
+def _or_sampling() -> str:
+    mode = getattr(shared.opts, "gpr_or_sampling", SAMPLING_PROPORTIONAL)
+    return mode if mode in SAMPLING_MODES else SAMPLING_PROPORTIONAL
+
+async def _plan_query(gel, include_str, exclude_str):
+    """
+    Include/Exclude 欄をテンプレートとして解釈し、検索するタグの組み合わせを決める。
+    件数を見るモードでは各組み合わせの件数（カウントキャッシュ経由）で選ぶので、0件の組み合わせにリクエストを使わない。
+    Runtime のループ上で実行すること。Returns (include or None if every combination is empty, exclude)
+    """
+    exclude = _split_query(exclude_str)
+
+    async def count(tags):
+        n = await _sidecar_call("count", tags=tags, exclude_tags=exclude, api_key=gel._api_key, user_id=gel._user_id)
+        return n if n is not _NO_SIDECAR else await gel._cached_count(gel._format_tags(tags, exclude))
+
+    planner = QueryPlanner(count, mode=_or_sampling())
+    with _METRICS.timer("plan"):
+        include = await planner.choose(compile_template(include_str))
+    return include, exclude
+
+async def _pick_post(include_str, exclude_str, prefetch_image=False):
+    """
+    Returns (post or None, error message or None)
+    """
+    if _use_local_corpus():
+        if _local_corpus() is None:
+            return None, "Local corpus not found, build or import one first"
+        return _local_post(include_str, exclude_str), None
+    if _use_cooc():
+        post = _cooc_post(include_str, exclude_str)
+        if post is not None:
+            return post, None
+
+    api_key = getattr(shared.opts, "gpr_api_key", None)
+    user_id = getattr(shared.opts, "gpr_user_id", None)
+    if not api_key or not user_id:
+        return None, "You need to log in to your gelbooru account"
+
+    include, exclude = await _runtime().call(_plan_query(_gel_client(api_key, user_id), include_str, exclude_str))
+    if include is None:
+        return None, None
+    return await _runtime().call(_random_post(api_key, user_id, include, exclude, prefetch_image)), None
+
+async def _pick_posts(include_str, exclude_str, n):
+    """
+    Returns (list of posts, error message or None)
+    """
+    if _use_local_corpus():
+        if _local_corpus() is None:
+            return [], "Local corpus not found, build or import one first"
+        posts = {}
+        for _ in range(n * 3):
+            post = _local_post(include_str, exclude_str)
+            if post is None:
+                break
+            posts.setdefault(post.id, post)
+            if len(posts) >= n:
+                break
+        return list(posts.values()), None
+    if _use_cooc():
+        posts = [_cooc_post(include_str, exclude_str) for _ in range(n)]
+        if all(post is not None for post in posts):
+            return posts, None
+
     api_key = getattr(shared.opts, "gpr_api_key", None)
     user_id = getattr(shared.opts, "gpr_user_id", None)
+    if not api_key or not user_id:
+        return [], "You need to log in to your gelbooru account"
+
+    include, exclude = await _runtime().call(_plan_query(_gel_client(api_key, user_id), include_str, exclude_str))
+    if include is None:
+        return [], None
+    return await _runtime().call(_random_posts(api_key, user_id, include, exclude, n)), None
+
+def _post_tags(post, transform=None) -> list:
+    # 除外リスト（TXT）の適用と "_"→" " の可読化を1パスで
+    tags = (transform or _tag_transform())(post.get_tags())
+    _schedule_tag_fill()  # カテゴリ未知のタグがあれば次回以降のために裏で引く
+    return tags
 
-    if(api_key == "" or user_id == ""):
-        return "You need to log in to your gelbooru account", None, "You need to log in to your gelbooru account"
+def _time_budget() -> float:
+    return max(1.0, float(getattr(shared.opts, "gpr_time_budget", 20) or 20))
 
-    include = include.split(',') if include else None
-    exclude = exclude.split(',') if exclude else None
+async def _fetch_random(include, exclude, want_image=False):
+    """
+    タグ取得〜画像取得までを1つの時間予算 (gpr_time_budget) 内で非同期に実行。
+    画像段階が予算を超える場合はタグのみで続行する。Runtime のループ上で実行すること。
+    Returns (tags_str, image_url, post, init_image). On failure: (error message, None, None, None)
+    """
+    loop = asyncio.get_running_loop()
+    budget = _time_budget()
+    deadline = loop.time() + budget
 
-    gel_post = await Gelbooru(api_key=api_key, user_id=user_id).random_post(tags=include, exclude_tags=exclude)
-    if(gel_post == None or gel_post == []):
-        return "Couldn't find a post with the specified tags", None, "Couldn't find a post with the specified tags"
-    
-    tags = gel_post.get_tags()
-    # ★ 追加：出力時の除外フィルタ（TXT）
-    tags = _apply_removal_filter(tags)
+    def remaining():
+        return max(0.0, deadline - loop.time())
 
-    # 既存仕様：除外リストに無いものだけ "_"→" " の可読化
-    excl = getattr(shared.opts, "gpr_undersocreReplacementExclusionList").split(',')
-    for i in range(len(tags)):
-        if(tags[i] not in excl):
-            tags[i] = tags[i].replace("_", " ")
+    try:
+        with _METRICS.timer("pick"):
+            gel_post, error = await asyncio.wait_for(_pick_post(include, exclude, prefetch_image=want_image), remaining())
+    except asyncio.TimeoutError:
+        error, gel_post = f"Timed out after {budget:g}s while searching posts", None
+    if error:
+        return error, None, None, None
+    if not gel_post:
+        return "Couldn't find a post with the specified tags", None, None, None
+
+    with _METRICS.timer("tags"):
+        tags = _post_tags(gel_post)
 
     # --- 安全化: 画像URLの存在確認 ---
     image_url = getattr(gel_post, "file_url", None)
+    init_image = None
     if not image_url or not isinstance(image_url, str) or not image_url.strip():
         image_url = None
-    else:
+    elif want_image:
+        # ダウンロード自体が存在確認を兼ねる
+        try:
+            init_image = await asyncio.wait_for(_load_init_image(gel_post, image_url), remaining())
+        except asyncio.TimeoutError:
+            print(f"[GPR] Image stage exceeded the {budget:g}s budget, continuing with tags only")
+            image_url = None
+        except Exception as e:
+            print("[GPR] Image download failed, continuing with tags only:", e)
+            image_url = None
+    elif not (gel_post.hash and gel_post.hash in _image_cache()):  # キャッシュ済みなら確認不要
         try:
-            resp = requests.head(image_url, timeout=5)
-            if resp.status_code != 200:
+            if not await asyncio.wait_for(_gel_client(None, None).check_file(image_url), min(5.0, remaining())):
                 image_url = None  # 死んだURLはスキップ
         except Exception:
-            image_url = None  # 接続失敗も同様にスキップ
+            image_url = None  # 接続失敗・タイムアウトも同様にスキップ
 
-    return ', '.join(tags), image_url, str(gel_post)
+    return ', '.join(tags), image_url, gel_post, init_image
+
+async def _fetch_random_batch(include, exclude, n):
+    """
+    バッチ用：N件の投稿を1つの時間予算内でまとめて取得（画像は扱わない）。
+    Returns (list of (tags_str, post), error message or None)
+    """
+    budget = _time_budget()
+    try:
+        with _METRICS.timer("pick"):
+            posts, error = await asyncio.wait_for(_pick_posts(include, exclude, n), budget)
+    except asyncio.TimeoutError:
+        return [], f"Timed out after {budget:g}s while searching posts"
+    if error:
+        return [], error
+    if not posts:
+        return [], "Couldn't find a post with the specified tags"
+    transform = _tag_transform()
+    return [(', '.join(_post_tags(post, transform)), post) for post in posts], None
 
+def _join_prompt(prompt, tags_str):
+    return f"{prompt}, {tags_str}" if prompt else tags_str
 
+async def get_random_tags(include, exclude):
+    tags_str, image_url, gel_post, _ = await _runtime().call(_fetch_random(include, exclude))
+    if gel_post is None:
+        return tags_str, None, tags_str
+    return tags_str, image_url, str(gel_post) if gel_post.id else ""
 
 
 def _fetch_tags_sync(include_str, exclude_str):
     """Used in before_process (sync wrapper)."""
-    api_key = getattr(shared.opts, "gpr_api_key", None)
-    user_id = getattr(shared.opts, "gpr_user_id", None)
-    if not api_key or not user_id:
+    post, error = _run_async(_pick_post(include_str, exclude_str))
+    if error or not post:
         return None
+    return _post_tags(post)
 
-    include_str = _expand_or_pattern_simple(include_str)
-    exclude_str = _expand_or_pattern_simple(exclude_str)
 
-    # 既存仕様：スペースはすべて削除、カンマ区切り
-    include = include_str.replace(" ", "") if include_str else ""
-    exclude = exclude_str.replace(" ", "") if exclude_str else ""
-    include_list = include.split(',') if include else None
-    exclude_list = exclude.split(',') if exclude else None
+# ==========================================================
+# Metrics export (Prometheus text format)
+#   - ファイル: gpr_metrics_file（空なら cache/metrics.prom）、書き込みは10秒に1回まで
+#   - HTTP: WebUI 起動時に GET /gpr/metrics を追加
+# ==========================================================
+def _metrics_file() -> str:
+    return getattr(shared.opts, "gpr_metrics_file", "") or os.path.join(_cache_dir(), "metrics.prom")
 
-    gel = Gelbooru(api_key=api_key, user_id=user_id)
-    post = _run_async(gel.random_post(tags=include_list, exclude_tags=exclude_list))
-    if not post:
-        return None
+def _export_metrics(force: bool = False):
+    now = time.monotonic()
+    if not force and now - _METRICS_WRITTEN["at"] < _METRICS_WRITE_INTERVAL:
+        return
+    _METRICS_WRITTEN["at"] = now
+    try:
+        _METRICS.write_prometheus(_metrics_file())
+    except OSError as e:
+        print("[GPR] Metrics export failed:", e)
 
-    tags = post.get_tags()
-    # ★ 追加：出力時の除外フィルタ（TXT）
-    tags = _apply_removal_filter(tags)
+def _on_app_started(demo, app):
+    from fastapi.responses import PlainTextResponse
 
-    # 既存仕様：除外リストに無いものだけ "_"→" " の可読化
-    excl = getattr(shared.opts, "gpr_undersocreReplacementExclusionList").split(',')
-    processed = [t.replace("_", " ") if t not in excl else t for t in tags]
-    return processed
+    def metrics():
+        return PlainTextResponse(_METRICS.prometheus(), media_type="text/plain; version=0.0.4")
 
+    app.add_api_route("/gpr/metrics", metrics, methods=["GET"])
+    # aiohttp / PIL / xmltodict は scripts/ のどのモジュールも最初の取得時まで読み込まない
+    # (WebUI は scripts/ の .py を全部 import するので、補助モジュールの読み込み時間はこの数字に入らないことがある)
+    print(f"[GPR] Startup: import {_STARTUP['import_ms']:.1f} ms, settings {_STARTUP['settings_ms']:.1f} ms")
+
+script_callbacks.on_app_started(_on_app_started)
 
 # ==========================================================
 # Main UI Script
@@ -237,7 +875,7 @@ class GPRScript(scripts.Script):
                 # ----- Removal List (TXT-backed) -----
                 with gr.Group():
                     removal_textbox = gr.Textbox(
-                        label="Removal List (comma-separated or newline-separated tags; lines starting with # are comments)",
+                        label="Removal List (comma-separated or newline-separated tags; * wildcards like *_background; /.../ lines are regular expressions; artist:* style rules remove a tag category; lines starting with # are comments)",
                         value=_ui_load_removal_text(),
                         lines=3
                     )
@@ -245,6 +883,15 @@ class GPRScript(scripts.Script):
                         removal_save_btn = gr.Button(value='Save Removal List', variant='primary', size='sm')
                         removal_reload_btn = gr.Button(value='Reload', size='sm')
 
+                # ----- Local corpus (offline mode) -----
+                with gr.Accordion('Local corpus', open=False):
+                    with gr.Row():
+                        corpus_pages = gr.Number(label='Pages to fetch (100 posts each)', value=50, precision=0)
+                        corpus_build_btn = gr.Button(value='Build from Include/Exclude', size='sm')
+                    corpus_dump_paths = gr.Textbox(label='Dump files or folders (one per line: dapi XML / JSON / JSON lines)', lines=2)
+                    corpus_import_btn = gr.Button(value='Import Dump', size='sm')
+                    corpus_status = gr.Textbox(label='Corpus status', interactive=False)
+
                 with gr.Row():
                     send_text_button = gr.Button(value='Randomize', variant='primary', size='sm')
                     append_tags_button = gr.Button(value='Append Tags', size='sm')
@@ -268,6 +915,17 @@ class GPRScript(scripts.Script):
                 outputs=[removal_textbox],
             )
 
+            corpus_build_btn.click(
+                fn=_ui_build_corpus,
+                inputs=[self.include_box, self.exclude_box, corpus_pages],
+                outputs=[corpus_status],
+            )
+            corpus_import_btn.click(
+                fn=_ui_import_corpus,
+                inputs=[corpus_dump_paths],
+                outputs=[corpus_status],
+            )
+
             append_tags_button.click(
                 fn=lambda result_tags, tags: (f"{tags}, {result_tags}"),
                 inputs=[result_tags_textbox, self.text2img if not is_img2img else self.img2img],
@@ -294,16 +952,38 @@ class GPRScript(scripts.Script):
         if not enable_auto:
             return
 
+        # この生成で観測した段階ごとの時間を集計（Runtime ループ上の処理も contextvar で追跡される）
+        with trace() as timings, _METRICS.timer("total"):
+            self._before_process(p, include_box, exclude_box)
+
+        if timings and getattr(shared.opts, "gpr_metrics_infotext", False):
+            if not hasattr(p, "extra_generation_params"):
+                p.extra_generation_params = {}
+            p.extra_generation_params["GPR Timings"] = format_trace(timings)
+        _export_metrics()
+
+    def _before_process(self, p, include_box, exclude_box):
+        is_img2img = isinstance(p, StableDiffusionProcessingImg2Img)
+        total = max(1, int(getattr(p, "batch_size", 1) or 1)) * max(1, int(getattr(p, "n_iter", 1) or 1))
+        if not is_img2img and total > 1:
+            # txt2img のバッチは画像ごとに別のタグ（img2img は初期画像が1枚なので従来通り）
+            self._before_process_batch(p, include_box, exclude_box, total)
+            return
+
         try:
-            # 1回のリクエストでタグ＋画像URL＋Post情報取得
-            tags_str, image_url, post_info = _run_async(get_random_tags(include_box, exclude_box))
+            # 1回の呼び出しでタグ＋画像URL＋Post情報＋（img2imgなら）画像データ取得
+            tags_str, image_url, post, init_image = _run_async(
+                _fetch_random(include_box, exclude_box, want_image=is_img2img),
+                timeout=_time_budget() + 5,
+            )
         except Exception as e:
-            print("[GPR] get_random_tags failed:", e)
+            print("[GPR] get_random_tags failed:", e or type(e).__name__)
             return
 
         # エラーメッセージ系は無視
-        if not tags_str or "You need" in tags_str or "Couldn't find" in tags_str:
+        if post is None or not tags_str:
             return
+        post_info = str(post) if post.id else None  # 合成したタグには投稿ページがない
 
         # ---- プロンプトにタグを追加 ----
         if getattr(p, "prompt", ""):
@@ -311,59 +991,28 @@ class GPRScript(scripts.Script):
         else:
             p.prompt = tags_str
 
-        # ----------------------------------------------------
-        # SDXL 推奨解像度への自動調整（縮小のみ・比率最適化）
-        # ----------------------------------------------------
-        def _find_best_sdxl_size(w, h):
-            presets = [
-                (1024, 1024),
-                (1152, 896), (1216, 832), (1344, 768),
-                (1536, 640), (1568, 672), (1728, 576),
-                (896, 1152), (832, 1216), (768, 1344),
-                (640, 1536), (576, 1728), (512, 2048),
-            ]
-
-            aspect = w / h
-            best = None
-            best_diff = 999.0
-
-            for pw, ph in presets:
-                # ソースより大きいサイズはスキップ（縮小のみ）
-                if pw > w or ph > h:
-                    continue
-
-                diff = abs(aspect - (pw / ph))
-                if diff < best_diff:
-                    best_diff = diff
-                    best = (pw, ph)
-
-            return best
-
         # ---- img2img のときのみ画像を投入＆解像度最適化 ----
-        if isinstance(p, StableDiffusionProcessingImg2Img) and image_url:
+        if is_img2img and init_image is not None:
             try:
-                resp = requests.get(image_url, timeout=10)
-
-                # Pillow で実体読み込み（ここで壊れた画像だと例外）
-                img = Image.open(io.BytesIO(resp.content))
-                img.load()
-                img = img.convert("RGB")
-
-                # ソース画像の実サイズから、最適な SDXL 推奨解像度を決定
-                px = img.width * img.height
-                if px <= 1_100_000:  # 1.1M以下は拡大も縮小も禁止
-                    print(f"[GPR] Keep original size due to low pixel count: {img.width}x{img.height}")
-                    p.width, p.height = img.width, img.height
-                else:
-                    best = _find_best_sdxl_size(img.width, img.height)
-                    if best:
-                        p.width, p.height = best
-                        print(f"[GPR] Auto SDXL Resize → {p.width}x{p.height}")
+                with _METRICS.timer("resize"):
+                    img = init_image
+
+                    # ソース画像の実サイズ（メタデータ優先、デコード画像は縮小済みの場合あり）から最適な SDXL 推奨解像度を決定
+                    src_w, src_h = (post.width, post.height) if post.width and post.height else (img.width, img.height)
+                    px = src_w * src_h
+                    if px <= _KEEP_SIZE_PIXELS:  # 1.1M以下は拡大も縮小も禁止
+                        print(f"[GPR] Keep original size due to low pixel count: {src_w}x{src_h}")
+                        p.width, p.height = src_w, src_h
                     else:
-                        print(f"[GPR] No suitable SDXL preset for {img.width}x{img.height}, keep original")
+                        best = _find_best_sdxl_size(src_w, src_h)
+                        if best:
+                            p.width, p.height = best
+                            print(f"[GPR] Auto SDXL Resize → {p.width}x{p.height}")
+                        else:
+                            print(f"[GPR] No suitable SDXL preset for {src_w}x{src_h}, keep original")
 
-                p.init_images = [img]
-                print(f"[GPR] Init Image Loaded (source) = {img.width}x{img.height}")
+                    p.init_images = [img]
+                    print(f"[GPR] Init Image Loaded (source) = {src_w}x{src_h}, decoded = {img.width}x{img.height}")
 
             except Exception as e:
                 print("[GPR] Invalid image. Skip init image:", e)
@@ -389,10 +1038,36 @@ class GPRScript(scripts.Script):
         except Exception as e:
             print("[GPR] Metadata insert failed:", e)
 
+    def _before_process_batch(self, p, include_box, exclude_box, total):
+        try:
+            results, error = _run_async(_fetch_random_batch(include_box, exclude_box, total), timeout=_time_budget() + 5)
+        except Exception as e:
+            print("[GPR] get_random_tags failed:", e or type(e).__name__)
+            return
+        if error or not results:
+            print("[GPR]", error)
+            return
+        if len(results) < total:
+            print(f"[GPR] Only {len(results)} posts found for a batch of {total}, reusing some")
+
+        # p.prompt をリストにすると all_prompts が画像ごとにそのまま使われる
+        base = p.prompt if isinstance(p.prompt, list) else [p.prompt or ""] * total
+        picks = [results[i % len(results)] for i in range(total)]
+        p.prompt = [_join_prompt(base[i] if i < len(base) else base[-1], tags_str) for i, (tags_str, _) in enumerate(picks)]
+
+        if not hasattr(p, "extra_generation_params"):
+            p.extra_generation_params = {}
+        if include_box:
+            p.extra_generation_params["GPR Include Tags"] = include_box
+        # 画像ごとの投稿 ID。リストにすると create_infotext が画像ごとに1件ずつ書く（合成したタグのみのときは残さない）
+        if any(post.id for _, post in picks):
+            p.extra_generation_params["GPR Post IDs"] = [str(post.id) for _, post in picks]
+
     # ======================================================
     # 設定UI（既存）
     # ======================================================
     def on_ui_settings():
+        started = time.perf_counter()
         GPR_SECTION = ("gpr", "Gelbooru Prompt Randomizer")
 
         gpr_options = {
@@ -403,11 +1078,34 @@ class GPRScript(scripts.Script):
                 "0_0,(o)_(o),+_+,+_-,._.,<o>_<o>,<|>_<|>,=_=,>_<,3_3,6_9,>_o,@_@,^_^,o_o,u_u,x_x,|_|,||_||",
                 "Underscore replacement exclusion list"
             ).info("Add tags that shouldn't have underscores replaced with spaces, separated by comma."),
+            "gpr_pool_size": shared.OptionInfo(8, "HTTP connection pool size", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}).info("Keep-alive connections shared by all requests to Gelbooru"),
+            "gpr_max_concurrency": shared.OptionInfo(4, "Max concurrent requests", gr.Slider, {"minimum": 1, "maximum": 32, "step": 1}).info("Shared by all tabs and API clients; identical in-flight requests are coalesced into one"),
+            "gpr_rate_limit": shared.OptionInfo(8, "Max Gelbooru API requests per second", gr.Slider, {"minimum": 1, "maximum": 30, "step": 1}).info("Backs off automatically on 429 responses and climbs back to this rate"),
+            "gpr_max_retries": shared.OptionInfo(3, "Retries on 429 / 5xx / connection errors", gr.Slider, {"minimum": 0, "maximum": 8, "step": 1}).info("Jittered exponential backoff; after repeated failures requests pause briefly instead of piling up"),
+            "gpr_endpoints": shared.OptionInfo("", "Mirror API endpoints", gr.Textbox, {"lines": 3}).info("One Gelbooru compatible dapi URL per line (https://.../index.php), serving the same posts. Requests go to the fastest endpoint and get a duplicate on the next one when slow. Your Gelbooru credentials are only sent to Gelbooru, add ?api_key=...&user_id=... to a mirror URL for its own account"),
+            "gpr_sidecar_socket": shared.OptionInfo("", "Sidecar socket").info("Unix socket of tools/sidecar.py, shared by several WebUI instances on this machine (one rate limit, count/response cache and reservoir); falls back to fetching in this process while it is not running. Empty: disabled"),
+            "gpr_dns_cache_ttl": shared.OptionInfo(300, "DNS cache TTL (seconds)", gr.Number).info("0 disables caching of resolved addresses"),
+            "gpr_count_cache_ttl": shared.OptionInfo(600, "Post count cache TTL (seconds)", gr.Number).info("Older counts are still used but refreshed in the background"),
+            "gpr_source": shared.OptionInfo(SOURCE_API, "Post source", gr.Radio, {"choices": [SOURCE_API, SOURCE_CORPUS, SOURCE_COOC]}).info("Local corpus samples offline from a corpus built or imported in the accordion / Co-occurrence model synthesizes tags from the tag pairs of posts fetched so far (cache/cooc.npz), using the API until it knows the query"),
+            "gpr_cooc_warmup_pages": shared.OptionInfo(10, "Co-occurrence model warm-up pages", gr.Slider, {"minimum": 0, "maximum": 50, "step": 1}).info("Pages of 100 posts fetched in the background, once per query, while the model does not know the query yet"),
+            "gpr_corpus_dir": shared.OptionInfo("", "Local corpus directory").info("Empty: extensions/Gelbooru-Prompt-Randomizer/cache/corpus"),
+            "gpr_time_budget": shared.OptionInfo(20, "Time budget per generation (seconds)", gr.Number).info("Search, URL check and image download share this budget; img2img falls back to tags only when the image would exceed it"),
+            "gpr_response_cache_mb": shared.OptionInfo(256, "API response cache size (MB)", gr.Number).info("Search pages and post lookups are kept compressed in cache/responses.sqlite and reused across restarts; 0 disables"),
+            "gpr_image_cache_mb": shared.OptionInfo(2048, "Init image cache size (MB)", gr.Number).info("Downloaded img2img init images are kept on disk by md5; 0 disables the cache"),
+            "gpr_response_parser": shared.OptionInfo("expat", "Response parser", gr.Radio, {"choices": ["expat", "json", "xmltodict"]}).info("expat: streaming XML / json: API json=1 mode (fastest) / xmltodict: legacy"),
+            "gpr_or_sampling": shared.OptionInfo(SAMPLING_PROPORTIONAL, "{a|b} OR group sampling", gr.Radio, {"choices": list(SAMPLING_MODES)}).info("proportional: by post count (uniform over all matching posts) / nonempty: skip alternatives without posts / uniform: random pick without counting; alt::3 sets a weight"),
+            "gpr_metrics_infotext": shared.OptionInfo(False, "Write per-image stage timings to the infotext (GPR Timings)"),
+            "gpr_metrics_file": shared.OptionInfo("", "Prometheus metrics file").info("Stage latency p50/p95/p99, also served at /gpr/metrics. Empty: extensions/Gelbooru-Prompt-Randomizer/cache/metrics.prom"),
+            "gpr_keep_categories": shared.OptionInfo(list(CATEGORIES), "Tag categories to keep", gr.CheckboxGroup, {"choices": list(CATEGORIES)}).info("Unchecked categories are removed like artist:* rules in the removal list; categories are looked up in the background and cached in cache/tags.sqlite, tags not looked up yet are kept"),
+            "gpr_reservoir": shared.OptionInfo(True, "Prefetch posts in the background (reservoir)").info("Fetch 100 posts per request and hand them out one per generation"),
+            "gpr_no_repeat": shared.OptionInfo(True, "Avoid repeating recently used posts").info("Remembers the last 50k-100k posts handed out per query (fixed ~120 KB, list/recent_posts.bloom) and skips them in prefetched pages; needs the reservoir"),
+            "gpr_reservoir_low_water": shared.OptionInfo(20, "Reservoir refill threshold", gr.Slider, {"minimum": 0, "maximum": 99, "step": 1}).info("Start a background refill when fewer posts than this remain"),
         }
 
         for key, opt in gpr_options.items():
             opt.section = GPR_SECTION
             shared.opts.add_option(key, opt)
+        _STARTUP["settings_ms"] += (time.perf_counter() - started) * 1000
 
     script_callbacks.on_ui_settings(on_ui_settings)
 
@@ -417,3 +1115,5 @@ class GPRScript(scripts.Script):
             self.text2img = component
         if kwargs.get("elem_id") == "img2img_prompt":
             self.img2img = component
+
+_STARTUP["import_ms"] = (time.perf_counter() - _STARTUP["started"]) * 1000
@@ -0,0 +1,163 @@
+"""
+Rebuild the tag prompts of generated images from the post IDs in their infotext.
+
+Usage:
+    python tools/regenerate_prompts.py <images or folders> [--out prompts.jsonl] [--txt]
+                                       [--api-key KEY --user-id ID] [--webui-config path/to/config.json]
+                                       [--concurrency 4] [--api https://gelbooru.com/index.php]
+
+Reads the PNG infotext ("parameters" chunk) of every image and collects the post recorded by the
+extension: GPR Post URL, or GPR Post IDs for batches (one ID per image). Images from batches saved
+by older versions, which list the IDs of the whole batch, are reported as ambiguous. All posts are fetched with Gelbooru.get_posts, 100 IDs per
+request, and their tags go through the same removal list, category rules (gpr_keep_categories,
+artist:* style rules, with categories from the extension's cache/tags.sqlite) and underscore rules
+as the extension. Categories of tags not in the database yet are looked up before the tags are used.
+
+Writes one JSON line per image ({"file", "id", "post_url", "tags"} or {"file", "id", "error"}) to
+--out or stdout. With --txt a caption file <image>.txt is also written next to every image.
+Credentials and the gpr_ tag options are read from the WebUI config.json (found automatically when
+the extension sits in extensions/), command line arguments take precedence.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from typing import *
+
+EXT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, EXT_ROOT)
+
+from scripts.Gel import Gelbooru, GelbooruException, get_runtime  # noqa: E402
+from scripts.GelTagDB import TagDB  # noqa: E402
+from scripts.GelTags import CATEGORIES, TagTransform, keep_categories_rules, parse_rules, uses_categories  # noqa: E402
+
+_POST_URL_RE = re.compile(r'GPR Post URL: "?[^\s",]*[?&]id=(\d+)')
+_POST_IDS_RE = re.compile(r'GPR Post IDs: "?([\d ]+)"?')
+
+
+def iter_images(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if name.lower().endswith('.png'):
+                        yield os.path.join(root, name)
+        elif path.lower().endswith('.png'):
+            yield path
+
+
+def read_infotext(path: str) -> Optional[str]:
+    from PIL import Image
+    try:
+        with Image.open(path) as image:
+            return image.info.get('parameters')
+    except OSError:
+        return None
+
+
+def post_ids(infotext: str) -> List[int]:
+    """
+    IDs recorded by the extension, one per image. Older versions wrote the whole batch into every image
+    """
+    match = _POST_IDS_RE.search(infotext)
+    if match:
+        return [int(post_id) for post_id in match.group(1).split()]
+    match = _POST_URL_RE.search(infotext)
+    return [int(match.group(1))] if match else []
+
+
+def load_webui_config(path: Optional[str]) -> dict:
+    candidates = [path] if path else [os.path.join(EXT_ROOT, '..', '..', 'config.json')]
+    for candidate in candidates:
+        if candidate and os.path.exists(candidate):
+            with open(candidate, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    return {}
+
+
+def load_rules(config: dict) -> List[str]:
+    """
+    The removal list plus the rules for gpr_keep_categories, as the extension builds them
+    """
+    removal = os.path.join(EXT_ROOT, 'list', 'removal_tags.txt')
+    text = ''
+    if os.path.exists(removal):
+        with open(removal, 'r', encoding='utf-8') as f:
+            text = f.read()
+    return parse_rules(text) + keep_categories_rules(tuple(config.get('gpr_keep_categories') or CATEGORIES))
+
+
+def build_transform(config: dict, rules: List[str], db: Optional[TagDB] = None) -> TagTransform:
+    return TagTransform(rules,
+                        replace_underscores=config.get('gpr_replaceUnderscores', True),
+                        keep_underscores=(config.get('gpr_undersocreReplacementExclusionList') or '').split(','),
+                        category=db.category if db is not None else None)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('paths', nargs='+', help='PNG files or folders')
+    ap.add_argument('--out', help='JSON lines output file, stdout if omitted')
+    ap.add_argument('--txt', action='store_true', help='also write <image>.txt caption files')
+    ap.add_argument('--api-key')
+    ap.add_argument('--user-id')
+    ap.add_argument('--webui-config', help='WebUI config.json with the gpr_ options')
+    ap.add_argument('--concurrency', type=int, default=4)
+    ap.add_argument('--api', help='dapi endpoint, Gelbooru by default')
+    args = ap.parse_args()
+
+    config = load_webui_config(args.webui_config)
+    api_key = args.api_key or config.get('gpr_api_key') or None
+    user_id = args.user_id or config.get('gpr_user_id') or None
+    rules = load_rules(config)
+    db = TagDB(os.path.join(EXT_ROOT, 'cache', 'tags.sqlite')) if uses_categories(rules) else None
+    transform = build_transform(config, rules, db)
+
+    images = []
+    for path in iter_images(args.paths):
+        infotext = read_infotext(path)
+        ids = post_ids(infotext) if infotext else []
+        if ids:
+            images.append((path, ids))
+    print(f'{len(images)} images with post IDs', file=sys.stderr)
+
+    runtime = get_runtime(pool_size=max(1, args.concurrency))
+    gel = Gelbooru(api_key=api_key, user_id=user_id, api=args.api, runtime=runtime,
+                   max_concurrency=args.concurrency)
+    all_ids = [ids[0] for _, ids in images if len(ids) == 1]
+    posts = runtime.submit(gel.get_posts(all_ids))
+    if db is not None and db.observe(tag for post in posts.values() for tag in post.get_tags()):
+        print(f'Looking up the categories of {db.pending} tags', file=sys.stderr)
+        try:
+            runtime.submit(db.fill(gel))
+        except GelbooruException as e:
+            print(f'Tag category lookup failed, tags of unknown category are kept: {e}', file=sys.stderr)
+    tags_by_id = {post_id: transform(post.get_tags()) for post_id, post in posts.items()}
+    print(f'{len(posts)} of {len(set(all_ids))} posts found', file=sys.stderr)
+
+    out = open(args.out, 'w', encoding='utf-8') if args.out else sys.stdout
+    try:
+        for path, ids in images:
+            if len(ids) > 1:
+                out.write(json.dumps({'file': path, 'id': None,
+                                      'error': f'ambiguous, the infotext lists the {len(ids)} post IDs of a batch'}) + '\n')
+                continue
+            post_id = ids[0]
+            if post_id not in tags_by_id:
+                out.write(json.dumps({'file': path, 'id': post_id, 'error': 'post not found'}) + '\n')
+                continue
+            tags = ', '.join(tags_by_id[post_id])
+            out.write(json.dumps({'file': path, 'id': post_id, 'post_url': str(posts[post_id]), 'tags': tags},
+                                 ensure_ascii=False) + '\n')
+            if args.txt:
+                with open(os.path.splitext(path)[0] + '.txt', 'w', encoding='utf-8') as f:
+                    f.write(tags + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        runtime.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Run the shared Gelbooru sidecar for several WebUI instances on one machine.
+
+Usage:
+    python tools/sidecar.py [--socket /tmp/gpr.sock] [--webui-config path/to/config.json]
+                            [--rate 8] [--concurrency 4] [--retries 3] [--parser expat]
+                            [--response-cache-mb 256] [--cache-dir DIR] [--api https://gelbooru.com/index.php]
+
+Every WebUI instance whose "Sidecar socket" option (gpr_sidecar_socket) points at the same socket
+sends its post searches here, so they share one rate budget, one post count cache, one response
+cache and one reservoir per query. Instances fall back to fetching in-process while the sidecar is
+not running. Defaults come from the gpr_ options in the WebUI config.json (found automatically when
+the extension sits in extensions/), command line arguments take precedence. Stop with Ctrl+C.
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+
+EXT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, EXT_ROOT)
+
+from scripts.Gel import Gelbooru, get_runtime  # noqa: E402
+from scripts.GelSidecar import SidecarServer  # noqa: E402
+
+
+def load_webui_config(path):
+    candidates = [path] if path else [os.path.join(EXT_ROOT, '..', '..', 'config.json')]
+    for candidate in candidates:
+        if candidate and os.path.exists(candidate):
+            with open(candidate, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    return {}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--socket', help='socket path, gpr_sidecar_socket by default')
+    ap.add_argument('--webui-config', help='WebUI config.json with the gpr_ options')
+    ap.add_argument('--rate', type=float, help='API requests per second for all instances together')
+    ap.add_argument('--concurrency', type=int)
+    ap.add_argument('--retries', type=int)
+    ap.add_argument('--parser', choices=[Gelbooru.PARSER_EXPAT, Gelbooru.PARSER_JSON, Gelbooru.PARSER_XMLTODICT])
+    ap.add_argument('--response-cache-mb', type=float)
+    ap.add_argument('--cache-dir', help='count and response caches, the extension cache/ by default')
+    ap.add_argument('--api', help='dapi endpoint, Gelbooru by default')
+    args = ap.parse_args()
+
+    config = load_webui_config(args.webui_config)
+
+    def option(value, name, default):
+        return value if value is not None else config.get(name, default)
+
+    path = args.socket or config.get('gpr_sidecar_socket')
+    if not path:
+        ap.error('no socket path: pass --socket or set the Sidecar socket option in the WebUI settings')
+    cache_dir = args.cache_dir or os.path.join(EXT_ROOT, 'cache')
+
+    server = SidecarServer(
+        path,
+        cache_dir=cache_dir,
+        api=args.api,
+        rate=max(0.5, float(option(args.rate, 'gpr_rate_limit', 8))),
+        max_concurrency=int(option(args.concurrency, 'gpr_max_concurrency', 4)),
+        max_retries=max(0, int(option(args.retries, 'gpr_max_retries', 3))),
+        parser=option(args.parser, 'gpr_response_parser', Gelbooru.PARSER_EXPAT),
+        response_cache_mb=float(option(args.response_cache_mb, 'gpr_response_cache_mb', 256)),
+        recent_path=os.path.join(EXT_ROOT, 'list', 'recent_posts.bloom'),
+        low_water=int(config.get('gpr_reservoir_low_water', 20)),
+    )
+    runtime = get_runtime(pool_size=max(1, int(config.get('gpr_pool_size', 8))))
+    runtime.submit(server.start())
+    print(f'Listening on {path}', file=sys.stderr)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        while not stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runtime.submit(server.close(), timeout=10)
+        print(f'Stopped, {dict(server.stats)}', file=sys.stderr)
+        runtime.close()
+
+
+if __name__ == '__main__':
+    main()